@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+from bisect_b2g.pool import disk_usage
+from bisect_b2g.util import pid_alive
+
+log = logging.getLogger(__name__)
+
+
+def line_fingerprint(history_line, config=''):
+    """
+    A key for the build of a line of history: a hash of its sorted
+    project names and revisions along with the build configuration
+    """
+    h = hashlib.sha1()
+    for name, hash in sorted((x.prj.name, x.hash) for x in history_line):
+        h.update('%s %s\n' % (name, hash))
+    h.update('config %s\n' % config)
+    return h.hexdigest()
+
+
+def config_fingerprint(config):
+    """The contents of config if it's a file, like a mozconfig, or config"""
+    if config and os.path.isfile(config):
+        with open(config, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return config or ''
+
+
+class ArtifactCache(object):
+    """
+    Build artifacts saved by evaluators, one directory per line of history
+    and build configuration.  An artifact is built in a staging directory
+    and renamed into place when it's published, so nobody ever sees half of
+    one.  Once the artifacts use more than budget bytes, the least recently
+    used ones that nobody is reading are removed.
+
+    Like a CheckoutPool, the sizes and use times are kept in a JSON file
+    that is only touched while holding a lock, so that several bisections
+    can share a cache
+    """
+
+    def __init__(self, path, config='', budget=None):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        self.config = config_fingerprint(config)
+        self.budget = budget
+        self.state_file = os.path.join(self.path, 'artifacts.json')
+        self.lock = threading.Lock()
+        for x in ('objects', 'tmp'):
+            if not os.path.isdir(os.path.join(self.path, x)):
+                os.makedirs(os.path.join(self.path, x))
+
+    def _with_state(self, func):
+        with self.lock:
+            with open(os.path.join(self.path, 'artifacts.lock'), 'a') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                try:
+                    state = {'artifacts': {}}
+                    if os.path.exists(self.state_file):
+                        with open(self.state_file) as f:
+                            state = json.load(f)
+                    rv = func(state)
+                    tmp = self.state_file + '.tmp'
+                    with open(tmp, 'w') as f:
+                        json.dump(state, f, indent=2, sort_keys=True)
+                    os.rename(tmp, self.state_file)
+                    return rv
+                finally:
+                    fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def key(self, history_line):
+        return line_fingerprint(history_line, self.config)
+
+    def artifact_path(self, key):
+        return os.path.join(self.path, 'objects', key[:2], key)
+
+    def has(self, history_line):
+        """Whether there's an artifact for history_line, without using it"""
+        return os.path.isdir(self.artifact_path(self.key(history_line)))
+
+    def lookup(self, history_line):
+        """
+        Where the artifact for history_line is, or None.  It isn't removed
+        until it's given back with release
+        """
+        key = self.key(history_line)
+        path = self.artifact_path(key)
+
+        def lease(state):
+            info = state['artifacts'].get(key)
+            if info is None or not os.path.isdir(path):
+                return None
+            info['used'] = time.time()
+            info['readers'].append(os.getpid())
+            return path
+
+        path = self._with_state(lease)
+        if path is not None:
+            log.info("Found a saved artifact at %s", path)
+        return path
+
+    def release(self, history_line):
+        key = self.key(history_line)
+
+        def unlease(state):
+            info = state['artifacts'].get(key)
+            if info is not None and os.getpid() in info['readers']:
+                info['readers'].remove(os.getpid())
+
+        self._with_state(unlease)
+
+    def staging(self):
+        """An empty directory to build an artifact in"""
+        return tempfile.mkdtemp(dir=os.path.join(self.path, 'tmp'))
+
+    def discard(self, staging):
+        shutil.rmtree(staging, ignore_errors=True)
+
+    def publish(self, history_line, staging):
+        """
+        Make what was built in staging the artifact for history_line and
+        return where it is.  Nothing is published if staging is empty or
+        there's already an artifact
+        """
+        if not os.listdir(staging):
+            self.discard(staging)
+            return None
+        key = self.key(history_line)
+        path = self.artifact_path(key)
+        size = disk_usage(staging)
+
+        def add(state):
+            if os.path.isdir(path):
+                return False, []
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(staging, path)
+            state['artifacts'][key] = {'size': size, 'used': time.time(),
+                                       'readers': []}
+            return True, self._evict(state, key)
+
+        added, evicted = self._with_state(add)
+        if not added:
+            self.discard(staging)
+        else:
+            log.info("Saved a %d byte artifact at %s", size, path)
+        for key in evicted:
+            log.info("Removing artifact %s to stay within %d bytes", key,
+                     self.budget)
+            # Moved aside first so that it disappears all at once
+            doomed = tempfile.mkdtemp(dir=os.path.join(self.path, 'tmp'))
+            os.rename(self.artifact_path(key), os.path.join(doomed, key))
+            self.discard(doomed)
+        return path
+
+    def _evict(self, state, keep):
+        if self.budget is None:
+            return []
+        artifacts = state['artifacts']
+        total = sum(x['size'] for x in artifacts.values())
+        evicted = []
+        for key, info in sorted(artifacts.items(), key=lambda x: x[1]['used']):
+            if total <= self.budget:
+                break
+            if key == keep or any(pid_alive(x) for x in info['readers']):
+                continue
+            total -= info['size']
+            del artifacts[key]
+            evicted.append(key)
+        return evicted
+
+
+class BuildIndexError(Exception):
+    pass
+
+
+class BuildIndex(object):
+    """
+    Builds that already exist, each with the revision of every project it
+    was built from.  The index is a JSON file holding a list like
+
+      [{"path": "builds/2013-05-01", "revisions": {"gecko": "0f6c...",
+        "gaia": "8a2e..."}}]
+
+    or an object mapping each path to its revisions.  Paths are relative to
+    the index and revisions can be abbreviated
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        self.entries = self._load()
+        self.builds = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            raise BuildIndexError("Could not read build index %s: %s" %
+                                  (self.path, e))
+        if isinstance(data, dict) and 'builds' in data:
+            data = data['builds']
+        if isinstance(data, dict):
+            data = [{'path': k, 'revisions': v} for k, v in data.items()]
+        if not isinstance(data, list):
+            raise BuildIndexError("%s doesn't look like a build index" %
+                                  self.path)
+        base = os.path.dirname(self.path)
+        entries = []
+        for entry in data:
+            try:
+                path = os.path.join(base, entry['path'])
+                revisions = dict(entry['revisions'])
+            except (KeyError, TypeError, ValueError) as e:
+                raise BuildIndexError("Build %r in %s is malformed: %s" %
+                                      (entry, self.path, e))
+            entries.append((path, revisions))
+        return entries
+
+    def resolve(self, projects):
+        """
+        Match the builds to the revisions of projects, which have to be
+        set before lookup can find anything.  Builds missing a project or
+        with a revision that isn't in its range are left out
+        """
+        hashes = dict((x.name, [y[0] for y in x.full_rev_list()])
+                      for x in projects)
+        self.builds = {}
+        for path, revisions in self.entries:
+            key = []
+            for name in sorted(hashes):
+                prefix = revisions.get(name)
+                matches = [x for x in hashes[name]
+                           if prefix and x.startswith(prefix)]
+                if len(matches) != 1:
+                    log.debug("Build %s has no single %s revision in range",
+                              path, name)
+                    break
+                key.append((name, matches[0]))
+            else:
+                self.builds[tuple(key)] = path
+        log.info("%d of the %d builds in %s are in range", len(self.builds),
+                 len(self.entries), self.path)
+
+    def lookup(self, history_line):
+        """The build of history_line, or None"""
+        return self.builds.get(
+            tuple(sorted((x.prj.name, x.hash) for x in history_line)))
+
+    def has(self, history_line):
+        return self.lookup(history_line) is not None
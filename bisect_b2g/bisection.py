@@ -4,6 +4,8 @@ import math
 from mako import exceptions
 from mako.template import Template
 
+from bisect_b2g.checkout import CheckoutPlanner
+
 # I would love templates to be in a data file.  PR encouraged!
 
 html_template = """<!DOCTYPE html><%! import isodate, datetime, socket %>
@@ -99,7 +101,13 @@ function show_tags(chkbox) {
   tr.untested.odd {
     background: #babdb6;
   }
-  tr.found.pass, tr.found.fail, tr.found.untested {
+  tr.skip.even {
+    background: #fce94f;
+  }
+  tr.skip.odd {
+    background: #edd400;
+  }
+  tr.found.pass, tr.found.fail, tr.found.skip, tr.found.untested {
     background: #204a87;
     color: white;
   }
@@ -109,7 +117,7 @@ function show_tags(chkbox) {
 <div id="page">
 <div id="header">
 <h1>Bisection results for ${", ".join([x.name.title() for x in projects])}</h1>
-% for cls in ('found', 'pass', 'fail', 'untested'):
+% for cls in ('found', 'pass', 'fail', 'skip', 'untested'):
 <input value="${cls}" type="checkbox" checked="checked"
     onclick="show_hide_row(this.value, this.checked)"
     class="filter">${cls.title()}</input>
@@ -165,6 +173,8 @@ function show_tags(chkbox) {
       classes.append('pass')
     elif loop.index in fail_i:
       classes.append('fail')
+    elif loop.index in skip_i:
+      classes.append('skip')
     else:
       classes.append('untested')
 
@@ -200,49 +210,118 @@ function show_tags(chkbox) {
 log = logging.getLogger(__name__)
 
 
+def describe_outcome(outcome):
+    if outcome is None:
+        return 'skip'
+    return 'pass' if outcome else 'fail'
+
+
 class Bisection(object):
 
-    def __init__(self, projects, history, evaluator):
+    # How far from the ideal split point, as a part of the distance to the
+    # next one, a line can be picked because it's cheaper to test
+    cheap_window = 0.25
+    # and at most how many lines away
+    max_cheap_distance = 32
+
+    def __init__(self, projects, history, evaluator, store=None,
+                 runner=None, prefetcher=None, first_good=False):
         object.__init__(self)
         self.projects = projects
         self.history = history
         self.evaluator = evaluator
-        self.max_recursions = \
-            round(math.log(len(history), 2))
+        self.store = store
+        self.runner = runner
+        self.prefetcher = prefetcher
+        # Whether the first line is known to be good, so it's never tested
+        self.first_good = first_good
         self.pass_i = []
         self.fail_i = []
+        # Lines the evaluator couldn't say anything about
+        self.skip_i = []
         self.order = []
         assert len(history) > 0
-        self.found = self._bisect(self.history, 0, 0)
+        if runner is not None and runner.jobs > 1:
+            self.max_recursions = \
+                round(math.log(len(history), runner.jobs + 1))
+            self.found = self._kary_bisect()
+        else:
+            self.max_recursions = \
+                round(math.log(len(history), 2))
+            self.planner = CheckoutPlanner()
+            try:
+                self.found = self._bisect(self.history, 0, 0)
+            finally:
+                self.planner.close()
+        self._warn_skipped()
+
+    def _warn_skipped(self):
+        """Say so if the change could be in a line that was skipped"""
+        end = min([x for x in self.fail_i if x > self.found_i] or
+                  [len(self.history)])
+        skipped = sorted(x for x in self.skip_i if self.found_i < x < end)
+        if skipped:
+            log.warning("Lines %s were skipped, so the change could be in "
+                        "any of them", ", ".join(str(x + 1) for x in skipped))
 
     def _bisect(self, history, num, offset_b):
+        if len(history) == 1 and offset_b == 0 and self.first_good:
+            self.found_i = 0
+            return history[0]
+
         def test(revs):
             log.info("Running test %d of %d", num + 1,
                      self.max_recursions + 1)
             for rev in revs:
                 log.info("  * " + str(rev))
-            for rev in revs:
-                log.debug("Setting revision for %s" % rev)
-                rev.prj.set_rev(rev.hash)
-            _outcome = self.evaluator.eval(revs)
+            _outcome = None
+            if self.store is not None:
+                _outcome = self.store.get(revs)
+                if _outcome is not None:
+                    log.info("Using the stored result for this line")
+            if _outcome is None:
+                if self.prefetcher is not None:
+                    workspace = self.prefetcher.take(revs)
+                    # Whatever the outcome, one of these gets tested next
+                    if len(history) > 1:
+                        self.prefetcher.prepare(
+                            [x[next(self._split_points(len(x), offset))]
+                             for x, offset in
+                             ((history[:middle], offset_b),
+                              (history[middle:], offset_b + middle))])
+                    _outcome = self.evaluator.eval_in(revs, workspace.path)
+                else:
+                    if self.evaluator.needs_checkout:
+                        self.planner.apply(revs)
+                    _outcome = self.evaluator.eval(revs)
+                if self.store is not None and _outcome is not None:
+                    self.store.put(revs, _outcome)
 
-            log.info("Test %s", 'pass' if _outcome else 'fail')
+            log.info("Test %s", describe_outcome(_outcome))
 
+            if _outcome is None:
+                self.skip_i.append(overall_index)
             if not overall_index in self.order:
                 self.order.append(overall_index)
             return _outcome
 
-        middle = len(history) / 2
-        overall_index = middle + offset_b
-
-        outcome = test(history[middle])
+        outcome = None
+        for middle in self._split_points(len(history), offset_b):
+            overall_index = middle + offset_b
+            outcome = test(history[middle])
+            if outcome is not None:
+                break
 
-        if len(history) == 1:
-            if num == self.max_recursions - 1:
+        if len(history) == 1 or outcome is None:
+            if len(history) > 1:
+                log.warning("None of lines %d to %d could be tested, the "
+                            "change is somewhere in them", offset_b + 1,
+                            offset_b + len(history))
+            elif num == self.max_recursions - 1:
                 # Sometimes, we do log2(N), others log2(N)-1
                 log.info("Psych!")
                 log.debug("We don't need to do the last recursion")
-            self.found_i = overall_index
+            self.found_i = offset_b
             return history[0]
         else:
             if outcome:
@@ -252,6 +331,132 @@ class Bisection(object):
                 self.fail_i.append(overall_index)
                 return self._bisect(history[:middle], num+1, offset_b)
 
+    def _is_cheap(self, history_line):
+        """Whether testing history_line needs no build or no test"""
+        if self.store is not None and \
+                self.store.get(history_line) is not None:
+            return True
+        return self.evaluator.is_cached(history_line)
+
+    def _cheap_near(self, i, lo, hi, gap, offset=0, taken=()):
+        """
+        The closest line to i between lo and hi that is cheap to test, if
+        there's one close enough given the gap between split points
+        """
+        if self.store is None and self.evaluator.artifacts is None and \
+                self.evaluator.builds is None:
+            return None
+        window = min(int(gap * self.cheap_window), self.max_cheap_distance)
+        for distance in range(window + 1):
+            for j in (i + distance, i - distance):
+                if lo < j < hi and j + offset not in self.skip_i and \
+                        j not in taken and \
+                        self._is_cheap(self.history[j + offset]):
+                    if j != i:
+                        log.info("Testing line %d instead of %d, which is "
+                                 "cheaper", j + offset + 1, i + offset + 1)
+                    return j
+        return None
+
+    def _split_points(self, size, offset_b):
+        """
+        Where to split a range of size lines, starting with the middle, or
+        a cheaper line near it, and moving out from it past lines that have
+        been skipped
+        """
+        if size == 1:
+            yield 0
+            return
+        middle = size / 2
+        cheap = self._cheap_near(middle, 0, size, middle, offset_b)
+        if cheap is not None:
+            yield cheap
+        for distance in range(size):
+            for i in (middle + distance, middle - distance):
+                if 0 < i < size and i + offset_b not in self.skip_i and \
+                        i != cheap:
+                    yield i
+                    if distance == 0:
+                        break
+
+    def _nearest_untried(self, i, lo, hi, taken):
+        """The closest line to i between lo and hi that can be tested"""
+        for distance in range(hi - lo):
+            for j in (i + distance, i - distance):
+                if lo < j < hi and j not in self.skip_i and j not in taken:
+                    return j
+        return None
+
+    def _test_lines(self, indices, num):
+        """Evaluate several lines of history at once with the runner"""
+        log.info("Running round %d of about %d, testing %d lines", num + 1,
+                 self.max_recursions, len(indices))
+        outcomes = {}
+        for i in indices:
+            if self.store is not None:
+                outcomes[i] = self.store.get(self.history[i])
+                if outcomes[i] is not None:
+                    log.info("Using the stored result for line %d", i + 1)
+        untested = [i for i in indices if outcomes.get(i) is None]
+        lines = [self.history[i] for i in untested]
+        for i, outcome in zip(untested, self.runner.evaluate(lines)):
+            outcomes[i] = outcome
+            if self.store is not None and outcome is not None:
+                self.store.put(self.history[i], outcome)
+        for i in indices:
+            log.info("Test of line %d: %s", i + 1,
+                     describe_outcome(outcomes[i]))
+            if outcomes[i] is None:
+                self.skip_i.append(i)
+            elif outcomes[i]:
+                self.pass_i.append(i)
+            else:
+                self.fail_i.append(i)
+            if i not in self.order:
+                self.order.append(i)
+        return outcomes
+
+    def _kary_bisect(self):
+        """
+        Like _bisect, but each round tests as many evenly spaced lines as
+        the runner has jobs, cutting the range into jobs + 1 parts
+        """
+        jobs = self.runner.jobs
+        lo, hi = 0, len(self.history)
+        num = 0
+        while hi - lo > 1:
+            size = hi - lo
+            indices = []
+            for x in range(1, jobs + 1):
+                i = lo + max(1, size * x / (jobs + 1))
+                if i in indices:
+                    continue
+                cheap = self._cheap_near(i, lo, hi, size / (jobs + 1),
+                                         taken=indices)
+                if cheap is not None:
+                    indices.append(cheap)
+                    continue
+                i = self._nearest_untried(i, lo, hi, indices)
+                if i is not None:
+                    indices.append(i)
+            if not indices:
+                log.warning("None of lines %d to %d could be tested, the "
+                            "change is somewhere in them", lo + 1, hi)
+                break
+            indices.sort()
+            outcomes = self._test_lines(indices, num)
+            for i in indices:
+                if outcomes[i] is None:
+                    continue
+                elif outcomes[i]:
+                    lo = i
+                else:
+                    hi = i
+                    break
+            num += 1
+        self.found_i = lo
+        return self.history[lo]
+
     def write(self, filename, fmt='html'):
         if fmt == 'html':
             return self.write_html(filename)
@@ -267,6 +472,7 @@ class Bisection(object):
                     projects=self.projects,
                     pass_i=self.pass_i,
                     fail_i=self.fail_i,
+                    skip_i=self.skip_i,
                     found_i=self.found_i,
                     order=self.order
                 ))
@@ -0,0 +1,76 @@
+import time
+import logging
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+
+class CheckoutPlanner(object):
+    """
+    Moves the projects to a line of history, only touching the ones that
+    aren't already there and updating those at the same time.  It keeps
+    track of how long each project's updates take so it can tell how much
+    time skipping and overlapping them saved
+    """
+
+    def __init__(self, jobs=None):
+        object.__init__(self)
+        self.jobs = jobs
+        self.pool = None
+        self.durations = {}
+        self.saved = 0.0
+
+    def _map(self, func, revs):
+        # Threads only pay off when there's more than one thing to do
+        if len(revs) < 2:
+            return map(func, revs)
+        if self.pool is None:
+            self.pool = ThreadPool(self.jobs or len(revs))
+        return self.pool.map(func, revs)
+
+    def _current(self, rev):
+        try:
+            return rev.prj.get_rev()
+        except Exception as e:
+            log.debug("Could not tell where %s is: %s", rev.prj.name, e)
+            return None
+
+    def _update(self, rev):
+        start = time.time()
+        log.debug("Setting revision for %s" % rev)
+        rev.prj.set_rev(rev.hash)
+        duration = time.time() - start
+        self.durations.setdefault(rev.prj.name, []).append(duration)
+        return duration
+
+    def plan(self, history_line):
+        """The revisions of a line whose projects need to be updated"""
+        current = self._map(self._current, history_line)
+        return [rev for rev, at in zip(history_line, current)
+                if at != rev.hash]
+
+    def _estimate(self, name):
+        durations = self.durations.get(name)
+        if not durations:
+            return 0.0
+        return sum(durations) / len(durations)
+
+    def apply(self, history_line):
+        changed = self.plan(history_line)
+        start = time.time()
+        durations = self._map(self._update, changed)
+        elapsed = time.time() - start
+        skipped = [x for x in history_line if x not in changed]
+        saved = sum(durations) - elapsed + \
+            sum(self._estimate(x.prj.name) for x in skipped)
+        self.saved += max(saved, 0)
+        log.info("Updated %d of %d repositories in %.1fs, saving about "
+                 "%.1fs (%.1fs so far)", len(changed), len(history_line),
+                 elapsed, max(saved, 0), self.saved)
+        return changed
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,127 @@
+import os
+import logging
+import sqlite3
+
+from bisect_b2g.util import StoreError
+
+log = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS commits (
+    hash TEXT PRIMARY KEY,
+    parent TEXT,
+    epoch REAL NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+chain_query = """
+WITH RECURSIVE chain(hash, parent, epoch, offset, depth) AS (
+    SELECT hash, parent, epoch, offset, 0 FROM commits WHERE hash = ?
+    UNION ALL
+    SELECT c.hash, c.parent, c.epoch, c.offset, chain.depth + 1
+    FROM commits c JOIN chain ON c.hash = chain.parent
+    WHERE chain.hash != ?
+)
+SELECT hash, epoch, offset FROM chain ORDER BY depth
+"""
+
+
+class CommitIndex(object):
+    """
+    An SQLite database of the first parent history of a repository that
+    outlives a single bisection.  Each commit is stored with its first
+    parent, commit time and offset, so a good..bad range that has been seen
+    before is answered without asking the repository at all.  A parent of
+    NULL means we haven't looked past that commit yet.
+
+    The database uses write-ahead logging so that many bisect processes on
+    the same host can read it while one of them is adding to it
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def chain(self, start, end):
+        """
+        The indexed commits from end back to start as (hash, epoch, offset)
+        tuples, newest first, or None if the index can't answer that yet
+        """
+        rows = self.db.execute(chain_query, (end, start)).fetchall()
+        if len(rows) == 0 or rows[-1][0] != start:
+            return None
+        return [(str(h), e, o) for h, e, o in rows]
+
+    def add(self, revs):
+        """
+        Store (hash, epoch, offset) tuples that follow each other along first
+        parents, newest first.  The oldest one is stored without a parent
+        unless we already know it.  Whatever is stored here is trusted from
+        then on, so revs has to come from a first parent walk
+        """
+        with self.db:
+            rows = [(h, p[0], e, o) for (h, e, o), p in zip(revs, revs[1:])]
+            self.db.executemany(
+                "INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?)", rows)
+            if len(revs) > 0:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO commits VALUES (?, NULL, ?, ?)",
+                    revs[-1])
+
+    def _walk(self, revs, complete=False):
+        new = []
+        for rev in revs:
+            new.append(rev)
+            if complete:
+                continue
+            known = self.db.execute(
+                "SELECT parent FROM commits WHERE hash = ?",
+                (rev[0],)).fetchone()
+            if known is not None and known[0] is not None:
+                break
+        return new
+
+    def update(self, repository, start, end, complete=False):
+        """
+        Walk the first parents of the repository from end, stopping at the
+        first commit that's already indexed with a parent unless complete
+        is set, and add what we found
+        """
+        try:
+            new = self._walk(repository.iter_revs(start, end), complete)
+        except StoreError as e:
+            log.debug("Reading %s directly failed, using the VCS: %s",
+                      repository.name, e)
+            new = self._walk(repository.iter_revs_vcs(start, end), complete)
+        log.debug("Adding %d commits of %s to the commit index",
+                  len(new), repository.name)
+        self.add(new)
+
+    def rev_tuples(self, repository, start, end):
+        """
+        Like Repository.rev_tuples, but answered from the index, which gets
+        updated from the repository when it doesn't cover the range yet
+        """
+        start = repository.full_hash(start)
+        end = repository.full_hash(end)
+        revs = self.chain(start, end)
+        if revs is None:
+            self.update(repository, start, end)
+            revs = self.chain(start, end)
+        if revs is None:
+            # The walk stopped on an indexed commit whose ancestry isn't
+            # complete, so index the whole range
+            self.update(repository, start, end, complete=True)
+            revs = self.chain(start, end)
+        return revs
@@ -1,17 +1,29 @@
 import os
+import shlex
+import socket
 import optparse
 import urlparse
 import logging
 import cProfile
 import pstats
+from multiprocessing.pool import ThreadPool
 
 log = logging.getLogger(__name__)
 
 import bisect_b2g
-from bisect_b2g.repository import Project
+from bisect_b2g.repository import Project, clone_modes
 from bisect_b2g.bisection import Bisection
-from bisect_b2g.history import build_history
-from bisect_b2g.evaluator import ScriptEvaluator, InteractiveEvaluator
+from bisect_b2g.history import build_compact_history, refine_history, \
+    prebuilt_lines, build_gap
+from bisect_b2g.pushes import load_pushlog, PushlogError
+from bisect_b2g.evaluator import ScriptEvaluator, InteractiveEvaluator, \
+    PythonEvaluator, HarnessEvaluator, EvaluatorError, load_function
+from bisect_b2g.results import ResultStore
+from bisect_b2g.mirror import MirrorCache
+from bisect_b2g.artifacts import ArtifactCache, BuildIndex, BuildIndexError
+from bisect_b2g.remote import Coordinator, Worker, RemoteError
+from bisect_b2g.workspace import make_runner, make_pools, make_prefetcher, \
+    sparse_patterns
 
 
 class InvalidArg(Exception):
@@ -163,19 +175,202 @@ def make_arg(arg_data):
     return arg
 
 
+class ProjectSetupError(Exception):
+
+    def __init__(self, failures):
+        Exception.__init__(self, "Could not set up %d of the repositories:\n"
+                           % len(failures) +
+                           "\n".join("  * %s: %s" % x for x in failures))
+        self.failures = failures
+
+
+def _setup_project(repo_data, use_index, clone_mode, mirror_cache=None):
+    try:
+        mirror = None
+        if mirror_cache is not None and \
+                repo_data['uri'] != repo_data['local_path'] and \
+                not os.path.exists(repo_data['local_path']):
+            mirror = mirror_cache.update(repo_data['uri'], repo_data['vcs'],
+                                         repo_data['name'])
+        project = Project(
+            name=repo_data['name'],
+            url=repo_data['uri'],
+            local_path=repo_data['local_path'],
+            good=repo_data['good'],
+            bad=repo_data['bad'],
+            vcs=repo_data['vcs'],
+            use_index=use_index,
+            clone_mode=clone_mode,
+            mirror=mirror,
+        )
+        project.rev_list()
+        return project, None
+    except Exception as e:
+        log.debug("Setting up %s failed", repo_data['name'], exc_info=True)
+        return None, e
+
+
+def setup_projects(repo_datas, jobs, use_index=True, clone_mode='full',
+                   mirror_cache=None):
+    """
+    Create, clone or open and read the history of each project, up to jobs
+    at a time.  The projects come back in the same order as repo_datas.  If
+    any of them fail, ProjectSetupError lists all of the failures.  New
+    clones borrow from the mirrors in mirror_cache when there is one
+    """
+    pool = ThreadPool(max(1, min(jobs, len(repo_datas))))
+    try:
+        results = pool.map(
+            lambda x: _setup_project(x, use_index, clone_mode, mirror_cache),
+            repo_datas)
+    finally:
+        pool.close()
+        pool.join()
+    failures = [(x['name'], e) for x, (p, e) in zip(repo_datas, results)
+                if e is not None]
+    if failures:
+        for project, e in results:
+            if project is not None:
+                project.close()
+        raise ProjectSetupError(failures)
+    return [x[0] for x in results]
+
+
 def main():
     parser = optparse.OptionParser("%prog - I bisect repositories!")
     parser.add_option("--script", "-x", help="Script to run.  Return code 0 " +
                       "means the current changesets are good, Return code 1 " +
                       "means that it's bad", dest="script")
+    parser.add_option("--timeout", help="Seconds the script can run " +
+                      "for before it and everything it started are " +
+                      "killed, which skips the revision set unless " +
+                      "--on-timeout says otherwise", dest="timeout",
+                      type="float", default=None)
+    parser.add_option("--on-timeout", help="Whether a revision set whose " +
+                      "test timed out is skipped (the default), good or bad",
+                      dest="on_timeout", type="choice",
+                      choices=["skip", "good", "bad"], default="skip")
+    parser.add_option("--idle-timeout", help="Seconds the script can go " +
+                      "without printing anything before it's killed",
+                      dest="idle_timeout", type="float", default=None)
+    parser.add_option("--script-log", help="Append the script's output " +
+                      "to this file instead of throwing it away",
+                      dest="script_log", default=None)
+    parser.add_option("--artifact-cache", help="Directory where " +
+                      "scripts can save what they build for each revision " +
+                      "set, through $BISECT_ARTIFACT_SAVE, and find it " +
+                      "again in $BISECT_ARTIFACT_HIT.  Revision sets with " +
+                      "something saved are tested first when they're close " +
+                      "enough to where the range would be split",
+                      dest="artifact_cache", default=None)
+    parser.add_option("--artifact-config", help="What else decides what " +
+                      "gets built, like a mozconfig file or a string " +
+                      "naming the build type.  Artifacts built with a " +
+                      "different one aren't used", dest="artifact_config",
+                      default="")
+    parser.add_option("--artifact-budget", help="Megabytes of artifacts " +
+                      "to keep.  The least recently used ones are removed " +
+                      "first", dest="artifact_budget", type="int",
+                      default=None)
+    parser.add_option("--builds", help="JSON file listing builds that " +
+                      "already exist and the revisions they were built " +
+                      "from.  The revision sets with a build are bisected " +
+                      "first, with the build in $BISECT_ARTIFACT_HIT, and " +
+                      "then the ones between the two builds that were " +
+                      "found", dest="builds", default=None)
     parser.add_option("-o", "--output", help="File to write HTML output to",
                       dest="output_html", default="bisect.html")
+    parser.add_option("--python", help="Python function to call " +
+                      "instead of a script, as package.module:function or " +
+                      "path/to/file.py:function.  It gets an object whose " +
+                      "read(path) method returns a file's contents at the " +
+                      "revision set, which is never checked out",
+                      dest="python", default=None)
+    parser.add_option("--harness", help="Command to start once and keep " +
+                      "running, which is sent each revision set as a line " +
+                      "of JSON on stdin and answers with a line like " +
+                      "{\"verdict\": \"pass\"}, \"fail\" or \"skip\"",
+                      dest="harness", default=None)
+    parser.add_option("--listen", help="Don't test anything here, but " +
+                      "hand the revision sets to workers that connect to " +
+                      "this address, which is host:port or the path of a " +
+                      "Unix socket.  Use --jobs to keep several busy",
+                      dest="listen", default=None)
+    parser.add_option("--worker", help="Test revision sets for the " +
+                      "bisection listening at this address with the " +
+                      "script, harness or Python function given here.  " +
+                      "The repositories are cloned under --workspaces",
+                      dest="worker", default=None)
     parser.add_option("-i", "--interactive", help="Interactively determine " +
                       "if the changeset is good",
                       dest="interactive", action="store_true")
     parser.add_option("-v", "--verbose", help="Logfile verbosity",
                       action="store_true", dest="verbose")
     parser.add_option("--profile-output", dest="prof_out", default=None)
+    parser.add_option("--history-file", help="Store the combined history " +
+                      "index in this file and mmap it instead of keeping " +
+                      "it in memory", dest="history_file", default=None)
+    parser.add_option("--setup-jobs", help="How many repositories to " +
+                      "clone, open and read history from at once",
+                      dest="setup_jobs", type="int", default=8)
+    parser.add_option("--clone-mode", help="How to clone repositories " +
+                      "that aren't there yet: full, partial (file " +
+                      "contents fetched when checked out) or shallow " +
+                      "(only the history between good and bad)",
+                      dest="clone_mode", type="choice", choices=clone_modes,
+                      default="full")
+    parser.add_option("--mirror-cache", help="Keep a mirror of each " +
+                      "remote repository in this directory, updated before " +
+                      "cloning, and make new clones borrow from it.  The " +
+                      "directory can be shared by several bisections",
+                      dest="mirror_cache", default=None)
+    parser.add_option("--sparse", help="Only check out this path, " +
+                      "starting with the repository's directory, like " +
+                      "gaia/apps/sms.  Can be given more than once, and " +
+                      "scripts can add their own.  Repositories without " +
+                      "any paths are checked out completely",
+                      dest="sparse", action="append", default=[])
+    parser.add_option("--include-path", help="Only bisect the revisions " +
+                      "of a repository that change this path, which " +
+                      "starts with the repository's directory and can use " +
+                      "wildcards.  Can be given more than once",
+                      dest="include_paths", action="append", default=[])
+    parser.add_option("--exclude-path", help="Leave out the revisions " +
+                      "that only change paths like this one.  Can be " +
+                      "given more than once", dest="exclude_paths",
+                      action="append", default=[])
+    parser.add_option("--pushlog", help="NAME=FILE, a pushlog saved " +
+                      "from json-pushes for repository NAME.  Only the " +
+                      "last revision of each push is bisected.  Can be " +
+                      "given once per repository", dest="pushlogs",
+                      action="append", default=[])
+    parser.add_option("--merge-pushes", help="Treat the commits landed " +
+                      "with each merge as a push in repositories without " +
+                      "a --pushlog", dest="merge_pushes",
+                      action="store_true")
+    parser.add_option("--refine", help="Once a push has been found, " +
+                      "bisect the revisions inside it", dest="refine",
+                      action="store_true")
+    parser.add_option("--no-commit-index", help="Don't use or update the " +
+                      "per-repository commit index when building history",
+                      dest="use_index", action="store_false", default=True)
+    parser.add_option("--results", help="Record test outcomes in this " +
+                      "file and reuse the ones already in it.  Use a " +
+                      "different file for each test", dest="results",
+                      default=None)
+    parser.add_option("-j", "--jobs", help="Test this many revision sets " +
+                      "at once, each in its own copy of the repositories",
+                      dest="jobs", type="int", default=1)
+    parser.add_option("--workspaces", help="Where to put the copies of " +
+                      "the repositories used with --jobs",
+                      dest="workspaces", default="bisect-workspaces")
+    parser.add_option("--prefetch", help="Check out both of the next " +
+                      "possible revision sets in workspaces while the " +
+                      "script runs", dest="prefetch", action="store_true")
+    parser.add_option("--pool-budget", help="Megabytes of working " +
+                      "directories to keep per repository for --jobs.  " +
+                      "The least recently used ones are removed first",
+                      dest="pool_budget", type="int", default=None)
     opts, args = parser.parse_args()
 
     # Set up logging
@@ -196,16 +391,92 @@ def main():
         log.setLevel(logging.INFO)
         file_handler.setLevel(logging.INFO)
 
-    if opts.script and opts.interactive:
-        log.error("You can't specify a script *and* interactive mode")
+    if len([x for x in (opts.script, opts.python, opts.harness,
+                        opts.interactive, opts.listen) if x]) > 1:
+        log.error("Only one of a script, a Python function, a harness, "
+                  "interactive mode or --listen can be used")
+        parser.print_help()
+        parser.exit(2)
+    elif opts.worker and not (opts.script or opts.python or opts.harness):
+        log.error("A worker needs a script, a Python function or a harness")
+        parser.print_help()
+        parser.exit(2)
+    elif not (opts.script or opts.harness) and opts.prefetch:
+        log.error("Only a script or a harness can be used with --prefetch")
+        parser.print_help()
+        parser.exit(2)
+    elif not (opts.script or opts.python or opts.harness or
+              opts.listen) and opts.jobs > 1:
+        log.error("Only a script, a Python function, a harness or --listen "
+                  "can be used with --jobs")
         parser.print_help()
         parser.exit(2)
-    elif opts.script:
-        evaluator = ScriptEvaluator(opts.script)
+    elif opts.artifact_cache and not (opts.script or opts.harness):
+        log.error("Only a script or a harness can use --artifact-cache")
+        parser.print_help()
+        parser.exit(2)
+    elif opts.builds and not (opts.script or opts.harness or opts.listen):
+        log.error("Only a script, a harness or --listen can use --builds")
+        parser.print_help()
+        parser.exit(2)
+
+    builds = None
+    if opts.builds:
+        try:
+            builds = BuildIndex(opts.builds)
+        except BuildIndexError as e:
+            log.error(e)
+            parser.exit(1)
+    timeout_outcome = {'skip': None, 'good': True,
+                       'bad': False}[opts.on_timeout]
+    artifacts = None
+    if opts.artifact_cache:
+        budget = None
+        if opts.artifact_budget is not None:
+            budget = opts.artifact_budget * 1024 * 1024
+        artifacts = ArtifactCache(opts.artifact_cache, opts.artifact_config,
+                                  budget)
+    if opts.script:
+        evaluator = ScriptEvaluator(opts.script, timeout=opts.timeout,
+                                    idle_timeout=opts.idle_timeout,
+                                    log_path=opts.script_log,
+                                    artifacts=artifacts, builds=builds,
+                                    timeout_outcome=timeout_outcome)
+    elif opts.harness:
+        evaluator = HarnessEvaluator(shlex.split(opts.harness),
+                                     timeout=opts.timeout,
+                                     log_path=opts.script_log,
+                                     artifacts=artifacts, builds=builds,
+                                     timeout_outcome=timeout_outcome)
+    elif opts.python:
+        try:
+            evaluator = PythonEvaluator(load_function(opts.python))
+        except EvaluatorError as e:
+            log.error(e)
+            parser.exit(2)
+    elif opts.listen:
+        # Made once the projects are set up
+        evaluator = None
     else:
         evaluator = InteractiveEvaluator()
 
-    projects = []
+    mirror_cache = None
+    if opts.mirror_cache:
+        mirror_cache = MirrorCache(opts.mirror_cache)
+    if opts.worker:
+        worker = Worker(opts.worker, evaluator, opts.workspaces,
+                        lambda x: setup_projects(
+                            x, opts.setup_jobs, use_index=opts.use_index,
+                            clone_mode=opts.clone_mode,
+                            mirror_cache=mirror_cache))
+        try:
+            worker.run()
+        except RemoteError as e:
+            log.error(e)
+            parser.exit(1)
+        finally:
+            evaluator.close()
+        return
 
     if len(args) < 2:
         log.error("You must specify at least two repositories")
@@ -215,24 +486,110 @@ def main():
     if opts.prof_out:
         pr = cProfile.Profile()
         pr.enable()
+    repo_datas = []
     for arg in args:
         try:
-            repo_data = parse_arg(arg)
+            repo_datas.append(parse_arg(arg))
         except InvalidArg as ia:
             log.error(ia)
             parser.print_help()
             parser.exit(2)
 
-        projects.append(Project(
-            name=repo_data['name'],
-            url=repo_data['uri'],
-            local_path=repo_data['local_path'],
-            good=repo_data['good'],
-            bad=repo_data['bad'],
-            vcs=repo_data['vcs'],
-        ))
-    combined_history = build_history(projects)
-    bisection = Bisection(projects, combined_history, evaluator)
+    try:
+        projects = setup_projects(repo_datas, opts.setup_jobs,
+                                  use_index=opts.use_index,
+                                  clone_mode=opts.clone_mode,
+                                  mirror_cache=mirror_cache)
+    except ProjectSetupError as e:
+        log.error(e)
+        parser.exit(1)
+    paths = list(opts.sparse)
+    if evaluator is not None:
+        paths += evaluator.sparse_paths() or []
+    patterns = sparse_patterns(projects, paths)
+    for project in projects:
+        project.set_sparse(patterns.get(project.name))
+    include = sparse_patterns(projects, opts.include_paths)
+    exclude = sparse_patterns(projects, opts.exclude_paths)
+    for project in projects:
+        project.set_path_filter(include.get(project.name),
+                                exclude.get(project.name))
+    pushlogs = {}
+    for arg in opts.pushlogs:
+        name, sep, path = arg.partition('=')
+        if not sep or name not in [x.name for x in projects]:
+            log.error("--pushlog %s isn't NAME=FILE for a repository", arg)
+            parser.exit(2)
+        try:
+            pushlogs[name] = load_pushlog(path)
+        except PushlogError as e:
+            log.error(e)
+            parser.exit(1)
+    for project in projects:
+        if project.name in pushlogs:
+            project.set_pushes(pushlogs[project.name])
+        elif opts.merge_pushes:
+            project.set_pushes('merges')
+    if opts.listen:
+        try:
+            evaluator = Coordinator(opts.listen, projects,
+                                    log_path=opts.script_log)
+        except (RemoteError, socket.error) as e:
+            log.error("Could not listen on %s: %s", opts.listen, e)
+            parser.exit(1)
+        # Only to tell which lines have builds, the workers use their own
+        evaluator.builds = builds
+    if builds is not None:
+        builds.resolve(projects)
+    combined_history = build_compact_history(projects, opts.history_file)
+    store = ResultStore(opts.results) if opts.results else None
+    runner = prefetcher = pools = None
+    if evaluator.needs_checkout and (opts.jobs > 1 or opts.prefetch):
+        budget = None
+        if opts.pool_budget is not None:
+            budget = opts.pool_budget * 1024 * 1024
+        pools = make_pools(projects, budget)
+    if opts.jobs > 1:
+        runner = make_runner(evaluator, projects, opts.workspaces, opts.jobs,
+                             pools)
+    elif opts.prefetch:
+        prefetcher = make_prefetcher(projects, opts.workspaces, pools)
+    history = combined_history
+    # Where the history of the last bisection starts in the whole history
+    offset = 0
+    if builds is not None:
+        indices = prebuilt_lines(history, builds.has)
+        if len(indices) > 1:
+            log.info("Bisecting the %d revision sets with builds first",
+                     len(indices) - 1)
+            # The first line has no build, and it's good anyway
+            bisection = Bisection(projects, [history[i] for i in indices],
+                                  evaluator, store, runner, prefetcher,
+                                  first_good=True)
+            offset, history = build_gap(history, indices, bisection.found_i)
+            log.info("Bisecting the %d revision sets between builds",
+                     len(history) - 1)
+        else:
+            log.warning("None of the revision sets have a build")
+    bisection = Bisection(projects, history, evaluator, store,
+                          runner, prefetcher)
+    total = len(combined_history)
+    refined = None
+    if opts.refine:
+        refined = refine_history(history, bisection.found_i)
+    if refined is not None:
+        log.info("Bisecting the %d revisions in the push that was found",
+                 len(refined) - 1)
+        bisection = Bisection(projects, refined, evaluator, store,
+                              runner, prefetcher)
+        offset, total = 0, len(refined)
+    for x in (runner, prefetcher):
+        if x is not None:
+            x.close()
+    evaluator.close()
+    if pools is not None:
+        for pool in pools.values():
+            pool.close()
     bisection.write(opts.output_html)
     if opts.prof_out:
         pr.disable()
@@ -246,7 +603,7 @@ def main():
                    for rev in bisection.found])
     log.info(
         "This was revision pair %d of %d total revision pairs" %
-        (combined_history.index(bisection.found) + 1, len(combined_history))
+        (offset + bisection.found_i + 1, total)
     )
 
 
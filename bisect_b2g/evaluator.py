@@ -1,10 +1,18 @@
 import os
 import sys
+import imp
+import json
+import time
+import errno
+import select
 import logging
 import tempfile
+import importlib
+import threading
 import subprocess
 
-from bisect_b2g.util import run_cmd
+from bisect_b2g.util import run_process, generate_env, kill_group
+from bisect_b2g.workspace import layout_path
 
 
 GOOD = 69
@@ -12,6 +20,9 @@ BAD = 96
 
 log = logging.getLogger(__name__)
 
+# How a line that timed out is counted, for the log
+timeout_names = {None: 'skipped', True: 'passing', False: 'failing'}
+
 
 class EvaluatorError(Exception):
     pass
@@ -19,24 +30,418 @@ class EvaluatorError(Exception):
 
 class Evaluator(object):
 
+    # Whether the projects have to be moved to a line before evaluating it
+    needs_checkout = True
+    # An ArtifactCache for evaluators that build things worth keeping
+    artifacts = None
+    # A BuildIndex of builds that were made some other way
+    builds = None
+
     def __init__(self):
         object.__init__(self)
 
     def eval(self, history_line):
         assert 0, "Unimplemented"
 
+    def eval_in(self, history_line, workdir):
+        """
+        Evaluate a history line that is checked out under workdir instead
+        of in the projects' own directories.  Evaluators that can't do that
+        should not be used with more than one job
+        """
+        return self.eval(history_line)
+
+    def close(self):
+        """Stop anything that was kept running between evaluations"""
+        pass
+
+    def is_cached(self, history_line):
+        """Whether there's a build or saved artifact for history_line"""
+        if self.builds is not None and self.builds.has(history_line):
+            return True
+        return self.artifacts is not None and \
+            self.artifacts.has(history_line)
+
+    def _open_artifacts(self, history_line):
+        """
+        The build or saved artifact for history_line, or None, and a
+        directory to save a new one in, or None if there's no need or no
+        ArtifactCache
+        """
+        if self.builds is not None:
+            build = self.builds.lookup(history_line)
+            if build is not None:
+                log.info("Using the build at %s", build)
+                return build, None
+        if self.artifacts is None:
+            return None, None
+        return self.artifacts.lookup(history_line), self.artifacts.staging()
+
+    def _close_artifacts(self, history_line, hit, staging, keep=True):
+        # Only artifacts from the cache come with somewhere to save
+        if hit is not None and staging is not None:
+            self.artifacts.release(history_line)
+        if staging is not None:
+            if keep:
+                self.artifacts.publish(history_line, staging)
+            else:
+                self.artifacts.discard(staging)
+
+    def sparse_paths(self):
+        """
+        The paths, relative to where the projects are checked out, that
+        evaluating needs.  None means it could need any of them
+        """
+        return None
+
 
 class ScriptEvaluator(Evaluator):
+    """
+    Runs a script, which passes by exiting with 0.  Scripts can say which
+    paths they need with lines like '# bisect_b2g-path: gaia/apps/*'.
 
-    def __init__(self, script):
+    A script that runs for more than timeout seconds, or prints nothing for
+    idle_timeout seconds, is killed along with everything it started and
+    its outcome is timeout_outcome, which skips the line by default.  Its
+    output is only kept in log_path, if given, and
+    passed a line at a time to line_callback if that is set.
+
+    With an ArtifactCache, $BISECT_ARTIFACT_HIT is the directory of what a
+    script saved for the same revisions before, if there is one, and
+    anything it puts in $BISECT_ARTIFACT_SAVE is saved for next time.  With
+    a BuildIndex, $BISECT_ARTIFACT_HIT is the build of the revisions, when
+    there is one, and there's nothing to save
+    """
+
+    path_marker = 'bisect_b2g-path:'
+
+    def __init__(self, script, timeout=None, idle_timeout=None,
+                 log_path=None, artifacts=None, builds=None,
+                 timeout_outcome=None):
         Evaluator.__init__(self)
         self.script = script
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.timeout_outcome = timeout_outcome
+        self.log_path = log_path
+        self.artifacts = artifacts
+        self.builds = builds
+        self.log_lock = threading.Lock()
+        self.line_callback = None
+
+    def sparse_paths(self):
+        script = self.script
+        if not isinstance(script, basestring):
+            script = script[0]
+        if not os.path.isfile(script):
+            return None
+        paths = []
+        with open(script) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#') and self.path_marker in line:
+                    paths.append(line.split(self.path_marker, 1)[1].strip())
+        return paths or None
+
+    def _run(self, command, history_line, workdir=None):
+        log_file = None
+        callbacks = []
+        if self.log_path is not None:
+            log_file = open(self.log_path, 'a')
+            prefix = '[%s] ' % workdir if workdir else ''
+
+            def write_line(line):
+                # Jobs share the log, so whole lines are written at once
+                with self.log_lock:
+                    log_file.write(prefix + line + '\n')
+                    log_file.flush()
+            callbacks.append(write_line)
+        if self.line_callback is not None:
+            callbacks.append(self.line_callback)
+        line_callback = None
+        if callbacks:
+            def line_callback(line):
+                for callback in callbacks:
+                    callback(line)
+            line_callback("Running %s" % (command,))
+        hit, staging = self._open_artifacts(history_line)
+        env = {}
+        if hit is not None:
+            env['BISECT_ARTIFACT_HIT'] = hit
+        if staging is not None:
+            env['BISECT_ARTIFACT_SAVE'] = staging
+        result = None
+        try:
+            result = run_process(command, workdir=workdir, inc_err=True,
+                                 env=env, timeout=self.timeout,
+                                 idle_timeout=self.idle_timeout,
+                                 line_callback=line_callback,
+                                 keep_output=64 * 1024)
+        finally:
+            if log_file is not None:
+                log_file.close()
+            # Whatever a script that was killed left behind can't be trusted
+            self._close_artifacts(history_line, hit, staging,
+                                  result is not None and not result.timed_out)
+        log.info("Script took %s", result.describe_usage())
+        if result.timed_out:
+            log.warning("Script timed out, counting it as %s",
+                        timeout_names[self.timeout_outcome])
+            return self.timeout_outcome
+        log.debug("Script evaluator returned %d", result.exit_code)
+        return result.exit_code == 0
 
     def eval(self, history_line):
         log.debug("Running script evaluator with %s", self.script)
-        code, output = run_cmd(command=self.script, rc_only=True)
-        log.debug("Script evaluator returned %d", code)
-        return code == 0
+        return self._run(self.script, history_line)
+
+    def eval_in(self, history_line, workdir):
+        # A relative script path means relative to where we were started
+        if isinstance(self.script, basestring):
+            command = [self.script]
+        else:
+            command = list(self.script)
+        if os.path.exists(command[0]):
+            command[0] = os.path.abspath(command[0])
+        log.debug("Running script evaluator with %s in %s", command, workdir)
+        return self._run(command, history_line, workdir)
+
+
+class HarnessError(EvaluatorError):
+    pass
+
+
+class HarnessTimeout(HarnessError):
+    pass
+
+
+class Harness(object):
+    """
+    One running copy of a harness command.  Each question is a line of JSON
+    written to its stdin, and the answer is the first line it prints that
+    is a JSON object with a 'verdict'.  Anything else it prints is logged
+    """
+
+    def __init__(self, command, workdir=None, log_path=None):
+        object.__init__(self)
+        self.command = command
+        self.workdir = workdir
+        self.log_path = log_path
+        self.proc = None
+        self.buf = ''
+        # How many verdicts it has given, over all restarts
+        self.answered = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        log.info("Starting harness %s", self.command)
+        stderr = None
+        if self.log_path is not None:
+            stderr = open(self.log_path, 'a')
+        try:
+            # Its own process group, so that it can be killed with
+            # everything it started
+            self.proc = subprocess.Popen(
+                self.command, cwd=self.workdir, env=generate_env({}),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=stderr, preexec_fn=os.setsid)
+        except OSError as e:
+            raise HarnessError("Could not start harness %s: %s" %
+                               (self.command, e))
+        finally:
+            if stderr is not None:
+                stderr.close()
+        self.buf = ''
+
+    def close(self, grace=5):
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            deadline = time.time() + grace
+            while proc.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            # Whatever it started may still be around even if it's gone
+            kill_group(proc, grace=0 if proc.returncode is not None else 5)
+            proc.wait()
+
+    def _readline(self, deadline):
+        """The next line of output, or None if the harness has gone"""
+        fd = self.proc.stdout.fileno()
+        while '\n' not in self.buf:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise HarnessTimeout()
+            try:
+                ready = select.select([fd], [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                return None
+            self.buf += data
+        line, self.buf = self.buf.split('\n', 1)
+        return line
+
+    def ask(self, message, timeout=None):
+        """
+        Send message and return the verdict, or None if the harness went
+        away before giving one.  Raises HarnessTimeout
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if self.proc is None:
+            self.start()
+        try:
+            self.proc.stdin.write(json.dumps(message) + '\n')
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            log.debug("Could not write to the harness: %s", e)
+            return None
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                return None
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                reply = None
+            if isinstance(reply, dict) and 'verdict' in reply:
+                self.answered += 1
+                return reply
+            log.debug("harness: %s", line)
+
+
+class HarnessEvaluator(Evaluator):
+    """
+    Keeps a harness running and sends it each line of history, so that
+    whatever it sets up once, like an emulator or a device connection,
+    survives between tests.  The message looks like
+
+      {"workdir": "/abs/path", "revisions": [{"project": "gaia",
+       "hash": "...", "date": "2013-05-01T12:00:00", "path": "/abs/gaia"}]}
+
+    and the harness answers with {"verdict": "pass"}, "fail" or "skip" on
+    a line of its own.  A harness that exits without a verdict is started
+    again and gets the line once more, after which the line counts as
+    failing.  One that takes more than timeout seconds is killed and
+    restarted for the next line, and the outcome is timeout_outcome, which
+    skips the line by default.  Each workspace gets its
+    own harness.  With an ArtifactCache or a BuildIndex, the message also
+    has the "artifact_hit" and "artifact_save" paths a script would get in
+    its environment
+    """
+
+    verdicts = {'pass': True, 'good': True, 'fail': False, 'bad': False,
+                'skip': None}
+
+    def __init__(self, command, timeout=None, log_path=None, retries=1,
+                 artifacts=None, builds=None, timeout_outcome=None):
+        Evaluator.__init__(self)
+        self.command = command
+        self.timeout = timeout
+        self.timeout_outcome = timeout_outcome
+        self.log_path = log_path
+        self.retries = retries
+        self.artifacts = artifacts
+        self.builds = builds
+        self.harnesses = {}
+        self.lock = threading.Lock()
+
+    def harness(self, workdir):
+        with self.lock:
+            if workdir not in self.harnesses:
+                command = self.command
+                if isinstance(command, basestring):
+                    command = [command]
+                # Files given relative to where we were started, like the
+                # harness itself, have to be found from a workspace too
+                command = [os.path.abspath(x) if os.path.isfile(x) else x
+                           for x in command]
+                self.harnesses[workdir] = Harness(command, workdir,
+                                                  self.log_path)
+            return self.harnesses[workdir]
+
+    def message(self, history_line, workdir):
+        revisions = []
+        for rev in history_line:
+            if workdir is None:
+                path = os.path.abspath(rev.prj.local_path)
+            else:
+                path = os.path.join(workdir, layout_path(rev.prj))
+            revisions.append({'project': rev.prj.name, 'hash': rev.hash,
+                              'date': rev.date.isoformat() if rev.date
+                              else None, 'path': path})
+        return {'workdir': workdir or os.getcwd(), 'revisions': revisions}
+
+    def _ask(self, harness, message):
+        """
+        The harness' reply, {'timed_out': True} if it took too long or None
+        if it kept exiting
+        """
+        with harness.lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    reply = harness.ask(message, self.timeout)
+                except HarnessTimeout:
+                    log.warning("Harness timed out, counting it as %s",
+                                timeout_names[self.timeout_outcome])
+                    harness.close(grace=0)
+                    return {'timed_out': True}
+                if reply is not None:
+                    return reply
+                log.warning("Harness exited without a verdict, restarting")
+                harness.close(grace=0)
+            if harness.answered == 0:
+                raise HarnessError("Harness %s keeps exiting without a "
+                                   "verdict" % (self.command,))
+            log.warning("Harness keeps exiting, counting it as failing")
+            return None
+
+    def _eval(self, history_line, workdir):
+        harness = self.harness(workdir)
+        message = self.message(history_line, workdir)
+        hit, staging = self._open_artifacts(history_line)
+        if hit is not None or staging is not None:
+            message['artifact_hit'] = hit
+            message['artifact_save'] = staging
+        reply = None
+        try:
+            reply = self._ask(harness, message)
+        finally:
+            self._close_artifacts(history_line, hit, staging,
+                                  reply is not None and 'verdict' in reply)
+        if reply is None:
+            return False
+        if reply.get('timed_out'):
+            return self.timeout_outcome
+        verdict = reply['verdict']
+        if verdict not in self.verdicts:
+            raise HarnessError("Harness gave an unknown verdict %r" %
+                               (verdict,))
+        log.debug("Harness evaluator returned %s", verdict)
+        return self.verdicts[verdict]
+
+    def eval(self, history_line):
+        return self._eval(history_line, None)
+
+    def eval_in(self, history_line, workdir):
+        return self._eval(history_line, os.path.abspath(workdir))
+
+    def close(self):
+        with self.lock:
+            harnesses, self.harnesses = self.harnesses.values(), {}
+        for harness in harnesses:
+            harness.close()
 
 
 class InteractiveEvaluator(Evaluator):
@@ -79,10 +484,9 @@ class InteractiveEvaluator(Evaluator):
         env['PS2'] = "> "
         env['IGNOREEOF'] = str(1024*4)
 
-        # We don't use run_cmd here because that function uses
-        # subprocess.Popen.communicate, which wait()s for the
-        # process before displaying output.  That doesn't work
-        # here because we're doing "smart" things here
+        # We don't use run_cmd here because that function reads the
+        # output itself and puts the command in its own process group,
+        # which would take the terminal away from the shell
         code = subprocess.call(
             [os.environ['SHELL'], "--rcfile", rcfile, "--noprofile"],
             env=env, stdout=sys.stdout, stderr=sys.stderr,
@@ -105,3 +509,79 @@ class InteractiveEvaluator(Evaluator):
                 "the interactive prompt")
         log.debug("Interactive evaluator returned %d", code)
         return rv
+
+
+class LineFiles(object):
+    """
+    Reads files as they are in a line of history, without checking it out.
+    Paths start with where the project is checked out, like they would for
+    a script
+    """
+
+    def __init__(self, history_line):
+        object.__init__(self)
+        self.history_line = history_line
+        self.revs = dict((x.prj.name, x) for x in history_line)
+
+    def find(self, path):
+        """The revision and the path inside its project that path is for"""
+        path = os.path.normpath(path)
+        for rev in self.history_line:
+            prefix = layout_path(rev.prj) + os.sep
+            if path.startswith(prefix):
+                return rev, path[len(prefix):]
+        raise EvaluatorError("%s isn't in any of the projects" % path)
+
+    def read(self, path):
+        """The contents of path, or None if it doesn't exist in this line"""
+        rev, path = self.find(path)
+        return rev.prj.repository.read_file(rev.hash, path)
+
+    def exists(self, path):
+        return self.read(path) is not None
+
+
+class PythonEvaluator(Evaluator):
+    """
+    Calls a Python function with a LineFiles for each line, which passes
+    if the function returns something true.  Nothing is checked out, so
+    this only suits questions that can be answered by reading files
+    """
+
+    needs_checkout = False
+
+    def __init__(self, function):
+        Evaluator.__init__(self)
+        self.function = function
+
+    def eval(self, history_line):
+        log.debug("Running %s", self.function.__name__)
+        outcome = bool(self.function(LineFiles(history_line)))
+        log.debug("%s returned %s", self.function.__name__, outcome)
+        return outcome
+
+    def eval_in(self, history_line, workdir):
+        return self.eval(history_line)
+
+
+def load_function(spec):
+    """
+    Find the function spec names, which is either 'package.module:function'
+    or 'path/to/file.py:function'
+    """
+    module_name, sep, name = spec.rpartition(':')
+    if not sep or not module_name or not name:
+        raise EvaluatorError("%s should look like module:function" % spec)
+    try:
+        if module_name.endswith('.py') or os.sep in module_name:
+            module = imp.load_source(
+                os.path.splitext(os.path.basename(module_name))[0],
+                module_name)
+        else:
+            module = importlib.import_module(module_name)
+    except (ImportError, IOError, SyntaxError) as e:
+        raise EvaluatorError("Could not load %s: %s" % (module_name, e))
+    function = getattr(module, name, None)
+    if not callable(function):
+        raise EvaluatorError("%s has no function %s" % (module_name, name))
+    return function
@@ -0,0 +1,82 @@
+import os
+import logging
+import threading
+import subprocess
+
+from bisect_b2g.util import generate_env
+
+log = logging.getLogger(__name__)
+
+
+class CatFileError(Exception):
+    """git cat-file could not be started or talked to"""
+    pass
+
+
+class CatFile(object):
+    """
+    A long running 'git cat-file --batch' for one repository, which reads
+    any number of objects without starting git for each of them.  If the
+    process goes away, it is restarted and the read is tried again
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        log.debug("Starting git cat-file for %s", self.path)
+        try:
+            self.proc = subprocess.Popen(
+                ['git', 'cat-file', '--batch'], cwd=self.path,
+                env=generate_env({}), stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        except OSError as e:
+            raise CatFileError("Could not start git: %s" % e)
+
+    def close(self):
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+                proc.wait()
+            except (IOError, OSError):
+                pass
+
+    def _read(self, name):
+        self.proc.stdin.write(name + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline()
+        if not header:
+            raise CatFileError("git cat-file for %s went away" % self.path)
+        fields = header.split()
+        if len(fields) != 3:
+            # '<name> missing' or '<name> ambiguous'
+            return None, None
+        sha, obj_type, size = fields
+        data = self.proc.stdout.read(int(size) + 1)
+        if len(data) != int(size) + 1:
+            raise CatFileError("git cat-file for %s went away" % self.path)
+        return obj_type, data[:-1]
+
+    def read(self, name):
+        """
+        Return (type, contents) of the object name refers to, which can be
+        anything git understands like 'HEAD:README', or (None, None) if
+        there's no such object
+        """
+        if '\n' in name:
+            raise CatFileError("Object names can't span lines: %r" % name)
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.proc is None:
+                        self.start()
+                    return self._read(name)
+                except (CatFileError, IOError, OSError) as e:
+                    log.debug("git cat-file for %s failed: %s", self.path, e)
+                    self.close()
+                    if attempt > 0:
+                        raise CatFileError(str(e))
@@ -0,0 +1,525 @@
+import os
+import mmap
+import zlib
+import glob
+import struct
+import logging
+import binascii
+
+from bisect_b2g.util import StoreError
+
+log = logging.getLogger(__name__)
+
+OBJ_COMMIT = 1
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+GRAPH_NO_PARENT = 0x70000000
+
+loose_types = {'commit': 1, 'tree': 2, 'blob': 3, 'tag': 4}
+
+
+class GitStoreError(StoreError):
+    pass
+
+
+def find_git_dir(path):
+    """Find the git dir for a work tree, following .git files"""
+    dot_git = os.path.join(path, '.git')
+    if os.path.isfile(dot_git):
+        with open(dot_git) as f:
+            contents = f.read().strip()
+        if not contents.startswith('gitdir: '):
+            raise GitStoreError("Unexpected .git file in %s" % path)
+        return os.path.normpath(os.path.join(path, contents[8:]))
+    elif os.path.isdir(dot_git):
+        return dot_git
+    elif os.path.exists(os.path.join(path, 'objects')):
+        return path
+    raise GitStoreError("%s is not a git repository" % path)
+
+
+def find_common_dir(git_dir):
+    """Worktrees share objects and refs with the main git dir"""
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.exists(commondir):
+        with open(commondir) as f:
+            return os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    return git_dir
+
+
+def _read_ref(git_dir, common_dir, ref):
+    for base in (git_dir, common_dir):
+        path = os.path.join(base, ref)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return f.read().strip()
+    packed = os.path.join(common_dir, 'packed-refs')
+    if os.path.exists(packed):
+        with open(packed) as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    return None
+
+
+def read_head(git_dir):
+    """
+    The commit HEAD points at, read from the files in the git dir, or None
+    if that can't be worked out without git, like with a reftable
+    """
+    common_dir = find_common_dir(git_dir)
+    if os.path.exists(os.path.join(common_dir, 'reftable')):
+        return None
+    value = _read_ref(git_dir, common_dir, 'HEAD')
+    # Symbolic refs can point at other symbolic refs
+    for depth in range(5):
+        if value is None or not value.startswith('ref: '):
+            break
+        value = _read_ref(git_dir, common_dir, value[5:].strip())
+    if value is not None and len(value) == 40:
+        try:
+            binascii.unhexlify(value)
+            return value.lower()
+        except TypeError:
+            pass
+    return None
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _inflate(data, pos):
+    d = zlib.decompressobj()
+    output = []
+    while True:
+        chunk = data[pos:pos + 8192]
+        pos += 8192
+        output.append(d.decompress(chunk))
+        if d.unused_data or len(chunk) == 0:
+            break
+    return ''.join(output)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        c = ord(data[pos])
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def apply_delta(base, delta):
+    src_size, pos = _read_varint(delta, 0)
+    dst_size, pos = _read_varint(delta, pos)
+    if src_size != len(base):
+        raise GitStoreError("Delta does not apply to its base object")
+    output = []
+    while pos < len(delta):
+        op = ord(delta[pos])
+        pos += 1
+        if op & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            output.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            output.append(delta[pos:pos + op])
+            pos += op
+        else:
+            raise GitStoreError("Invalid delta opcode")
+    result = ''.join(output)
+    if len(result) != dst_size:
+        raise GitStoreError("Delta produced an object of the wrong size")
+    return result
+
+
+def parse_commit(data):
+    """Return (first parent, committer epoch, offset east of UTC)"""
+    parent = committer = None
+    for line in data.split('\n\n', 1)[0].split('\n'):
+        if line.startswith('parent ') and parent is None:
+            parent = binascii.unhexlify(line[7:47])
+        elif line.startswith('committer '):
+            committer = line
+    if committer is None:
+        raise GitStoreError("Commit has no committer")
+    epoch, tz = committer.rsplit(' ', 2)[1:]
+    offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+    if tz[0] == '-':
+        offset = -offset
+    return parent, int(epoch), offset
+
+
+class Pack(object):
+    """A version 2 pack index and the pack it describes"""
+
+    def __init__(self, idx_path):
+        object.__init__(self)
+        self.idx = _map_file(idx_path)
+        if self.idx[:8] != '\377tOc\x00\x00\x00\x02':
+            raise GitStoreError("Unsupported pack index %s" % idx_path)
+        self.fanout = struct.unpack_from('>256I', self.idx, 8)
+        self.count = self.fanout[255]
+        self.names_at = 8 + 256 * 4
+        self.offsets_at = self.names_at + self.count * 24
+        self.large_at = self.offsets_at + self.count * 4
+        self.pack_path = idx_path[:-4] + '.pack'
+        self._pack = None
+
+    @property
+    def pack(self):
+        if self._pack is None:
+            self._pack = _map_file(self.pack_path)
+        return self._pack
+
+    def offset(self, sha):
+        first = ord(sha[0])
+        lo = self.fanout[first - 1] if first > 0 else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) / 2
+            at = self.names_at + mid * 20
+            name = self.idx[at:at + 20]
+            if name < sha:
+                lo = mid + 1
+            elif name > sha:
+                hi = mid
+            else:
+                offset, = struct.unpack_from(
+                    '>I', self.idx, self.offsets_at + mid * 4)
+                if offset & 0x80000000:
+                    offset, = struct.unpack_from(
+                        '>Q', self.idx,
+                        self.large_at + (offset & 0x7fffffff) * 8)
+                return offset
+        return None
+
+    def read(self, offset, store):
+        data = self.pack
+        c = ord(data[offset])
+        obj_type = (c >> 4) & 7
+        pos = offset + 1
+        while c & 0x80:
+            c = ord(data[pos])
+            pos += 1
+        if obj_type == OBJ_OFS_DELTA:
+            c = ord(data[pos])
+            pos += 1
+            base = c & 0x7f
+            while c & 0x80:
+                c = ord(data[pos])
+                pos += 1
+                base = ((base + 1) << 7) | (c & 0x7f)
+            base_type, base_data = self.read(offset - base, store)
+            return base_type, apply_delta(base_data, _inflate(data, pos))
+        elif obj_type == OBJ_REF_DELTA:
+            base_type, base_data = store.read(data[pos:pos + 20])
+            return base_type, apply_delta(base_data, _inflate(data, pos + 20))
+        return obj_type, _inflate(data, pos)
+
+
+class CommitGraph(object):
+    """
+    A single commit-graph file.  It knows the parents and commit time of
+    every commit it covers, but not the committer's timezone
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.data = data = _map_file(path)
+        if data[:4] != 'CGPH' or data[4:6] != '\x01\x01':
+            raise GitStoreError("Unsupported commit-graph %s" % path)
+        chunks = {}
+        for i in range(ord(data[6])):
+            chunk_id, at = struct.unpack_from('>4sQ', data, 8 + i * 12)
+            chunks[chunk_id] = at
+        try:
+            self.fanout = struct.unpack_from('>256I', data, chunks['OIDF'])
+            self.names_at = chunks['OIDL']
+            self.commits_at = chunks['CDAT']
+        except KeyError:
+            raise GitStoreError("commit-graph %s is missing chunks" % path)
+        self.count = self.fanout[255]
+
+    def position(self, sha):
+        first = ord(sha[0])
+        lo = self.fanout[first - 1] if first > 0 else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) / 2
+            at = self.names_at + mid * 20
+            name = self.data[at:at + 20]
+            if name < sha:
+                lo = mid + 1
+            elif name > sha:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def sha(self, position):
+        at = self.names_at + position * 20
+        return self.data[at:at + 20]
+
+    def entry(self, position):
+        """
+        Return (position of the first parent, commit epoch).  In a split
+        commit-graph, parent positions count the commits of every layer
+        """
+        parent, x, high, low = struct.unpack_from(
+            '>IIII', self.data, self.commits_at + position * 36 + 20)
+        return parent, ((high & 3) << 32) | low
+
+    def commit(self, position):
+        """Return (first parent, commit epoch) for a position"""
+        parent, epoch = self.entry(position)
+        if parent == GRAPH_NO_PARENT:
+            return None, epoch
+        return self.sha(parent), epoch
+
+
+class CommitGraphChain(object):
+    """
+    A split commit-graph, which is several commit-graph files, oldest
+    first, numbered as if they were one
+    """
+
+    def __init__(self, paths):
+        object.__init__(self)
+        self.layers = []
+        base = 0
+        for path in paths:
+            layer = CommitGraph(path)
+            self.layers.append((base, layer))
+            base += layer.count
+
+    def _layer(self, position):
+        for base, layer in self.layers:
+            if position < base + layer.count:
+                return base, layer
+        raise GitStoreError("No commit %d in the commit-graph" % position)
+
+    def position(self, sha):
+        for base, layer in self.layers:
+            position = layer.position(sha)
+            if position is not None:
+                return base + position
+        return None
+
+    def sha(self, position):
+        base, layer = self._layer(position)
+        return layer.sha(position - base)
+
+    def commit(self, position):
+        base, layer = self._layer(position)
+        parent, epoch = layer.entry(position - base)
+        if parent == GRAPH_NO_PARENT:
+            return None, epoch
+        return self.sha(parent), epoch
+
+
+def load_commit_graph(objects_dir):
+    """
+    The commit-graph of objects_dir, split or not, or None if there isn't
+    one we can use
+    """
+    info = os.path.join(objects_dir, 'info')
+    single = os.path.join(info, 'commit-graph')
+    chain = os.path.join(info, 'commit-graphs', 'commit-graph-chain')
+    try:
+        if os.path.exists(single):
+            return CommitGraph(single)
+        if os.path.exists(chain):
+            with open(chain) as f:
+                hashes = [x.strip() for x in f if x.strip()]
+            return CommitGraphChain(
+                [os.path.join(info, 'commit-graphs', 'graph-%s.graph' % x)
+                 for x in hashes])
+    except (GitStoreError, IOError, OSError) as e:
+        log.info("Not using the commit-graph in %s: %s", objects_dir, e)
+    return None
+
+
+class OffsetCache(object):
+    """
+    The committer's offset from UTC for commits we've read, which is the
+    one thing a commit-graph doesn't know.  They never change, so they're
+    kept in a file of fixed size records that's only ever appended to
+    """
+
+    record = struct.Struct('>20si')
+
+    def __init__(self, path=None):
+        object.__init__(self)
+        self.path = path
+        self.offsets = {}
+        self.new = []
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            # A record cut short by another process is ignored
+            size = self.record.size
+            for at in range(0, len(data) - size + 1, size):
+                sha, offset = self.record.unpack_from(data, at)
+                self.offsets[sha] = offset
+
+    def get(self, sha):
+        return self.offsets.get(sha)
+
+    def add(self, sha, offset):
+        if sha not in self.offsets:
+            self.offsets[sha] = offset
+            self.new.append(self.record.pack(sha, offset))
+
+    def save(self):
+        if self.path is None or not self.new:
+            return
+        try:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.path, 'ab') as f:
+                f.write(''.join(self.new))
+            self.new = []
+        except (IOError, OSError) as e:
+            log.warning("Could not save commit offsets to %s: %s",
+                        self.path, e)
+
+
+def find_object_dirs(objects_dir, seen=None):
+    """The objects directory and those it borrows from via alternates"""
+    seen = seen if seen is not None else []
+    objects_dir = os.path.normpath(objects_dir)
+    if objects_dir in seen or not os.path.isdir(objects_dir):
+        return seen
+    seen.append(objects_dir)
+    alternates = os.path.join(objects_dir, 'info', 'alternates')
+    if os.path.exists(alternates):
+        with open(alternates) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    find_object_dirs(os.path.join(objects_dir, line), seen)
+    return seen
+
+
+class GitObjectStore(object):
+    """
+    Read-only access to the loose and packed objects of a repository,
+    enough to walk first parents without running git.  Offsets read from
+    commits are kept in offsets_path, if given, so that later walks can
+    stick to the commit-graph
+    """
+
+    def __init__(self, git_dir, offsets_path=None):
+        object.__init__(self)
+        self.git_dir = git_dir
+        self.common_dir = find_common_dir(git_dir)
+        self.objects_dir = os.path.join(self.common_dir, 'objects')
+        if not os.path.isdir(self.objects_dir):
+            raise GitStoreError("No objects in %s" % git_dir)
+        self.object_dirs = find_object_dirs(self.objects_dir)
+        self.packs = []
+        self._scan_packs()
+        self.graph = load_commit_graph(self.objects_dir)
+        self.offsets = OffsetCache(offsets_path)
+        # The parents of the commits a shallow clone was cut off at are
+        # missing, so they're treated as root commits
+        self.shallow = set()
+        shallow = os.path.join(self.common_dir, 'shallow')
+        if os.path.exists(shallow):
+            with open(shallow) as f:
+                self.shallow = set(binascii.unhexlify(x.strip())
+                                   for x in f if x.strip())
+
+    def _scan_packs(self):
+        known = set(x.pack_path for x in self.packs)
+        for objects_dir in self.object_dirs:
+            for idx in sorted(glob.glob(
+                    os.path.join(objects_dir, 'pack', '*.idx'))):
+                if idx[:-4] + '.pack' not in known:
+                    self.packs.append(Pack(idx))
+
+    def read(self, sha):
+        """Return (type number, data) for a binary sha"""
+        hex_sha = binascii.hexlify(sha)
+        for objects_dir in self.object_dirs:
+            loose = os.path.join(objects_dir, hex_sha[:2], hex_sha[2:])
+            if os.path.exists(loose):
+                with open(loose, 'rb') as f:
+                    raw = zlib.decompress(f.read())
+                header, x, data = raw.partition('\0')
+                return loose_types[header.split(' ')[0]], data
+        for attempt in range(2):
+            for pack in self.packs:
+                offset = pack.offset(sha)
+                if offset is not None:
+                    return pack.read(offset, self)
+            # A gc or fetch might have made new packs since we looked
+            self._scan_packs()
+        raise GitStoreError("Object %s not found" % hex_sha)
+
+    def read_commit(self, sha):
+        obj_type, data = self.read(sha)
+        if obj_type != OBJ_COMMIT:
+            raise GitStoreError("%s is not a commit" % binascii.hexlify(sha))
+        return parse_commit(data)
+
+    def first_parent_walk(self, end, start=None, tz=True):
+        """
+        Yield (hash, committer epoch, offset east of UTC) for each commit
+        from end back to start following only first parents, newest first.
+        Without start, walk to the root commit.  The commit-graph doesn't
+        store timezones, so a commit object is read for any offset that
+        isn't cached yet, unless tz is False, in which case offsets are
+        reported as 0
+        """
+        try:
+            for rev in self._walk(end, start, tz):
+                yield rev
+        finally:
+            self.offsets.save()
+
+    def _walk(self, end, start, tz):
+        sha = binascii.unhexlify(end)
+        while True:
+            position = None
+            if self.graph is not None:
+                position = self.graph.position(sha)
+            if position is not None:
+                parent, epoch = self.graph.commit(position)
+                offset = self.offsets.get(sha) if tz else 0
+                if offset is None:
+                    offset = self.read_commit(sha)[2]
+                    self.offsets.add(sha, offset)
+            else:
+                parent, epoch, offset = self.read_commit(sha)
+                self.offsets.add(sha, offset)
+            hex_sha = binascii.hexlify(sha)
+            yield hex_sha, epoch, offset
+            if hex_sha == start:
+                return
+            if sha in self.shallow:
+                parent = None
+            if parent is None:
+                if start is None:
+                    return
+                raise GitStoreError("%s is not a first parent ancestor of %s"
+                                    % (start, end))
+            sha = parent
@@ -0,0 +1,124 @@
+import os
+import struct
+import logging
+import threading
+import subprocess
+
+from bisect_b2g.util import generate_env
+
+log = logging.getLogger(__name__)
+
+
+class CommandServerError(Exception):
+    """The command server could not be started or talked to"""
+    pass
+
+
+class HgCommandError(Exception):
+
+    def __init__(self, msg, exit_code=None):
+        Exception.__init__(self, msg)
+        self.exit_code = exit_code
+
+
+class CommandServer(object):
+    """
+    A long running 'hg serve --cmdserver pipe' for one repository.  Running
+    commands through it saves starting up Mercurial for every command.  If
+    the server goes away, it is restarted and the command is tried again
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        log.debug("Starting hg command server for %s", self.path)
+        env = generate_env({'HGPLAIN': '1', 'HGENCODING': 'UTF-8'})
+        try:
+            self.proc = subprocess.Popen(
+                ['hg', 'serve', '--cmdserver', 'pipe', '-R', self.path,
+                 '--config', 'ui.interactive=False'],
+                cwd=self.path, env=env, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        except OSError as e:
+            raise CommandServerError("Could not start hg: %s" % e)
+        channel, hello = self._read_channel()
+        if channel != 'o' or 'runcommand' not in hello:
+            self.close()
+            raise CommandServerError(
+                "hg command server for %s doesn't support runcommand" %
+                self.path)
+
+    def close(self):
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            try:
+                proc.stdin.close()
+                proc.wait()
+            except (IOError, OSError):
+                pass
+
+    def _read_channel(self):
+        header = self.proc.stdout.read(5)
+        if len(header) < 5:
+            raise CommandServerError("hg command server for %s went away" %
+                                     self.path)
+        channel, length = struct.unpack('>cI', header)
+        if channel.isupper():
+            # Input requests only carry the size they want
+            return channel, length
+        return channel, self.proc.stdout.read(length)
+
+    def _runcommand(self, args):
+        data = '\0'.join(args)
+        self.proc.stdin.write('runcommand\n' + struct.pack('>I', len(data)) +
+                              data)
+        self.proc.stdin.flush()
+        output = []
+        error = []
+        while True:
+            channel, data = self._read_channel()
+            if channel == 'o':
+                output.append(data)
+            elif channel == 'e':
+                error.append(data)
+            elif channel == 'r':
+                return struct.unpack('>i', data)[0], \
+                    ''.join(output), ''.join(error)
+            elif channel in ('I', 'L'):
+                # Nothing should ever want input, so give it an EOF
+                self.proc.stdin.write(struct.pack('>I', 0))
+                self.proc.stdin.flush()
+            elif channel.isupper():
+                raise CommandServerError("Unknown required channel %s" %
+                                         channel)
+
+    def runcommand(self, *args):
+        """Return the exit code, stdout and stderr of an hg command"""
+        args = [x.encode('utf-8') if isinstance(x, unicode) else str(x)
+                for x in args]
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.proc is None:
+                        self.start()
+                    return self._runcommand(args)
+                except (CommandServerError, IOError, OSError) as e:
+                    log.debug("hg command server for %s failed: %s",
+                              self.path, e)
+                    self.close()
+                    if attempt > 0:
+                        raise CommandServerError(str(e))
+
+    def command(self, *args):
+        """Run an hg command, raising HgCommandError if it fails"""
+        code, output, error = self.runcommand(*args)
+        if code != 0:
+            raise HgCommandError(
+                "Error running hg %s in %s:\n\tErr: %s\n\tOut: %s\n\tExit: %d"
+                % (" ".join(args), self.path, error, output, code),
+                exit_code=code)
+        return output.decode('utf-8')
@@ -0,0 +1,212 @@
+import os
+import mmap
+import zlib
+import struct
+import logging
+import binascii
+
+from bisect_b2g.util import StoreError
+
+log = logging.getLogger(__name__)
+
+FLAG_INLINE_DATA = 1 << 16
+FLAG_GENERALDELTA = 1 << 17
+
+index_entry = struct.Struct('>Qiiiiii20s12x')
+
+unsupported_requirements = ('revlogv2', 'changelogv2', 'exp-revlogv2.2')
+
+
+class HgStoreError(StoreError):
+    pass
+
+
+def find_store(path):
+    """Find the store directory of a Mercurial working copy"""
+    dot_hg = os.path.join(path, '.hg')
+    if not os.path.isdir(dot_hg):
+        raise HgStoreError("%s is not a Mercurial repository" % path)
+    requires = []
+    if os.path.exists(os.path.join(dot_hg, 'requires')):
+        with open(os.path.join(dot_hg, 'requires')) as f:
+            requires = f.read().split()
+    for requirement in unsupported_requirements:
+        if requirement in requires:
+            raise HgStoreError("%s needs %s" % (path, requirement))
+    # 'hg share' working copies point at the .hg of the shared repository
+    sharedpath = os.path.join(dot_hg, 'sharedpath')
+    if os.path.exists(sharedpath):
+        with open(sharedpath) as f:
+            dot_hg = os.path.join(dot_hg, f.read().strip())
+    if 'store' in requires:
+        return os.path.join(dot_hg, 'store')
+    return dot_hg
+
+
+def read_dirstate_parent(path):
+    """
+    The first parent of a working copy, from the start of its dirstate, or
+    None if the dirstate is in a format we don't know
+    """
+    dot_hg = os.path.join(path, '.hg')
+    requires = os.path.join(dot_hg, 'requires')
+    if os.path.exists(requires):
+        with open(requires) as f:
+            if 'dirstate-v2' in f.read().split():
+                return None
+    dirstate = os.path.join(dot_hg, 'dirstate')
+    if not os.path.exists(dirstate):
+        # A working copy that was never updated is at the null revision
+        return '0' * 40
+    with open(dirstate, 'rb') as f:
+        parent = f.read(20)
+    if len(parent) != 20:
+        return None
+    return binascii.hexlify(parent)
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def apply_patch(text, patch):
+    """Apply a binary mpatch delta to text"""
+    output = []
+    last = pos = 0
+    while pos < len(patch):
+        start, end, length = struct.unpack_from('>lll', patch, pos)
+        pos += 12
+        output.append(text[last:start])
+        output.append(patch[pos:pos + length])
+        pos += length
+        last = end
+    output.append(text[last:])
+    return ''.join(output)
+
+
+class Revlog(object):
+    """
+    Read-only version 1 revlog, inline or with a separate data file.  Only
+    zlib and uncompressed chunks can be read
+    """
+
+    def __init__(self, index_path):
+        object.__init__(self)
+        self.index = _map_file(index_path)
+        if len(self.index) == 0:
+            self.entries = []
+            return
+        header, = struct.unpack_from('>I', self.index, 0)
+        if header & 0xffff != 1:
+            raise HgStoreError("Unsupported revlog version in %s" %
+                               index_path)
+        self.inline = bool(header & FLAG_INLINE_DATA)
+        self.generaldelta = bool(header & FLAG_GENERALDELTA)
+        if self.inline:
+            self.data = self.index
+        else:
+            self.data = _map_file(index_path[:-2] + '.d')
+
+        # Entries are (data offset, compressed length, base, p1, p2, node)
+        self.entries = []
+        pos = 0
+        while pos + index_entry.size <= len(self.index):
+            offset_flags, comp_len, x, base, x, p1, p2, node = \
+                index_entry.unpack_from(self.index, pos)
+            rev = len(self.entries)
+            if rev == 0:
+                offset_flags &= 0xffffffff
+            offset = offset_flags >> 16
+            if self.inline:
+                offset += (rev + 1) * index_entry.size
+                pos += index_entry.size + comp_len
+            else:
+                pos += index_entry.size
+            self.entries.append((offset, comp_len, base, p1, p2, node))
+        self._nodemap = None
+        self._cache = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rev(self, node):
+        if self._nodemap is None:
+            self._nodemap = dict((x[5], i) for i, x in
+                                 enumerate(self.entries))
+        try:
+            return self._nodemap[node]
+        except KeyError:
+            raise HgStoreError("Unknown node %s" % binascii.hexlify(node))
+
+    def node(self, rev):
+        return self.entries[rev][5]
+
+    def parents(self, rev):
+        return self.entries[rev][3:5]
+
+    def _chunk(self, rev):
+        offset, length = self.entries[rev][:2]
+        chunk = self.data[offset:offset + length]
+        if len(chunk) == 0 or chunk[0] == '\0':
+            return chunk
+        elif chunk[0] == 'x':
+            return zlib.decompress(chunk)
+        elif chunk[0] == 'u':
+            return chunk[1:]
+        raise HgStoreError("Unsupported revlog compression %r" % chunk[0])
+
+    def revision(self, rev):
+        chain = []
+        text = None
+        r = rev
+        while True:
+            if self._cache is not None and self._cache[0] == r:
+                text = self._cache[1]
+                break
+            chain.append(r)
+            base = self.entries[r][2]
+            if base == r:
+                break
+            r = base if self.generaldelta else r - 1
+        if text is None:
+            text = self._chunk(chain.pop())
+        for r in reversed(chain):
+            text = apply_patch(text, self._chunk(r))
+        self._cache = (rev, text)
+        return text
+
+
+def parse_changeset(text):
+    """Return (epoch, offset east of UTC) from a changelog entry"""
+    date_line = text.split('\n', 3)[2]
+    epoch, tz = date_line.split(' ')[:2]
+    return int(float(epoch)), -int(tz)
+
+
+class Changelog(Revlog):
+
+    def __init__(self, path):
+        Revlog.__init__(self, os.path.join(find_store(path), '00changelog.i'))
+
+    def first_parent_walk(self, end, start=None):
+        """
+        Yield (node, epoch, offset east of UTC) for each changeset from end
+        back to start following only first parents, newest first.  Without
+        start, walk to the root
+        """
+        rev = self.rev(binascii.unhexlify(end))
+        while True:
+            node = binascii.hexlify(self.node(rev))
+            epoch, offset = parse_changeset(self.revision(rev))
+            yield node, epoch, offset
+            if node == start:
+                return
+            rev = self.parents(rev)[0]
+            if rev == -1:
+                if start is None:
+                    return
+                raise HgStoreError("%s is not a first parent ancestor of %s"
+                                   % (start, end))
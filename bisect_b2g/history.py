@@ -1,5 +1,12 @@
+import array
+import binascii
+import heapq
 import logging
+import mmap
+import struct
+
 from bisect_b2g.repository import Rev
+from bisect_b2g.util import from_epoch, to_epoch
 
 log = logging.getLogger(__name__)
 
@@ -14,35 +21,258 @@ def make_revision_linked_list(project):
     return head
 
 
-def create_line(exhausted_heads, heads):
-    line = sorted(exhausted_heads + heads, key=lambda x: x.date)
-    oldest_head = line[0]
-    oldest_head_i = heads.index(oldest_head)
-    if oldest_head.next_rev is None:
-        log.debug("Exhausted %s", oldest_head.prj.name)
-        exhausted_heads.append(oldest_head)
-        del heads[oldest_head_i]
-    else:
-        log.debug("Moving %s to next revision", oldest_head.prj.name)
-        heads[oldest_head_i] = heads[oldest_head_i].next_rev
-    line.sort(key=lambda x: x.prj.name)
-    log.debug("Generated a line of history: %s", [x.tag() for x in line])
-    return sorted(line, key=lambda x: x.prj.name)
+def interleave(columns):
+    """
+    Merge the per-project date columns (oldest first) into a single history.
+
+    For each line of history, yield a list with one index per column that
+    points at the revision each project is at on that line.  The same list
+    object is updated and yielded each time, so copy it if you need to keep
+    it.  Between two lines only the project with the oldest current revision
+    moves forward, ties going to the first column.  The history ends on the
+    line where that oldest revision is the last one of its project
+    """
+    if len(columns) == 0 or not all(columns):
+        return
+
+    positions = [0] * len(columns)
+    heap = [(column[0], i) for i, column in enumerate(columns)]
+    heapq.heapify(heap)
+
+    while True:
+        yield positions
+        oldest_i = heap[0][1]
+        next_pos = positions[oldest_i] + 1
+        if next_pos == len(columns[oldest_i]):
+            return
+        positions[oldest_i] = next_pos
+        heapq.heapreplace(heap, (columns[oldest_i][next_pos], oldest_i))
+
+
+def iter_history(projects):
+    """Generate the lines of the combined history one at a time"""
+    revs = []
+    for project in projects:
+        head = make_revision_linked_list(project)
+        project_revs = []
+        while head is not None:
+            project_revs.append(head)
+            head = head.next_rev
+        revs.append(project_revs)
+
+    name_order = sorted(range(len(projects)), key=lambda i: projects[i].name)
+    debug = log.isEnabledFor(logging.DEBUG)
+
+    for positions in interleave([[x.date for x in y] for y in revs]):
+        line = [revs[i][positions[i]] for i in name_order]
+        if debug:
+            log.debug("Generated a line of history: %s",
+                      [x.tag() for x in line])
+        yield line
 
 
 def build_history(projects):
-    history = []
-    exhausted_heads = []
-    heads = [make_revision_linked_list(x) for x in projects]
+    history = list(iter_history(projects))
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Global History:")
+        for line in history:
+            log.debug(["%s@%s" % (x.prj.name, x.tag()) for x in line])
+    return history
+
+
+class HistoryColumn(object):
+    """
+    The revisions of one project, oldest first, stored as flat arrays.  Rev
+    objects are only created when a line that uses them is looked at
+    """
+
+    def __init__(self, project, rev_list):
+        object.__init__(self)
+        self.project = project
+        self.epochs = array.array('d')
+        self.offsets = array.array('i')
+        hashes = []
+        for hash, date in rev_list:
+            epoch, offset = to_epoch(date)
+            self.epochs.append(epoch)
+            self.offsets.append(offset)
+            hashes.append(hash)
+        # Hashes are packed into a single binary string when they're all
+        # hex of the same length, which is always the case for Git and Hg
+        self.hash_size = len(hashes[0]) / 2 if len(hashes) > 0 else 0
+        joined = ''.join(hashes)
+        try:
+            if any(len(x) != self.hash_size * 2 for x in hashes):
+                raise ValueError("Hashes have different lengths")
+            self.hashes = binascii.unhexlify(joined)
+            if binascii.hexlify(self.hashes) != joined:
+                raise ValueError("Hashes are not lower case hex")
+        except (TypeError, ValueError):
+            self.hash_size = None
+            self.hashes = hashes
+        self._revs = {}
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def hash(self, i):
+        size = self.hash_size
+        if size is None:
+            return self.hashes[i]
+        return binascii.hexlify(self.hashes[i * size:(i + 1) * size])
+
+    def rev(self, i):
+        if i not in self._revs:
+            self._revs[i] = Rev(self.hash(i), self.project,
+                                from_epoch(self.epochs[i], self.offsets[i]))
+        return self._revs[i]
+
 
-    while len(heads) > (len(heads) + len(exhausted_heads) - 1):
-        history.append(create_line(exhausted_heads, heads))
+class CompactHistory(object):
+    """
+    A combined history that stores one small integer per project per line
+    instead of a list of Revs.  Each row of the index matrix holds the
+    position in every project's HistoryColumn, in project name order.  The
+    matrix either lives in memory or in a file that gets mmap()ed.
 
-    log.debug("Global History:")
-    for line in history:
-        log.debug(["%s@%s" % (x.prj.name, x.tag()) for x in line])
+    Indexing gives back a line as a list of Revs, slicing gives back
+    another CompactHistory sharing the same storage
+    """
+
+    def __init__(self, columns, rows, start=0, stop=None):
+        object.__init__(self)
+        self.columns = columns
+        self.rows = rows
+        self.width = len(columns)
+        self._fmt = '=%di' % self.width
+        self._row_size = struct.calcsize(self._fmt)
+        if stop is None:
+            if isinstance(rows, array.array):
+                stop = len(rows) / self.width if self.width else 0
+            else:
+                stop = len(rows) / self._row_size
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def row(self, i):
+        i += self.start
+        if isinstance(self.rows, array.array):
+            return self.rows[i * self.width:(i + 1) * self.width]
+        return struct.unpack_from(self._fmt, self.rows, i * self._row_size)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[x] for x in range(start, stop, step)]
+            return CompactHistory(self.columns, self.rows,
+                                  self.start + start,
+                                  self.start + max(start, stop))
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("history index out of range")
+        return [c.rev(x) for c, x in zip(self.columns, self.row(key))]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def index(self, line):
+        wanted = sorted((x.prj.name, x.hash) for x in line)
+        for i in range(len(self)):
+            if wanted == [(c.project.name, c.hash(x))
+                          for c, x in zip(self.columns, self.row(i))]:
+                return i
+        raise ValueError("line is not in history")
+
+
+def build_compact_history(projects, path=None):
+    """
+    Build a CompactHistory with the same lines as build_history.  If path
+    is given, the index matrix is written to that file and mapped back in
+    """
+    name_order = sorted(range(len(projects)), key=lambda i: projects[i].name)
+    columns = [HistoryColumn(x, x.rev_list()) for x in projects]
+    lines = interleave([x.epochs for x in columns])
+
+    if path is None:
+        rows = array.array('i')
+        for positions in lines:
+            rows.extend([positions[i] for i in name_order])
+    else:
+        with open(path, 'w+b') as f:
+            for positions in lines:
+                f.write(struct.pack('=%di' % len(name_order),
+                                    *[positions[i] for i in name_order]))
+            f.flush()
+            if f.tell() > 0:
+                rows = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                rows = array.array('i')
+
+    history = CompactHistory([columns[i] for i in name_order], rows)
+    log.debug("Built a compact history of %d lines", len(history))
     return history
 
 
+def refine_history(history, found_i):
+    """
+    When the step from the last good line, found_i, to the next one moves
+    a single project over several revisions that were left out of the
+    history, like a whole push, return the lines for each of those
+    revisions with the other projects staying put.  Otherwise None
+    """
+    if found_i + 1 >= len(history):
+        return None
+    good, bad = history[found_i], history[found_i + 1]
+    moved = [i for i, (x, y) in enumerate(zip(good, bad)) if x.hash != y.hash]
+    if len(moved) != 1:
+        return None
+    i = moved[0]
+    revs = good[i].prj.full_rev_list()
+    hashes = [x[0] for x in revs]
+    try:
+        first, last = hashes.index(good[i].hash), hashes.index(bad[i].hash)
+    except ValueError:
+        return None
+    if last - first < 2:
+        return None
+    lines = []
+    for hash, date in revs[first:last + 1]:
+        line = list(good)
+        line[i] = Rev(hash, good[i].prj, date)
+        lines.append(line)
+    return lines
+
+
+def prebuilt_lines(history, has_build):
+    """
+    The indexes of the first line, which is taken to be good like in any
+    bisection, and of every line after it that has a build, leaving out the
+    last line that is taken to be bad
+    """
+    return [0] + [i for i in range(1, len(history) - 1)
+                  if has_build(history[i])]
+
+
+def build_gap(history, indices, found_i):
+    """
+    After bisecting only the lines at indices, the part of history from the
+    line that was found to the next line with a build, or the end, and where
+    it starts.  The change is somewhere in there
+    """
+    start = indices[found_i]
+    if found_i + 1 < len(indices):
+        end = indices[found_i + 1]
+    else:
+        end = len(history) - 1
+    return start, history[start:end + 1]
+
+
 def validate_history(history):
     pass
@@ -0,0 +1,76 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import logging
+
+from bisect_b2g.util import run_cmd
+
+log = logging.getLogger(__name__)
+
+
+class MirrorCache(object):
+    """
+    A directory of bare mirrors, one per remote URL, that clones on this
+    machine borrow their history from instead of downloading it again.
+    Each mirror is named after the repository with a hash of the full URL
+    so that two remotes with the same name don't collide.  Mirrors are
+    created and updated while holding a lock next to them so that jobs
+    starting at the same time don't trip over each other.
+
+    Git clones use a mirror's objects through their alternates, so nothing
+    is ever garbage collected or pruned from one
+    """
+
+    # Objects a clone still needs could otherwise go during a fetch
+    git_config = [('gc.auto', '0'), ('gc.pruneExpire', 'never'),
+                  ('maintenance.auto', 'false'), ('fetch.prune', 'false')]
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def mirror_path(self, url, vcs, name):
+        digest = hashlib.sha1(url).hexdigest()[:12]
+        return os.path.join(self.path, '%s-%s.%s' % (name, digest, vcs))
+
+    def _create(self, url, vcs, path):
+        log.info("Mirroring %s into %s", url, path)
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        if vcs == 'git':
+            run_cmd(['git', 'clone', '--mirror', '--quiet', url, tmp])
+            self._configure(tmp)
+        else:
+            run_cmd(['hg', 'clone', '--noupdate', '--quiet', url, tmp])
+        os.rename(tmp, path)
+
+    def _configure(self, path):
+        for key, value in self.git_config:
+            run_cmd(['git', 'config', key, value], workdir=path)
+
+    def _update(self, url, vcs, path):
+        log.info("Updating mirror of %s", url)
+        if vcs == 'git':
+            # Mirrors made before these settings existed get them too
+            self._configure(path)
+            run_cmd(['git', 'fetch', '--quiet', 'origin'], workdir=path)
+        else:
+            run_cmd(['hg', 'pull', '--quiet'], workdir=path)
+
+    def update(self, url, vcs, name):
+        """Create or update the mirror of url and return where it is"""
+        path = self.mirror_path(url, vcs, name)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    self._update(url, vcs, path)
+                else:
+                    self._create(url, vcs, path)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        return path
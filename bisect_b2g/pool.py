@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+
+from bisect_b2g.util import pid_alive
+
+log = logging.getLogger(__name__)
+
+
+def disk_usage(path):
+    """Bytes used by the files under path, not following symlinks"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Slot(object):
+    """A working directory handed out by a CheckoutPool"""
+
+    def __init__(self, name, path, repository):
+        object.__init__(self)
+        self.name = name
+        self.path = path
+        self.repository = repository
+
+    def set_rev(self, rev):
+        self.repository.set_rev(rev)
+
+    def __str__(self):
+        return "Slot %s at %s" % (self.name, self.path)
+    __repr__ = __str__
+
+
+class CheckoutPool(object):
+    """
+    Working directories for one repository, made with git worktree or hg
+    share so they don't need their own copy of the history.  A slot is
+    leased to one user at a time and remembers the revision it was left at,
+    so asking for a revision hands back the free slot that is already there
+    or closest to it.  Once the slots use more than budget bytes, the least
+    recently used free ones are removed.
+
+    The pool's state lives in a JSON file next to the slots and is only
+    touched while holding a lock on it, so bisections in different
+    processes can share a pool.  Leases held by processes that have gone
+    away are ignored
+    """
+
+    # A checkout's size hardly changes between nearby revisions, so it's
+    # only measured again after this many releases
+    measure_every = 10
+
+    def __init__(self, repository, path, budget=None):
+        object.__init__(self)
+        self.repository = repository
+        self.path = os.path.abspath(path)
+        self.budget = budget
+        self.state_file = os.path.join(self.path, 'pool.json')
+        self.lock = threading.Lock()
+        self._repositories = {}
+        # Releases of each slot since we last measured it
+        self._releases = {}
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _with_state(self, func):
+        """Call func with the pool state while holding the pool lock and
+        save whatever it did to the state"""
+        with self.lock:
+            with open(os.path.join(self.path, 'pool.lock'), 'a') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                try:
+                    state = {'next': 0, 'slots': {}}
+                    if os.path.exists(self.state_file):
+                        with open(self.state_file) as f:
+                            state = json.load(f)
+                    rv = func(state)
+                    tmp = self.state_file + '.tmp'
+                    with open(tmp, 'w') as f:
+                        json.dump(state, f, indent=2, sort_keys=True)
+                    os.rename(tmp, self.state_file)
+                    return rv
+                finally:
+                    fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def _slot(self, name):
+        path = os.path.join(self.path, name)
+        if name not in self._repositories:
+            self._repositories[name] = \
+                self.repository.__class__(self.repository.name,
+                                          self.repository.url, path)
+        return Slot(name, path, self._repositories[name])
+
+    def _choose(self, state, rev, distance):
+        free = [(name, info) for name, info in state['slots'].items()
+                if info['pid'] is None or not pid_alive(info['pid'])]
+        for name, info in free:
+            if info['rev'] == rev:
+                return name
+        if distance is not None:
+            near = [(distance(info['rev']), name) for name, info in free
+                    if info['rev'] is not None]
+            near = [x for x in near if x[0] is not None]
+            if len(near) > 0:
+                return min(near)[1]
+        if len(free) > 0:
+            return max(free, key=lambda x: x[1]['used'])[0]
+        return None
+
+    def acquire(self, rev, distance=None):
+        """
+        Lease a slot for rev, making a new one if none are free.  The slot
+        is not moved to rev, that's left to the caller.  distance, if
+        given, is called with a revision and returns how far it is from
+        rev, or None if it can't tell
+        """
+        def lease(state):
+            name = self._choose(state, rev, distance)
+            if name is None:
+                name = str(state['next'])
+                state['next'] += 1
+                state['slots'][name] = {'rev': None, 'size': None}
+                created.append(name)
+            state['slots'][name].update({'pid': os.getpid(),
+                                         'used': time.time()})
+            return name
+
+        created = []
+        name = self._with_state(lease)
+        if created:
+            path = os.path.join(self.path, name)
+            log.debug("Adding %s to the pool for %s", path,
+                      self.repository.name)
+            try:
+                self._repositories[name] = \
+                    self.repository.add_checkout(path)
+            except Exception:
+                self._with_state(lambda s: s['slots'].pop(name))
+                raise
+        slot = self._slot(name)
+        log.debug("Leased %s for %s", slot, rev)
+        return slot
+
+    def release(self, slot):
+        """Give a slot back, remembering where it was left"""
+        rev = slot.repository.get_rev()
+        size = None
+        if self.budget is not None:
+            releases = self._releases.get(slot.name)
+            if releases is None or releases + 1 >= self.measure_every:
+                size = disk_usage(slot.path)
+                self._releases[slot.name] = 0
+            else:
+                self._releases[slot.name] = releases + 1
+
+        def unlease(state):
+            info = state['slots'][slot.name]
+            info.update({'pid': None, 'rev': rev, 'used': time.time()})
+            if size is not None:
+                info['size'] = size
+            return self._evict(state)
+
+        for name in self._with_state(unlease):
+            log.info("Removing %s from the pool for %s to stay within %d "
+                     "bytes", name, self.repository.name, self.budget)
+            self._releases.pop(name, None)
+            repository = self._repositories.pop(name, None)
+            if repository is not None:
+                repository.close()
+            self.repository.remove_checkout(os.path.join(self.path, name))
+
+    def _evict(self, state):
+        if self.budget is None:
+            return []
+        slots = state['slots']
+        total = sum(x['size'] or 0 for x in slots.values())
+        evicted = []
+        for name, info in sorted(slots.items(), key=lambda x: x[1]['used']):
+            if total <= self.budget:
+                break
+            if info['pid'] is None or not pid_alive(info['pid']):
+                total -= info['size'] or 0
+                del slots[name]
+                evicted.append(name)
+        return evicted
+
+    def close(self):
+        for repository in self._repositories.values():
+            repository.close()
+        self._repositories = {}
@@ -0,0 +1,68 @@
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PushlogError(Exception):
+    pass
+
+
+def load_pushlog(path):
+    """
+    Read a pushlog saved from json-pushes, either the original format or
+    version 2, and return the changesets of each push, oldest push first
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, ValueError) as e:
+        raise PushlogError("Could not read pushlog %s: %s" % (path, e))
+    if isinstance(data, dict) and isinstance(data.get('pushes'), dict):
+        data = data['pushes']
+    if not isinstance(data, dict):
+        raise PushlogError("%s doesn't look like a pushlog" % path)
+    pushes = []
+    for push_id, push in data.items():
+        try:
+            changesets = push['changesets']
+            # With full=1 each changeset is a dict instead of a hash
+            changesets = [x['node'] if isinstance(x, dict) else x
+                          for x in changesets]
+            pushes.append((int(push_id), changesets))
+        except (KeyError, TypeError, ValueError) as e:
+            raise PushlogError("Push %s in %s is malformed: %s" %
+                               (push_id, path, e))
+    return [x[1] for x in sorted(pushes)]
+
+
+def merge_groups(rev_list, merges):
+    """
+    Guess pushes from where merges are on a first parent history, each one
+    ending with a merge and holding the commits that landed before it
+    """
+    groups = [[]]
+    for hash, date in rev_list:
+        groups[-1].append(hash)
+        if hash in merges:
+            groups.append([])
+    return [x for x in groups if x]
+
+
+def push_heads(rev_list, groups):
+    """
+    The part of a rev_list that's left when each push is cut down to its
+    last revision.  Revisions in no push stay on their own, and the first
+    and last ones are always kept so the range stays the same
+    """
+    push_of = {}
+    for i, group in enumerate(groups):
+        for hash in group:
+            push_of[hash] = i
+    kept = []
+    for i, rev in enumerate(rev_list):
+        push = push_of.get(rev[0])
+        if i == 0 or i == len(rev_list) - 1 or push is None or \
+                push != push_of.get(rev_list[i + 1][0]):
+            kept.append(rev)
+    return kept
@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import Queue
+import socket
+import logging
+import threading
+
+import isodate
+
+from bisect_b2g.evaluator import Evaluator, EvaluatorError
+from bisect_b2g.checkout import CheckoutPlanner
+from bisect_b2g.repository import Rev
+from bisect_b2g.workspace import layout_path, sparse_patterns
+
+log = logging.getLogger(__name__)
+
+
+class RemoteError(EvaluatorError):
+    pass
+
+
+def parse_address(address):
+    """
+    The socket family and address for 'host:port', or for a Unix socket
+    given as 'unix:path' or anything with a '/' in it
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if os.sep in address:
+        return socket.AF_UNIX, address
+    host, sep, port = address.rpartition(':')
+    try:
+        return socket.AF_INET, (host, int(port))
+    except ValueError:
+        raise RemoteError("%s isn't host:port or a Unix socket" % address)
+
+
+class Connection(object):
+    """Lines of JSON going both ways over a socket"""
+
+    def __init__(self, sock):
+        object.__init__(self)
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = json.dumps(message) + '\n'
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv(self):
+        """The next message, or None once the other end has gone"""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise RemoteError("Garbled message %r" % line[:100])
+
+    def close(self):
+        for x in (self.rfile, self.sock):
+            try:
+                x.close()
+            except (IOError, socket.error):
+                pass
+
+
+def describe_projects(projects):
+    """What a worker needs to know to make its own copy of each project"""
+    repositories = []
+    for project in projects:
+        url = project.url
+        if os.path.exists(url):
+            url = os.path.abspath(url)
+        repositories.append({
+            'name': project.name, 'vcs': project.vcs, 'url': url,
+            'path': layout_path(project), 'good': project.good,
+            'bad': project.bad, 'sparse': project.repository.sparse})
+    return repositories
+
+
+def describe_line(history_line):
+    return [{'project': rev.prj.name, 'hash': rev.hash,
+             'date': rev.date.isoformat() if rev.date else None}
+            for rev in history_line]
+
+
+class Task(object):
+
+    def __init__(self, id, history_line):
+        object.__init__(self)
+        self.id = id
+        self.history_line = history_line
+        self.attempts = 0
+        self.done = False
+        self.outcome = None
+        self.error = None
+
+
+class Coordinator(Evaluator):
+    """
+    Hands lines of history out to workers that connect to address, so that
+    they are tested on other machines.  Each worker gets one line at a
+    time, and a line whose worker goes away is given to the next one that's
+    free.  Nothing is checked out here, so with more than one job lines are
+    simply evaluated from several threads at once.  What the workers print
+    is kept in log_path, if given
+    """
+
+    needs_checkout = False
+
+    def __init__(self, address, projects, log_path=None, max_attempts=3):
+        Evaluator.__init__(self)
+        self.log_path = log_path
+        self.log_lock = threading.Lock()
+        self.max_attempts = max_attempts
+        self.setup = {'setup': describe_projects(projects)}
+        self.tasks = Queue.Queue()
+        self.cond = threading.Condition()
+        self.next_id = 0
+        self.workers = set()
+        self.closed = False
+        family, sockaddr = parse_address(address)
+        self.family = family
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            if os.path.exists(sockaddr):
+                os.unlink(sockaddr)
+        else:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
+                                     1)
+        self.listener.bind(sockaddr)
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+        log.info("Waiting for workers on %s", address)
+        self.accepter = threading.Thread(target=self._accept)
+        self.accepter.daemon = True
+        self.accepter.start()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                sock, peer = self.listener.accept()
+            except socket.error:
+                if self.closed:
+                    break
+                raise
+            thread = threading.Thread(target=self._serve,
+                                      args=(Connection(sock),))
+            thread.daemon = True
+            thread.start()
+
+    def _write_log(self, name, line):
+        log.debug("[%s] %s", name, line)
+        if self.log_path is not None:
+            with self.log_lock:
+                with open(self.log_path, 'a') as f:
+                    f.write('[%s] %s\n' % (name, line))
+
+    def _finish(self, task, outcome=None, error=None):
+        with self.cond:
+            task.done = True
+            task.outcome = outcome
+            task.error = error
+            self.cond.notify_all()
+
+    def _retry(self, task, reason):
+        task.attempts += 1
+        if task.attempts >= self.max_attempts:
+            self._finish(task, error="%s, %d times" % (reason, task.attempts))
+        else:
+            log.warning("%s, trying it again", reason)
+            self.tasks.put(task)
+
+    def _next_task(self):
+        while not self.closed:
+            try:
+                return self.tasks.get(timeout=0.5)
+            except Queue.Empty:
+                pass
+        return None
+
+    def _run_task(self, conn, name, task):
+        """The outcome of task on a worker, or raises RemoteError"""
+        conn.send({'task': task.id,
+                   'revisions': describe_line(task.history_line)})
+        while True:
+            message = conn.recv()
+            if message is None:
+                raise RemoteError("Worker %s went away" % name)
+            if 'log' in message:
+                self._write_log(name, message['log'])
+            elif message.get('task') == task.id:
+                return message
+
+    def _serve(self, conn):
+        name = 'unknown'
+        task = None
+        try:
+            hello = conn.recv()
+            if hello is None or 'worker' not in hello:
+                raise RemoteError("Something that isn't a worker connected")
+            name = hello['worker']
+            log.info("Worker %s connected, setting it up", name)
+            conn.send(self.setup)
+            reply = conn.recv()
+            if reply is None or not reply.get('ready'):
+                raise RemoteError("Worker %s could not set up: %s" %
+                                  (name, (reply or {}).get('error')))
+            log.info("Worker %s is ready", name)
+            with self.cond:
+                self.workers.add(name)
+            while True:
+                task = self._next_task()
+                if task is None:
+                    break
+                reply = self._run_task(conn, name, task)
+                if 'error' in reply:
+                    self._retry(task, "Worker %s could not test line: %s" %
+                                (name, reply['error']))
+                else:
+                    self._finish(task, reply.get('outcome'))
+                task = None
+            conn.send({'bye': True})
+        except (RemoteError, socket.error, IOError) as e:
+            log.warning("Lost worker %s: %s", name, e)
+            if task is not None:
+                self._retry(task, "Worker %s went away during a test" % name)
+        finally:
+            with self.cond:
+                self.workers.discard(name)
+            conn.close()
+
+    def evaluate(self, history_lines):
+        """Return the outcome for each line, in the same order"""
+        tasks = []
+        with self.cond:
+            for history_line in history_lines:
+                tasks.append(Task(self.next_id, history_line))
+                self.next_id += 1
+            if not self.workers:
+                log.info("There are no workers yet, waiting for one")
+        for task in tasks:
+            self.tasks.put(task)
+        with self.cond:
+            while not all(x.done for x in tasks):
+                self.cond.wait(1)
+        for task in tasks:
+            if task.error is not None:
+                raise RemoteError(task.error)
+        return [x.outcome for x in tasks]
+
+    def eval(self, history_line):
+        return self.evaluate([history_line])[0]
+
+    def eval_in(self, history_line, workdir):
+        return self.eval(history_line)
+
+    def close(self):
+        self.closed = True
+        try:
+            # Wakes up the accepting thread
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.unlink(self.address)
+
+
+def connect(address, timeout=60):
+    """A socket connected to address, retrying for up to timeout seconds"""
+    family, sockaddr = parse_address(address)
+    deadline = time.time() + timeout
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockaddr)
+            return sock
+        except socket.error as e:
+            sock.close()
+            if time.time() > deadline:
+                raise RemoteError("Could not connect to %s: %s" %
+                                  (address, e))
+            time.sleep(1)
+
+
+class Worker(object):
+    """
+    Tests lines of history for a Coordinator.  The projects are cloned
+    under workdir, laid out like they are for the coordinator, by
+    setup_projects, which is given a list of dictionaries like
+    driver.setup_projects is.  Lines are checked out there and the
+    evaluator runs from the top of workdir
+    """
+
+    def __init__(self, address, evaluator, workdir, setup_projects,
+                 name=None):
+        object.__init__(self)
+        self.address = address
+        self.evaluator = evaluator
+        self.workdir = os.path.abspath(workdir)
+        self.setup_projects = setup_projects
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.projects = {}
+        self.planner = CheckoutPlanner()
+
+    def _setup(self, repositories):
+        repo_datas = []
+        for repository in repositories:
+            repo_datas.append({
+                'name': repository['name'], 'vcs': repository['vcs'],
+                'uri': repository['url'], 'good': repository['good'],
+                'bad': repository['bad'],
+                'local_path': os.path.join(self.workdir, repository['path'])})
+        projects = self.setup_projects(repo_datas)
+        if self.evaluator.builds is not None:
+            self.evaluator.builds.resolve(projects)
+        # Paths our own evaluator needs are added to the coordinator's
+        patterns = sparse_patterns(
+            projects, self.evaluator.sparse_paths() or [],
+            dict((x['name'], x['path']) for x in repositories))
+        for project, repository in zip(projects, repositories):
+            if repository['sparse']:
+                project.set_sparse(repository['sparse'] +
+                                   patterns.get(project.name, []))
+        self.projects = dict((x.name, x) for x in projects)
+
+    def _line(self, revisions):
+        return [Rev(x['hash'], self.projects[x['project']],
+                    isodate.parse_datetime(x['date']) if x['date'] else None)
+                for x in revisions]
+
+    def _test(self, conn, task):
+        history_line = self._line(task['revisions'])
+        log.info("Testing %s", ", ".join(str(x) for x in history_line))
+        if self.evaluator.needs_checkout:
+            self.planner.apply(history_line)
+        # Scripts can pass on what they print as they go
+
+        def send_line(line):
+            conn.send({'log': line})
+        if hasattr(self.evaluator, 'line_callback'):
+            self.evaluator.line_callback = send_line
+        try:
+            return self.evaluator.eval_in(history_line, self.workdir)
+        finally:
+            if hasattr(self.evaluator, 'line_callback'):
+                self.evaluator.line_callback = None
+
+    def run(self):
+        """Take lines from the coordinator until it says it's done"""
+        conn = Connection(connect(self.address))
+        try:
+            conn.send({'worker': self.name})
+            message = conn.recv()
+            if message is None:
+                return
+            try:
+                self._setup(message['setup'])
+            except Exception as e:
+                log.error("Could not set up the projects: %s", e)
+                conn.send({'ready': False, 'error': str(e)})
+                return
+            conn.send({'ready': True})
+            while True:
+                message = conn.recv()
+                if message is None or message.get('bye'):
+                    break
+                try:
+                    outcome = self._test(conn, message)
+                except Exception as e:
+                    log.warning("Could not test line: %s", e, exc_info=True)
+                    conn.send({'task': message['task'], 'error': str(e)})
+                else:
+                    conn.send({'task': message['task'], 'outcome': outcome})
+        finally:
+            conn.close()
+            self.planner.close()
+            for project in self.projects.values():
+                project.close()
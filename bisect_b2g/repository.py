@@ -1,24 +1,113 @@
 import os
+import re
+import glob
+import json
+import fnmatch
+import shutil
+import sqlite3
+import hashlib
+import ConfigParser
 import logging
 from xml.etree import ElementTree
-import datetime
 
 import isodate
 import git
 import git.exc as gitexc
 import hgapi
 
+from bisect_b2g.util import from_epoch, to_epoch, StoreError
+from bisect_b2g.commitindex import CommitIndex
+from bisect_b2g.pushes import push_heads, merge_groups
+from bisect_b2g.gitstore import GitObjectStore, read_head
+from bisect_b2g.gitbatch import CatFile
+from bisect_b2g.hgstore import Changelog, read_dirstate_parent
+from bisect_b2g.hgserver import CommandServer, CommandServerError, \
+    HgCommandError
+
 log = logging.getLogger(__name__)
 
+full_hash_re = re.compile('^[0-9a-f]{40}$')
+
+# full copies everything, partial leaves file contents on the server until
+# they're needed and shallow only fetches the history between good and bad
+clone_modes = ('full', 'partial', 'shallow')
+
+
+class TagIndex(object):
+    """
+    All the tags of a repository, as tag -> hash and hash -> [tags].  The
+    index is saved to a JSON file along with a fingerprint of whatever the
+    VCS stores tags in, so it's only rebuilt when that changes
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.fingerprint = None
+        self.names = {}
+        self.tags = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        self.update(data['fingerprint'], data['names'].items())
+        return True
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': self.fingerprint,
+                       'names': self.names}, f)
+        os.rename(tmp, self.path)
+
+    def update(self, fingerprint, pairs):
+        self.fingerprint = fingerprint
+        self.names = {}
+        self.tags = {}
+        for tag, hash in pairs:
+            self.names[tag] = hash
+            self.tags.setdefault(hash, []).append(tag)
+        for tags in self.tags.values():
+            tags.sort()
+
+
+def path_matches(path, patterns):
+    """
+    Whether path is one of patterns, is inside one of them or matches one
+    of them as a wildcard
+    """
+    for pattern in patterns:
+        pattern = pattern.strip('/')
+        if path == pattern or path.startswith(pattern + '/') or \
+                fnmatch.fnmatchcase(path, pattern):
+            return True
+    return False
+
 
 class Repository(object):
 
-    def __init__(self, name, url, local_path):
+    def __init__(self, name, url, local_path, clone_mode='full',
+                 clone_revs=None, mirror=None):
         object.__init__(self)
         self.name = name
         self.url = url
         self.local_path = local_path
+        self.clone_mode = clone_mode
+        self.clone_revs = clone_revs
+        # A local copy of url that new clones take their history from
+        self.mirror = mirror
+        # Paths, relative to the top of the repository, that are checked
+        # out.  None means everything
+        self.sparse = None
         self.resolved_tags = {}
+        self._tag_index = None
+        self._commit_index = None
         if url == local_path:
             log.info("Setting up %s", local_path)
         else:
@@ -36,9 +125,55 @@ class Repository(object):
     def set_rev(self, rev):
         assert 0
 
+    def close(self):
+        if self._commit_index is not None:
+            self._commit_index.close()
+            self._commit_index = None
+
+    def metadata_dir(self):
+        """Where bisect_b2g keeps its own files for this repository"""
+        assert 0
+
+    def tag_index(self):
+        if self._tag_index is None:
+            self._tag_index = TagIndex(
+                os.path.join(self.metadata_dir(), 'tags.json'))
+            self._tag_index.load()
+            self.refresh_tags()
+        return self._tag_index
+
+    def refresh_tags(self):
+        fingerprint = self._tags_fingerprint()
+        if self._tag_index.fingerprint != fingerprint:
+            log.debug("Building tag index for %s", self.name)
+            self._tag_index.update(fingerprint, self._all_tags())
+            self.resolved_tags = {}
+            try:
+                self._tag_index.save()
+            except (IOError, OSError) as e:
+                log.warning("Could not save tag index for %s: %s",
+                            self.name, e)
+
+    def _tags_fingerprint(self):
+        assert 0
+
+    def _all_tags(self):
+        assert 0
+
     def resolve_tag(self, rev):
         if not rev is None and not rev in self.resolved_tags:
-            self.resolved_tags[rev] = self._resolve_tag(rev)
+            index = self.tag_index()
+            if rev in index.names:
+                rev_tags = index.tags[index.names[rev]]
+            else:
+                rev_tags = index.tags.get(rev)
+            if rev_tags:
+                self.resolved_tags[rev] = " ".join(rev_tags)
+            elif full_hash_re.match(rev):
+                self.resolved_tags[rev] = rev
+            else:
+                # Short hashes and other names need the VCS to expand them
+                self.resolved_tags[rev] = self._resolve_tag(rev)
         elif rev is None:
             return self._resolve_tag(rev)
         return self.resolved_tags[rev]
@@ -49,9 +184,139 @@ class Repository(object):
     def validate_rev(self, rev):
         assert 0
 
-    def rev_list(self, start, end):
+    def ensure_range(self, good, bad):
+        """
+        Fetch whatever is missing to walk from bad back to good, so that
+        existing and cut down clones can still be used
+        """
         assert 0
 
+    def read_file(self, rev, path):
+        """
+        The contents of path, relative to the top of the repository, at
+        rev without checking it out, or None if there's no such file
+        """
+        assert 0
+
+    def set_sparse(self, patterns):
+        """
+        Only check out the files matching patterns from now on, or all of
+        them if patterns is None or empty
+        """
+        patterns = list(patterns) if patterns else None
+        if patterns == self.sparse and (patterns or not self.is_sparse()):
+            return
+        log.info("Checking out %s of %s", ', '.join(patterns)
+                 if patterns else 'all', self.name)
+        self._apply_sparse(patterns)
+        self.sparse = patterns
+
+    def is_sparse(self):
+        """Whether only some of the files are checked out"""
+        assert 0
+
+    def _apply_sparse(self, patterns):
+        assert 0
+
+    def add_checkout(self, path):
+        """
+        Make another working directory at path that shares this
+        repository's history, and return a Repository for it.  It checks
+        out the same paths as this one
+        """
+        assert 0
+
+    def remove_checkout(self, path):
+        assert 0
+
+    def iter_revs(self, start, end):
+        """
+        Lazily yield (hash, commit epoch, offset east of UTC) for the first
+        parent history from end back to start, newest first, reading the
+        repository directly.  Raises StoreError if that can't be done
+        """
+        assert 0
+
+    def iter_revs_vcs(self, start, end):
+        """The same as iter_revs, but using the VCS"""
+        assert 0
+
+    def rev_tuples(self, start, end):
+        """A list of what iter_revs yields, using the VCS if we have to"""
+        try:
+            return list(self.iter_revs(start, end))
+        except StoreError as e:
+            log.debug("Reading %s directly failed, using the VCS: %s",
+                      self.name, e)
+            return list(self.iter_revs_vcs(start, end))
+
+    def commit_index(self):
+        if self._commit_index is None:
+            self._commit_index = CommitIndex(
+                os.path.join(self.metadata_dir(), 'commits.sqlite'))
+        return self._commit_index
+
+    def rev_list(self, start, end, use_index=False):
+        revs = None
+        if use_index:
+            try:
+                revs = self.commit_index().rev_tuples(self, start, end)
+            except sqlite3.Error as e:
+                log.warning("Commit index for %s failed: %s", self.name, e)
+        if revs is None:
+            revs = self.rev_tuples(start, end)
+        return [(x[0], from_epoch(x[1], x[2])) for x in reversed(revs)]
+
+    def changed_files(self, start, end):
+        """
+        Map the hash of each revision between start and end to the paths
+        it changed, compared to its first parent
+        """
+        assert 0
+
+    def merges(self, start, end):
+        """The hashes of the merges on the first parent history"""
+        assert 0
+
+    def touching(self, rev_list, include=None, exclude=None, all_revs=None):
+        """
+        The part of a rev_list whose revisions change a path matching
+        include, or any path if it's empty, that doesn't match exclude.
+        The first and last revisions are always kept, so the range stays
+        the same.  If rev_list has been cut down from all_revs, each
+        revision also counts the changes of those left out before it
+        """
+        if len(rev_list) < 3 or not (include or exclude):
+            return rev_list
+        changed = self.changed_files(rev_list[0][0], rev_list[-1][0])
+        if all_revs is not None:
+            grouped = {}
+            kept = set(x[0] for x in rev_list)
+            files = []
+            for hash, date in all_revs:
+                files.extend(changed.get(hash, ()))
+                if hash in kept:
+                    grouped[hash], files = files, []
+            changed = grouped
+
+        def wanted(path):
+            return (not include or path_matches(path, include)) and \
+                not path_matches(path, exclude or [])
+        kept = [x for x in rev_list[1:-1]
+                if any(wanted(y) for y in changed.get(x[0], ()))]
+        log.info("%d of %d revisions of %s touch the paths wanted",
+                 len(kept) + 2, len(rev_list), self.name)
+        return [rev_list[0]] + kept + [rev_list[-1]]
+
+    def full_hash(self, rev):
+        """Expand rev to a full hash, avoiding the VCS where we can"""
+        if full_hash_re.match(rev):
+            return rev
+        names = self.tag_index().names
+        if rev in names:
+            return names[rev]
+        return self.get_rev(rev)
+
 
 class GitRepository(Repository):
 
@@ -62,9 +327,39 @@ class GitRepository(Repository):
             self.repo = git.Repo(self.local_path)
         else:
             log.debug("%s does not exist, cloning", self.name)
-            self.repo = git.Repo.clone_from(self.url, self.local_path)
+            options = {}
+            if self.clone_mode == 'partial':
+                options['filter'] = 'blob:none'
+            elif self.clone_mode == 'shallow':
+                options['depth'] = 1
+            if self.mirror:
+                # Objects already in the mirror are used from there through
+                # objects/info/alternates instead of being copied
+                options['reference'] = self.mirror
+            self.repo = git.Repo.clone_from(self.url, self.local_path,
+                                            **options)
+        self._object_store = None
+        self.cat_file = CatFile(self.local_path)
+
+    def close(self):
+        self.cat_file.close()
+        Repository.close(self)
+
+    def read_file(self, rev, path):
+        obj_type, data = self.cat_file.read('%s:%s' % (rev, path))
+        if obj_type != 'blob':
+            return None
+        return data
 
     def get_rev(self, rev=None):
+        if not rev:
+            try:
+                head = read_head(self.repo.git_dir)
+            except (IOError, OSError, StoreError) as e:
+                log.debug("Could not read HEAD of %s: %s", self.name, e)
+                head = None
+            if head is not None:
+                return head
         _rev = rev if rev else 'HEAD'
         log.debug("Getting revision for %s", _rev)
         return self.repo.commit(_rev).hexsha
@@ -77,6 +372,39 @@ class GitRepository(Repository):
         log.debug("Intended to set %s, actually set %s",
                   rev, self.get_rev())
 
+    def metadata_dir(self):
+        return os.path.join(self.repo.git_dir, 'bisect_b2g')
+
+    def _common_dir(self):
+        # Worktrees keep their refs in the main repository's git dir
+        commondir = os.path.join(self.repo.git_dir, 'commondir')
+        if os.path.exists(commondir):
+            with open(commondir) as f:
+                return os.path.join(self.repo.git_dir, f.read().strip())
+        return self.repo.git_dir
+
+    def _tags_fingerprint(self):
+        common_dir = self._common_dir()
+        stamps = []
+        packed_refs = os.path.join(common_dir, 'packed-refs')
+        if os.path.exists(packed_refs):
+            st = os.stat(packed_refs)
+            stamps.append(('packed-refs', st.st_size, st.st_mtime))
+        tags_dir = os.path.join(common_dir, 'refs', 'tags')
+        for dirpath, dirnames, filenames in os.walk(tags_dir):
+            for filename in filenames:
+                st = os.stat(os.path.join(dirpath, filename))
+                stamps.append((os.path.join(dirpath, filename),
+                               st.st_size, st.st_mtime))
+        return hashlib.sha1(repr(sorted(stamps))).hexdigest()
+
+    def _all_tags(self):
+        output = self.repo.git.for_each_ref(
+            'refs/tags', format='%(objectname) %(*objectname) %(refname)')
+        for line in output.splitlines():
+            hash, peeled, ref = line.split(' ', 2)
+            yield ref[len('refs/tags/'):], peeled or hash
+
     def _resolve_tag(self, rev):
         git = self.repo.git
         _rev = rev[:] if rev else 'HEAD'
@@ -89,106 +417,352 @@ class GitRepository(Repository):
     def validate_rev(self, rev):
         pass
 
-    def rev_list(self, start, end):
-
-        start_parents = self.repo.commit(start).parents
-        if len(start_parents) == 0:
-            rev_spec = end
-        else:
-            rev_spec = '%s^..%s' % (start, end)
-
-        log.debug("Using revspec '%s'", rev_spec)
-        commits = self.repo.iter_commits(rev=rev_spec,
-                                         first_parent=True)
+    def _has_commit(self, rev):
+        try:
+            self.repo.commit(rev)
+            return True
+        except (gitexc.BadName, gitexc.BadObject, ValueError):
+            return False
 
-        output = []
+    def is_shallow(self):
+        return os.path.exists(os.path.join(self._common_dir(), 'shallow'))
 
-        class FixedSecondsOffset(datetime.tzinfo):
-            def __init__(self, offset):
-                self.offset = offset
+    def _fetch(self, *args):
+        log.debug("Fetching %s into %s", " ".join(args), self.name)
+        self.repo.git.fetch('origin', *args)
+        self._object_store = None
 
-            def utcoffset(self, dt):
-                return datetime.timedelta(seconds=-self.offset)
+    def _fetch_rev(self, rev):
+        log.info("Fetching %s into %s", rev, self.name)
+        depth = ['--depth=1'] if self.is_shallow() else []
+        try:
+            if full_hash_re.match(rev):
+                self._fetch(*(depth + [rev]))
+            else:
+                self._fetch(*(depth + ['refs/tags/%s:refs/tags/%s' %
+                                       (rev, rev)]))
+        except gitexc.GitCommandError as e:
+            log.debug("Targeted fetch of %s failed: %s", rev, e)
+            self._fetch(*(depth + ['--tags']))
+
+    def _covers(self, good, bad):
+        try:
+            self.repo.git.merge_base('--is-ancestor', good, bad)
+            return True
+        except gitexc.GitCommandError:
+            return False
 
-            def tzname(self, dt):
-                return ''
+    def ensure_range(self, good, bad):
+        for rev in (good, bad):
+            if not self._has_commit(rev):
+                self._fetch_rev(rev)
+        if not self.is_shallow():
+            return
+        good = self.get_rev(good)
+        bad = self.get_rev(bad)
+        if self._covers(good, bad):
+            return
+        # Commits between good and bad are normally newer than good
+        since = self.repo.commit(good).committed_date - 1
+        log.info("Deepening %s to cover %s..%s", self.name, good, bad)
+        self._fetch('--shallow-since=%d' % since, bad)
+        depth = 64
+        while not self._covers(good, bad) and depth <= 4096:
+            self._fetch('--deepen=%d' % depth, bad)
+            depth *= 4
+        if not self._covers(good, bad):
+            self._fetch('--unshallow')
+
+    def is_sparse(self):
+        try:
+            return self.repo.git.config(
+                '--type=bool', 'core.sparseCheckout') == 'true'
+        except gitexc.GitCommandError:
+            return False
 
-            def dst(self, dt):
-                return datetime.timedelta(0)
+    def _apply_sparse(self, patterns):
+        if patterns:
+            # Anchor the patterns at the top, otherwise they'd match in
+            # every directory
+            self.repo.git.sparse_checkout(
+                'set', '--no-cone', *['/' + x.lstrip('/') for x in patterns])
+        else:
+            self.repo.git.sparse_checkout('disable')
+
+    def add_checkout(self, path):
+        # Nothing is checked out until the sparse patterns are in place, like
+        # hg share --noupdate
+        self.repo.git.worktree('add', '--no-checkout', '--detach', path)
+        checkout = GitRepository(self.name, self.url, path)
+        checkout.set_sparse(self.sparse)
+        checkout.repo.git.reset('-q', '--hard', 'HEAD')
+        return checkout
+
+    def remove_checkout(self, path):
+        try:
+            self.repo.git.worktree('remove', '--force', path)
+        except gitexc.GitCommandError as e:
+            log.debug("Removing worktree %s failed: %s", path, e)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            self.repo.git.worktree('prune')
+
+    def object_store(self):
+        if self._object_store is None:
+            self._object_store = GitObjectStore(
+                self.repo.git_dir,
+                os.path.join(self.metadata_dir(), 'offsets.bin'))
+        return self._object_store
+
+    def iter_revs(self, start, end, tz=True):
+        start = self.get_rev(start) if start is not None else None
+        end = self.get_rev(end)
+        return self.object_store().first_parent_walk(end, start, tz)
+
+    def merges(self, start, end):
+        return set(self.repo.git.rev_list(
+            '--first-parent', '--merges', '%s..%s' % (start, end)).split())
+
+    def changed_files(self, start, end):
+        # -m with --first-parent lists what merges changed from their first
+        # parent instead of nothing
+        output = self.repo.git.log(
+            '--first-parent', '-m', '--no-renames', '--name-only',
+            '--format=%x00%H', '%s..%s' % (start, end))
+        changed = {}
+        for entry in output.split('\0')[1:]:
+            lines = [x for x in entry.splitlines() if x]
+            changed[lines[0]] = lines[1:]
+        return changed
+
+    def iter_revs_vcs(self, start, end):
+        if start is None or len(self.repo.commit(start).parents) == 0:
+            rev_spec = end
+        else:
+            rev_spec = '%s^..%s' % (start, end)
 
-        for commit in commits:
-            output.append((
-                commit.hexsha,
-                datetime.datetime.fromtimestamp(
-                    commit.committed_date,
-                    FixedSecondsOffset(commit.committer_tz_offset))
-            ))
-        output.reverse()
-        return output
+        log.debug("Using revspec '%s'", rev_spec)
+        for commit in self.repo.iter_commits(rev=rev_spec, first_parent=True):
+            yield (commit.hexsha, commit.committed_date,
+                   -commit.committer_tz_offset)
 
 
 class HgRepository(Repository):
 
+    # Read the changelog ourselves instead of asking 'hg log' for a range
+    read_revlog = True
+
     def __init__(self, *args, **kwargs):
         Repository.__init__(self, *args, **kwargs)
         if os.path.exists(self.local_path) and os.path.isdir(self.local_path):
             self.repo = hgapi.Repo(self.local_path)
+        elif self.mirror:
+            # The shared working copy keeps the mirror's store and default
+            # path, which is url
+            hgapi.Repo.command('.', os.environ, '--config',
+                               'extensions.share=', 'share', self.mirror,
+                               self.local_path)
+            self.repo = hgapi.Repo(self.local_path)
         else:
-            self.repo = hgapi.hg_clone(self.url, self.local_path)
+            # Mercurial can't leave out file contents or old history
+            # without extensions, but it can stop at the revisions we need
+            args = []
+            if self.clone_mode != 'full' and self.clone_revs:
+                for rev in self.clone_revs:
+                    args.extend(['-r', rev])
+            self.repo = hgapi.hg_clone(self.url, self.local_path, *args)
+        self.server = CommandServer(self.local_path)
+
+    def hg(self, *args):
+        """Run an hg command, through the command server if we can"""
+        if self.server is not None:
+            try:
+                return self.server.command(*args)
+            except CommandServerError as e:
+                log.warning("Not using the hg command server for %s: %s",
+                            self.name, e)
+                self.server = None
+        return self.repo.hg_command(*args)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        Repository.close(self)
+
+    def read_file(self, rev, path):
+        args = ('cat', '-r', rev, 'path:' + path)
+        if self.server is not None:
+            try:
+                # Straight from the server so file contents aren't decoded
+                code, output, error = self.server.runcommand(*args)
+                return output if code == 0 else None
+            except CommandServerError as e:
+                log.warning("Not using the hg command server for %s: %s",
+                            self.name, e)
+                self.server = None
+        try:
+            return self.repo.hg_command(*args)
+        except hgapi.HgException:
+            return None
 
     def get_rev(self, rev=None):
+        if not rev:
+            try:
+                parent = read_dirstate_parent(self.local_path)
+            except (IOError, OSError) as e:
+                log.debug("Could not read dirstate of %s: %s", self.name, e)
+                parent = None
+            if parent is not None:
+                return parent
         _rev = rev if rev else '.'
         log.debug("Getting revision for %s", _rev)
-        return self.repo.hg_log(
-            limit=1, identifier=_rev, **{'--template': '{node}'})
+        return self.hg('log', '-l', '1', '-r', _rev, '--template', '{node}')
 
     def set_rev(self, rev):
-        self.repo.hg_update('-r' + rev, clean=True)
+        self.hg('update', '--clean', '-r', rev)
         log.debug("Intended to set %s, actually set %s",
                   rev, self.get_rev())
 
     def validate_rev(self, rev):
         assert 0
 
+    def metadata_dir(self):
+        return os.path.join(self.local_path, '.hg', 'bisect_b2g')
+
+    def _tags_fingerprint(self):
+        stamps = []
+        for f in (('store', '00changelog.i'), ('localtags',)):
+            path = os.path.join(self.local_path, '.hg', *f)
+            if os.path.exists(path):
+                st = os.stat(path)
+                stamps.append((f, st.st_size, st.st_mtime))
+        return hashlib.sha1(repr(stamps)).hexdigest()
+
+    def _all_tags(self):
+        output = self.hg('tags', '--template', '{node} {tag}\n')
+        for line in output.splitlines():
+            hash, tag = line.split(' ', 1)
+            yield tag, hash
+
     def _resolve_tag(self, rev):
-        tags = self.repo.hg_tags()
-        hg_id = self.repo.hg_log(
-            limit=1, template="{node|short}",
-            identifier=rev if rev else ".")
+        hg_id = self.hg('log', '-l', '1', '-r', rev if rev else '.',
+                        '--template', '{node|short}')
         found_tags = []
-        for k in tags.keys():
-            if tags[k] == hg_id:
-                found_tags.append(k)
+        for line in self.hg('tags', '--template',
+                            '{node|short} {tag}\n').splitlines():
+            node, tag = line.split(' ', 1)
+            if node == hg_id:
+                found_tags.append(tag)
         if len(found_tags) > 0:
             return " ".join(found_tags)
         else:
             return rev
 
-    def rev_list(self, start, end):
+    def ensure_range(self, good, bad):
+        for rev in (good, bad):
+            try:
+                self.get_rev(rev)
+                continue
+            except (HgCommandError, hgapi.HgException):
+                pass
+            log.info("Pulling %s into %s", rev, self.name)
+            try:
+                self.hg('pull', '-r', rev)
+            except (HgCommandError, hgapi.HgException) as e:
+                log.debug("Targeted pull of %s failed: %s", rev, e)
+                self.hg('pull')
+
+    def _enable_sparse(self):
+        # Once a working copy is sparse, every hg command needs the
+        # extension, so it's turned on in the repository's own hgrc
+        hgrc = os.path.join(self.local_path, '.hg', 'hgrc')
+        config = ConfigParser.RawConfigParser()
+        config.read(hgrc)
+        if config.has_option('extensions', 'sparse'):
+            return
+        with open(hgrc, 'a') as f:
+            f.write('\n[extensions]\nsparse =\n')
+        # The command server only reads the configuration when it starts
+        if self.server is not None:
+            self.server.close()
+
+    def is_sparse(self):
+        requires = os.path.join(self.local_path, '.hg', 'requires')
+        if not os.path.exists(requires):
+            return False
+        with open(requires) as f:
+            return 'exp-sparse' in f.read().split()
+
+    def _apply_sparse(self, patterns):
+        self._enable_sparse()
+        if self.is_sparse():
+            self.hg('debugsparse', '--reset')
+        if patterns:
+            self.hg('debugsparse', '--include',
+                    *[('glob:' if glob.has_magic(x) else 'path:') +
+                      x.lstrip('/') for x in patterns])
+
+    def add_checkout(self, path):
+        self.hg('--config', 'extensions.share=', 'share', '--noupdate',
+                os.path.abspath(self.local_path), path)
+        checkout = HgRepository(self.name, self.url, path)
+        checkout.set_sparse(self.sparse)
+        return checkout
+
+    def remove_checkout(self, path):
+        shutil.rmtree(path)
+
+    def changelog(self):
+        return Changelog(self.local_path)
+
+    def iter_revs(self, start, end):
+        if not self.read_revlog:
+            raise StoreError("Reading the revlog is disabled")
+        start = self.get_rev(start) if start is not None else None
+        end = self.get_rev(end)
+        try:
+            changelog = self.changelog()
+        except (IOError, OSError) as e:
+            raise StoreError("Could not read changelog: %s" % e)
+        return changelog.first_parent_walk(end, start)
+
+    def merges(self, start, end):
+        return set(self.hg('log', '-r', 'merge() and %s:%s' % (start, end),
+                           '--template', '{node}\\n').split())
+
+    def changed_files(self, start, end):
+        output = self.hg('log', '-r', '%s:%s' % (start, end), '--template',
+                         '\\0{node}\\n{join(files, "\\n")}\\n')
+        changed = {}
+        for entry in output.split('\0')[1:]:
+            lines = [x for x in entry.splitlines() if x]
+            changed[lines[0]] = lines[1:]
+        return changed
+
+    def iter_revs_vcs(self, start, end):
         log.debug("Fetching HG revision list for %s..%s", start, end)
-        # XXX This is busted somehow
-        #rev_range = "p1(first(children(%s))..first(children(%s)))" % (
-        #   end, start)
-        rev_range = "%s:%s" % (start, end)
+        # First parents only, newest first, like the changelog walk
+        if start is None:
+            rev_range = "sort(_firstancestors(%s), -rev)" % end
+        else:
+            rev_range = "sort(_firstancestors(%s) and %s::%s, -rev)" % (
+                end, start, end)
         log.debug("Using revset '%s'", rev_range)
-        raw_xml = self.repo.hg_log(rev_range, **{'--style': 'xml'})
+        raw_xml = self.hg('log', '-r', rev_range, '--style', 'xml')
 
         assert len(raw_xml) > 0, "No XML returned!"
 
         root = ElementTree.XML(raw_xml.encode('utf-8'))
-        output = []
 
         for log_entry in root.findall('logentry'):
             d = isodate.parse_datetime(log_entry.find('date').text)
             h = log_entry.get('node')
-            output.append((h, d))
-
-        return output
+            yield (h,) + to_epoch(d)
 
 
 class Project(object):
     def __init__(self, name, url, local_path, good, bad,
-                 vcs="git"):
+                 vcs="git", use_index=True, clone_mode='full', mirror=None):
         object.__init__(self)
         self.name = name
         self.url = url
@@ -196,6 +770,14 @@ class Project(object):
         self.good = good
         self.bad = bad
         self.vcs = vcs
+        self.use_index = use_index
+        self._rev_list = None
+        # Only revisions changing these paths are bisected
+        self.include = None
+        self.exclude = None
+        # Each push is cut down to its last revision, if there are any
+        self.pushes = None
+        self._filtered = None
 
         if self.vcs == 'git':
             repocls = GitRepository
@@ -206,12 +788,61 @@ class Project(object):
 
         log.debug("Using %s for %s", str(repocls), self.name)
 
+        self.repocls = repocls
         self.repository = repocls(self.name,
                                   self.url,
-                                  self.local_path)
+                                  self.local_path,
+                                  clone_mode=clone_mode,
+                                  clone_revs=(good, bad),
+                                  mirror=mirror)
+        self.repository.ensure_range(good, bad)
+
+    def full_rev_list(self):
+        """Every revision between good and bad, without any filtering"""
+        if self._rev_list is None:
+            self._rev_list = self.repository.rev_list(
+                self.good, self.bad, use_index=self.use_index)
+        return self._rev_list
 
     def rev_list(self):
-        return self.repository.rev_list(self.good, self.bad)
+        revs = self.full_rev_list()
+        if not (self.include or self.exclude or self.pushes):
+            return revs
+        if self._filtered is None:
+            if self.pushes:
+                revs = push_heads(revs, self._push_groups())
+                log.info("%s has %d pushes", self.name, len(revs))
+            self._filtered = self.repository.touching(
+                revs, self.include, self.exclude, self.full_rev_list())
+        return self._filtered
+
+    def _push_groups(self):
+        if self.pushes != 'merges':
+            return self.pushes
+        revs = self.full_rev_list()
+        merges = self.repository.merges(revs[0][0], revs[-1][0])
+        if not merges:
+            log.warning("There are no merges to group %s by", self.name)
+            return []
+        return merge_groups(revs, merges)
+
+    def set_pushes(self, pushes):
+        """
+        Only bisect the last revision of each push.  pushes is a list of
+        the changesets in each push or 'merges' to guess them from where
+        merges are
+        """
+        self.pushes = pushes
+        self._filtered = None
+
+    def set_path_filter(self, include=None, exclude=None):
+        """
+        Leave out the revisions that don't change a path matching include
+        or only change paths matching exclude
+        """
+        self.include = include
+        self.exclude = exclude
+        self._filtered = None
 
     def get_rev(self, rev=None):
         return self.repository.get_rev(rev)
@@ -229,6 +860,21 @@ class Project(object):
     def resolve_tag(self, rev=None):
         return self.repository.resolve_tag(rev)
 
+    def set_sparse(self, patterns):
+        self.repository.set_sparse(patterns)
+
+    def checkout_at(self, path):
+        """A Repository for another copy of this project at path, cloned
+        from our local copy if it doesn't exist yet.  It checks out the
+        same paths as our local copy"""
+        checkout = self.repocls(self.name, os.path.abspath(self.local_path),
+                                path)
+        checkout.set_sparse(self.repository.sparse)
+        return checkout
+
+    def close(self):
+        self.repository.close()
+
     def __str__(self):
         return "Name: %(name)s, Url: %(url)s, " % (self.__dict__,) + \
                "Good: %(good)s, Bad: %(bad)s, VCS: %(vcs)s" % self.__dict__
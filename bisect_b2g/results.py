@@ -0,0 +1,71 @@
+import os
+import json
+import fcntl
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def line_key(history_line):
+    """The (project, hash) pairs of a history line, in project name order"""
+    return tuple(sorted((rev.prj.name, rev.hash) for rev in history_line))
+
+
+class ResultStore(object):
+    """
+    Evaluator outcomes that survive the bisection that produced them.  Each
+    outcome is appended to a file as a line of JSON while holding an
+    exclusive lock, so several bisections can share one store and a
+    restarted bisection doesn't need to test the same line twice.  Records
+    written by other processes are picked up the next time we look
+    """
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.results = {}
+        self._read_to = 0
+
+    def _load(self, f):
+        f.seek(self._read_to)
+        for data in f:
+            if not data.endswith('\n'):
+                # Someone is still writing this one
+                break
+            self._read_to += len(data)
+            try:
+                record = json.loads(data)
+                key = tuple(tuple(x) for x in record['line'])
+                self.results[key] = bool(record['outcome'])
+            except (ValueError, KeyError, TypeError):
+                log.warning("Ignoring bad record in %s: %r", self.path, data)
+
+    def refresh(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as f:
+            fcntl.lockf(f, fcntl.LOCK_SH)
+            try:
+                self._load(f)
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+    def get(self, history_line):
+        """The stored outcome for a history line, or None"""
+        key = line_key(history_line)
+        if key not in self.results:
+            self.refresh()
+        return self.results.get(key)
+
+    def put(self, history_line, outcome):
+        key = line_key(history_line)
+        record = json.dumps({'line': key, 'outcome': bool(outcome)})
+        with open(self.path, 'a+') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            try:
+                f.write(record + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+        self.results[key] = bool(outcome)
@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import unittest
+
+from bisect_b2g.artifacts import ArtifactCache, BuildIndex, \
+    BuildIndexError, line_fingerprint
+from bisect_b2g.evaluator import ScriptEvaluator
+from bisect_b2g.repository import Rev
+from bisect_b2g.tests.test_repository import make_temp_dir
+from bisect_b2g.tests.test_history import FakeProject as HistoryProject
+
+
+class FakeProject(object):
+
+    def __init__(self, name):
+        object.__init__(self)
+        self.name = name
+
+
+def make_line(*revs):
+    return [Rev(hash, FakeProject(name), None) for name, hash in revs]
+
+
+class ArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempArtifacts')
+        self.addCleanup(shutil.rmtree, self.loc)
+        self.cache = ArtifactCache(os.path.join(self.loc, 'cache'))
+        self.line = make_line(('gecko', 'a'), ('gaia', 'b'))
+
+    def build(self, cache, line, size=10):
+        staging = cache.staging()
+        with open(os.path.join(staging, 'b2g.tar'), 'w') as f:
+            f.write('x' * size)
+        return cache.publish(line, staging)
+
+    def test_fingerprint(self):
+        self.assertEqual(line_fingerprint(self.line),
+                         line_fingerprint(list(reversed(self.line))))
+        self.assertNotEqual(line_fingerprint(self.line),
+                            line_fingerprint(self.line, 'debug'))
+        self.assertNotEqual(
+            line_fingerprint(self.line),
+            line_fingerprint(make_line(('gecko', 'a'), ('gaia', 'c'))))
+        config = os.path.join(self.loc, 'mozconfig')
+        with open(config, 'w') as f:
+            f.write('ac_add_options --enable-debug\n')
+        other = ArtifactCache(os.path.join(self.loc, 'cache'), config)
+        self.assertNotEqual(self.cache.key(self.line), other.key(self.line))
+
+    def test_publish(self):
+        self.assertEqual(None, self.cache.lookup(self.line))
+        self.assertFalse(self.cache.has(self.line))
+        path = self.build(self.cache, self.line)
+        self.assertTrue(self.cache.has(self.line))
+        self.assertEqual(path, self.cache.lookup(self.line))
+        self.cache.release(self.line)
+        with open(os.path.join(path, 'b2g.tar')) as f:
+            self.assertEqual('x' * 10, f.read())
+        # The first one stays
+        self.build(self.cache, self.line, 20)
+        self.assertEqual(10, os.path.getsize(os.path.join(path, 'b2g.tar')))
+        self.assertEqual([], os.listdir(os.path.join(self.cache.path, 'tmp')))
+
+    def test_empty(self):
+        staging = self.cache.staging()
+        self.assertEqual(None, self.cache.publish(self.line, staging))
+        self.assertFalse(os.path.exists(staging))
+        self.assertFalse(self.cache.has(self.line))
+
+    def test_evict(self):
+        cache = ArtifactCache(os.path.join(self.loc, 'cache'), budget=25)
+        lines = [make_line(('gecko', str(x))) for x in range(4)]
+        self.build(cache, lines[0])
+        self.build(cache, lines[1])
+        # Being read, so it's kept even though it's the oldest
+        cache.lookup(lines[0])
+        self.build(cache, lines[2])
+        self.assertEqual([True, False, True],
+                         [cache.has(x) for x in lines[:3]])
+        cache.release(lines[0])
+        cache.lookup(lines[2])
+        cache.release(lines[2])
+        self.build(cache, lines[3])
+        self.assertEqual([False, False, True, True],
+                         [cache.has(x) for x in lines])
+
+    def test_script(self):
+        script = ScriptEvaluator(
+            ['sh', '-c', 'test -n "$BISECT_ARTIFACT_HIT" && '
+             'cat "$BISECT_ARTIFACT_HIT/built" || '
+             'echo built > "$BISECT_ARTIFACT_SAVE/built"'],
+            artifacts=self.cache)
+        self.assertFalse(script.is_cached(self.line))
+        self.assertEqual(True, script.eval(self.line))
+        self.assertTrue(script.is_cached(self.line))
+        self.assertEqual(True, script.eval(self.line))
+        self.assertEqual([], os.listdir(os.path.join(self.cache.path, 'tmp')))
+
+
+class BuildIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempBuilds')
+        self.addCleanup(shutil.rmtree, self.loc)
+        self.index = os.path.join(self.loc, 'builds.json')
+        self.projects = [HistoryProject('gaia', [1, 3]),
+                         HistoryProject('gecko', [2, 40])]
+
+    def write(self, data):
+        with open(self.index, 'w') as f:
+            json.dump(data, f)
+        return BuildIndex(self.index)
+
+    def line(self, gaia, gecko):
+        return [Rev(gaia, self.projects[0], None),
+                Rev(gecko, self.projects[1], None)]
+
+    def test_lookup(self):
+        builds = self.write([
+            {'path': 'one', 'revisions': {'gaia': 'gaia1', 'gecko': 'gecko2'}},
+            # Abbreviated
+            {'path': '/b/two', 'revisions': {'gaia': 'gaia3', 'gecko':
+                                             'gecko4'}},
+            # Ambiguous, missing a project and out of range
+            {'path': 'x', 'revisions': {'gaia': 'gaia', 'gecko': 'gecko2'}},
+            {'path': 'y', 'revisions': {'gaia': 'gaia1'}},
+            {'path': 'z', 'revisions': {'gaia': 'gaia1', 'gecko': 'gecko9'}},
+        ])
+        builds.resolve(self.projects)
+        self.assertEqual(os.path.join(self.loc, 'one'),
+                         builds.lookup(self.line('gaia1', 'gecko2')))
+        self.assertEqual('/b/two', builds.lookup(self.line('gaia3',
+                                                           'gecko40')))
+        self.assertFalse(builds.has(self.line('gaia3', 'gecko2')))
+        self.assertEqual(2, len(builds.builds))
+
+    def test_formats(self):
+        builds = self.write({'one': {'gaia': 'gaia1', 'gecko': 'gecko2'}})
+        builds.resolve(self.projects)
+        self.assertTrue(builds.has(self.line('gaia1', 'gecko2')))
+        builds = self.write({'builds': [{'path': 'one', 'revisions': {
+            'gaia': 'gaia1', 'gecko': 'gecko2'}}]})
+        builds.resolve(self.projects)
+        self.assertTrue(builds.has(self.line('gaia1', 'gecko2')))
+        for data in ('nope', [{'path': 'one'}]):
+            self.assertRaises(BuildIndexError, self.write, data)
+        os.remove(self.index)
+        self.assertRaises(BuildIndexError, BuildIndex, self.index)
+
+    def test_script(self):
+        builds = self.write({'one': {'gaia': 'gaia1', 'gecko': 'gecko2'}})
+        builds.resolve(self.projects)
+        script = ScriptEvaluator(
+            ['sh', '-c', 'test "$BISECT_ARTIFACT_HIT" = "%s" -a '
+             '-z "$BISECT_ARTIFACT_SAVE"' % os.path.join(self.loc, 'one')],
+            builds=builds)
+        self.assertTrue(script.is_cached(self.line('gaia1', 'gecko2')))
+        self.assertEqual(True, script.eval(self.line('gaia1', 'gecko2')))
+        self.assertEqual(False, script.eval(self.line('gaia3', 'gecko2')))
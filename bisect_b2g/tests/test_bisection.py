@@ -1,9 +1,13 @@
+import os
+import shutil
 import unittest
 import math
 
 from bisect_b2g.evaluator import Evaluator
 from bisect_b2g.bisection import Bisection
 from bisect_b2g.repository import Rev
+from bisect_b2g.results import ResultStore
+from bisect_b2g.tests.test_repository import make_temp_dir
 
 from mock import Mock, call
 
@@ -107,6 +111,13 @@ class BisectionTest(unittest.TestCase):
         self.assertEqual([5, 2, 1, 0], all_bad.order)
         self.validate_calls(all_bad.order)
 
+    def test_first_good(self):
+        all_bad = Bisection(
+            [self.project], self.history,
+            ConsistentEvaluator(False), first_good=True)
+        self.assertEqual(0, all_bad.found_i)
+        self.assertEqual([5, 2, 1], all_bad.order)
+
     def test_true_on_2_of_10(self):
         trues = (2,)
         count = 10
@@ -124,3 +135,172 @@ class BisectionTest(unittest.TestCase):
         self.validate_calls(bisect.order)
         self.assertEqual(3, bisect.found_i)
         self.assertEqual([5, 2, 3, 4], bisect.order)
+
+    def test_stored_results(self):
+        loc = make_temp_dir('TempResults')
+        self.addCleanup(shutil.rmtree, loc)
+        self.project.name = 'name'
+        path = os.path.join(loc, 'results')
+        first = Bisection([self.project], self.history,
+                          ConsistentEvaluator(False), ResultStore(path))
+        self.project.set_rev.reset_mock()
+        # Every line this bisection needs has been tested already
+        second = Bisection([self.project], self.history,
+                           OrderedEvaluator([], 1), ResultStore(path))
+        self.assertEqual(first.order, second.order)
+        self.assertEqual(0, second.found_i)
+        self.assertFalse(self.project.set_rev.called)
+
+
+class ThresholdEvaluator(Evaluator):
+    """Lines before the threshold pass, the rest fail"""
+
+    def __init__(self, threshold):
+        Evaluator.__init__(self)
+        self.threshold = threshold
+
+    def eval(self, line):
+        return line[0].hash < self.threshold
+
+
+class FakeRunner(object):
+
+    def __init__(self, evaluator, jobs):
+        object.__init__(self)
+        self.evaluator = evaluator
+        self.jobs = jobs
+        self.rounds = []
+
+    def evaluate(self, lines):
+        self.rounds.append([x[0].hash for x in lines])
+        return [self.evaluator.eval(x) for x in lines]
+
+
+class KaryBisectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Mock()
+
+    def build_history(self, count):
+        return [[Rev(x, self.project, None)] for x in range(count)]
+
+    def test_same_as_binary(self):
+        for count in range(1, 30):
+            history = self.build_history(count)
+            for threshold in range(count + 1):
+                evaluator = ThresholdEvaluator(threshold)
+                binary = Bisection([self.project], history, evaluator)
+                for jobs in range(2, 6):
+                    kary = Bisection([self.project], history, evaluator,
+                                     runner=FakeRunner(evaluator, jobs))
+                    self.assertEqual(binary.found_i, kary.found_i)
+
+    def test_rounds(self):
+        history = self.build_history(100)
+        evaluator = ThresholdEvaluator(42)
+        runner = FakeRunner(evaluator, 3)
+        bisect = Bisection([self.project], history, evaluator,
+                           runner=runner)
+        self.assertEqual(41, bisect.found_i)
+        self.assertEqual([[25, 50, 75], [31, 37, 43], [38, 40, 41],
+                          [42]], runner.rounds)
+        self.assertFalse(self.project.set_rev.called)
+        self.assertEqual(sum(runner.rounds, []), bisect.order)
+        self.assertEqual(sorted(bisect.order),
+                         sorted(bisect.pass_i + bisect.fail_i))
+        self.assertTrue(all(x < 42 for x in bisect.pass_i))
+        self.assertTrue(all(x >= 42 for x in bisect.fail_i))
+
+
+class SkippingEvaluator(ThresholdEvaluator):
+    """Like ThresholdEvaluator, but some lines can't be tested"""
+
+    def __init__(self, threshold, skipped):
+        ThresholdEvaluator.__init__(self, threshold)
+        self.skipped = skipped
+
+    def eval(self, line):
+        if line[0].hash in self.skipped:
+            return None
+        return ThresholdEvaluator.eval(self, line)
+
+
+class SkipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Mock()
+
+    def build_history(self, count):
+        return [[Rev(x, self.project, None)] for x in range(count)]
+
+    def bisections(self, history, evaluator):
+        yield Bisection([self.project], history, evaluator)
+        for jobs in range(2, 5):
+            yield Bisection([self.project], history, evaluator,
+                            runner=FakeRunner(evaluator, jobs))
+
+    def test_skip_around(self):
+        for count in range(2, 20):
+            history = self.build_history(count)
+            for threshold in range(1, count):
+                # Everything but the lines either side of the change
+                skipped = set(range(count)) - set([threshold - 1, threshold])
+                evaluator = SkippingEvaluator(threshold, skipped)
+                for bisect in self.bisections(history, evaluator):
+                    self.assertEqual(threshold - 1, bisect.found_i)
+                    self.assertEqual([], [x for x in bisect.pass_i +
+                                          bisect.fail_i if x in skipped])
+
+    def test_skip_middle(self):
+        history = self.build_history(10)
+        bisect = Bisection([self.project], history,
+                           SkippingEvaluator(4, set([5])))
+        self.assertEqual(3, bisect.found_i)
+        self.assertEqual([5, 6, 3, 4], bisect.order)
+        self.assertEqual([5], bisect.skip_i)
+
+    def test_all_skipped(self):
+        history = self.build_history(10)
+        evaluator = SkippingEvaluator(4, set(range(1, 10)))
+        for bisect in self.bisections(history, evaluator):
+            # Nothing after the first line could be told apart
+            self.assertEqual(0, bisect.found_i)
+            self.assertEqual([], bisect.pass_i + bisect.fail_i)
+
+
+class FakeArtifacts(object):
+
+    def __init__(self, cached):
+        object.__init__(self)
+        self.cached = cached
+
+    def has(self, line):
+        return line[0].hash in self.cached
+
+
+class CheapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Mock()
+        self.history = [[Rev(x, self.project, None)] for x in range(100)]
+
+    def evaluator(self, cached):
+        evaluator = ThresholdEvaluator(42)
+        evaluator.artifacts = FakeArtifacts(cached)
+        return evaluator
+
+    def test_cheap_first(self):
+        bisect = Bisection([self.project], self.history,
+                           self.evaluator(set([47, 30])))
+        self.assertEqual(41, bisect.found_i)
+        # 30 is too far from the middle to be worth it
+        self.assertEqual(47, bisect.order[0])
+        self.assertFalse(30 in bisect.order)
+
+    def test_cheap_kary(self):
+        evaluator = self.evaluator(set([23, 52]))
+        runner = FakeRunner(evaluator, 3)
+        bisect = Bisection([self.project], self.history, evaluator,
+                           runner=runner)
+        self.assertEqual(41, bisect.found_i)
+        self.assertEqual([23, 52, 75], runner.rounds[0])
@@ -0,0 +1,53 @@
+import unittest
+
+from mock import Mock
+
+from bisect_b2g.checkout import CheckoutPlanner
+from bisect_b2g.repository import Rev
+
+
+class FakeProject(object):
+
+    def __init__(self, name, at):
+        object.__init__(self)
+        self.name = name
+        self.at = at
+        self.set_revs = []
+
+    def get_rev(self):
+        return self.at
+
+    def set_rev(self, rev):
+        self.set_revs.append(rev)
+        self.at = rev
+
+
+class CheckoutPlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.projects = [FakeProject(x, 'old') for x in ('a', 'b', 'c')]
+        self.planner = CheckoutPlanner()
+
+    def tearDown(self):
+        self.planner.close()
+
+    def line(self, *hashes):
+        return [Rev(h, p, None) for h, p in zip(hashes, self.projects)]
+
+    def test_plan(self):
+        line = self.line('old', 'new', 'old')
+        self.assertEqual([line[1]], self.planner.plan(line))
+
+    def test_apply(self):
+        self.planner.apply(self.line('1', '1', '1'))
+        self.planner.apply(self.line('1', '2', '1'))
+        self.planner.apply(self.line('3', '2', '3'))
+        self.assertEqual(['1', '3'], self.projects[0].set_revs)
+        self.assertEqual(['1', '2'], self.projects[1].set_revs)
+        self.assertEqual(['1', '3'], self.projects[2].set_revs)
+
+    def test_unknown_state(self):
+        self.projects[0].get_rev = Mock(side_effect=Exception("broken"))
+        self.planner.apply(self.line('old', 'old', 'old'))
+        self.assertEqual(['old'], self.projects[0].set_revs)
+        self.assertEqual([], self.projects[1].set_revs)
@@ -0,0 +1,102 @@
+import os
+import shutil
+import hashlib
+import unittest
+
+from bisect_b2g.commitindex import CommitIndex
+from bisect_b2g.util import StoreError
+from bisect_b2g.tests.test_repository import make_temp_dir
+
+
+def fake_hash(i):
+    return hashlib.sha1(str(i)).hexdigest()
+
+
+class FakeRepository(object):
+    """A linear history of commits 0..count-1, newest last"""
+
+    def __init__(self, count, broken=False):
+        object.__init__(self)
+        self.name = 'fake'
+        self.commits = [(fake_hash(i), 1000 + i, 3600) for i in range(count)]
+        self.broken = broken
+        self.walked = 0
+
+    def full_hash(self, rev):
+        return rev
+
+    def _walk(self, start, end):
+        hashes = [x[0] for x in self.commits]
+        for rev in reversed(self.commits[:hashes.index(end) + 1]):
+            self.walked += 1
+            yield rev
+            if rev[0] == start:
+                return
+
+    def iter_revs(self, start, end):
+        if self.broken:
+            raise StoreError("Can't read this")
+        return self._walk(start, end)
+
+    def iter_revs_vcs(self, start, end):
+        return self._walk(start, end)
+
+    def rev_tuples(self, start, end):
+        # Not a first parent walk, so the index mustn't learn from it
+        revs = list(self.iter_revs_vcs(start, end))
+        return revs[:1] + [('side', 0, 0)] + revs[1:]
+
+
+class CommitIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempCommitIndex')
+        self.path = os.path.join(self.loc, 'index', 'commits.sqlite')
+        self.index = CommitIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.loc)
+
+    def test_rev_tuples(self):
+        repo = FakeRepository(10)
+        revs = self.index.rev_tuples(repo, fake_hash(2), fake_hash(8))
+        self.assertEqual(list(reversed(repo.commits[2:9])), revs)
+
+    def test_cached_range(self):
+        repo = FakeRepository(10)
+        self.index.rev_tuples(repo, fake_hash(2), fake_hash(8))
+        repo.walked = 0
+        revs = self.index.rev_tuples(repo, fake_hash(4), fake_hash(6))
+        self.assertEqual(list(reversed(repo.commits[4:7])), revs)
+        self.assertEqual(0, repo.walked)
+
+    def test_incremental_update(self):
+        repo = FakeRepository(10)
+        self.index.rev_tuples(repo, fake_hash(0), fake_hash(5))
+        repo.walked = 0
+        revs = self.index.rev_tuples(repo, fake_hash(0), fake_hash(9))
+        self.assertEqual(list(reversed(repo.commits)), revs)
+        # Only the new commits and the newest known one are walked
+        self.assertEqual(5, repo.walked)
+
+    def test_incomplete_ancestry(self):
+        repo = FakeRepository(10)
+        self.index.rev_tuples(repo, fake_hash(4), fake_hash(6))
+        revs = self.index.rev_tuples(repo, fake_hash(1), fake_hash(8))
+        self.assertEqual(list(reversed(repo.commits[1:9])), revs)
+        self.assertEqual(None, self.index.db.execute(
+            "SELECT * FROM commits WHERE hash = 'side'").fetchone())
+
+    def test_vcs_fallback(self):
+        repo = FakeRepository(5, broken=True)
+        revs = self.index.rev_tuples(repo, fake_hash(0), fake_hash(4))
+        self.assertEqual(list(reversed(repo.commits)), revs)
+
+    def test_persistent(self):
+        repo = FakeRepository(5)
+        self.index.rev_tuples(repo, fake_hash(0), fake_hash(4))
+        self.index.close()
+        self.index = CommitIndex(self.path)
+        self.assertEqual(list(reversed(repo.commits)),
+                         self.index.chain(fake_hash(0), fake_hash(4)))
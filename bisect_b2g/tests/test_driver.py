@@ -2,8 +2,12 @@
 
 import unittest
 import os
+import shutil
 
 import bisect_b2g.driver as driver
+from bisect_b2g.mirror import MirrorCache
+from bisect_b2g.tests.test_repository import TempGitRepository, \
+    make_temp_dir
 
 
 class SimpleFunctionTests(unittest.TestCase):
@@ -140,3 +144,57 @@ class ParseArgTests(ArgTests):
         self.assertRaises(driver.InvalidArg,
                           driver.parse_arg,
                           (bad_uri))
+
+
+class SetupProjectsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.t_repos = [TempGitRepository(revision_names=['A', 'B', 'C'])
+                        for x in range(3)]
+
+    def tearDown(self):
+        for t_repo in self.t_repos:
+            shutil.rmtree(t_repo.location)
+
+    def repo_data(self, t_repo, good='A', bad='C'):
+        return {'name': os.path.basename(t_repo.location), 'vcs': 'git',
+                'uri': t_repo.location, 'local_path': t_repo.location,
+                'good': good, 'bad': bad}
+
+    def test_order(self):
+        repo_datas = [self.repo_data(x) for x in self.t_repos]
+        projects = driver.setup_projects(repo_datas, 2)
+        self.assertEqual([x['name'] for x in repo_datas],
+                         [x.name for x in projects])
+        for project, t_repo in zip(projects, self.t_repos):
+            self.assertEqual([x['commit'] for x in t_repo.revisions],
+                             [x[0] for x in project.rev_list()])
+            project.close()
+
+    def test_errors(self):
+        repo_datas = [self.repo_data(self.t_repos[0], good='nope'),
+                      self.repo_data(self.t_repos[1]),
+                      self.repo_data(self.t_repos[2], bad='nope')]
+        try:
+            driver.setup_projects(repo_datas, 3)
+        except driver.ProjectSetupError as e:
+            self.assertEqual([repo_datas[0]['name'], repo_datas[2]['name']],
+                             [x[0] for x in e.failures])
+            self.assertTrue(repo_datas[2]['name'] in str(e))
+        else:
+            self.fail("No ProjectSetupError")
+
+    def test_mirror_cache(self):
+        loc = make_temp_dir('TempSetup')
+        self.addCleanup(shutil.rmtree, loc)
+        cache = MirrorCache(os.path.join(loc, 'cache'))
+        repo_datas = [self.repo_data(x) for x in self.t_repos[:2]]
+        for i, repo_data in enumerate(repo_datas):
+            repo_data['local_path'] = os.path.join(loc, str(i))
+        projects = driver.setup_projects(repo_datas, 2, mirror_cache=cache)
+        self.assertEqual(2, len([x for x in os.listdir(cache.path)
+                                 if x.endswith('.git')]))
+        for project, t_repo in zip(projects, self.t_repos):
+            self.assertEqual(t_repo.revisions[-1]['commit'],
+                             project.get_rev())
+            project.close()
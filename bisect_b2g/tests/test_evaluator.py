@@ -18,6 +18,167 @@ class ScriptEvaluatorTests(unittest.TestCase):
         se = evaluator.ScriptEvaluator(script=[dumbo, '--exit-code', str(1)])
         self.assertEqual(False, se.eval(object()))
 
+    def test_timeout(self):
+        se = evaluator.ScriptEvaluator(script=['sleep', '30'], timeout=0.2)
+        self.assertEqual(None, se.eval(object()))
+        se.timeout_outcome = False
+        self.assertEqual(False, se.eval(object()))
+
+    def test_log(self):
+        with tempfile.NamedTemporaryFile() as f:
+            se = evaluator.ScriptEvaluator(
+                script=[dumbo, 'STDOUT:out', 'STDERR:err', '--exit-code',
+                        '0'], log_path=f.name)
+            self.assertEqual(True, se.eval(object()))
+            self.assertEqual(True, se.eval_in(object(), os.getcwd()))
+            lines = f.read().splitlines()
+        self.assertEqual(['out', 'err'], lines[1:3])
+        self.assertEqual('[%s] out' % os.getcwd(), lines[4])
+
+    def test_sparse_paths(self):
+        se = evaluator.ScriptEvaluator(script=[dumbo, '--exit-code', str(0)])
+        self.assertEqual(None, se.sparse_paths())
+        with tempfile.NamedTemporaryFile() as f:
+            f.write('#!/bin/sh\n# bisect_b2g-path: gaia/apps/*\n'
+                    '#bisect_b2g-path:gecko/dom \ngrep x gaia/apps/x\n')
+            f.flush()
+            se = evaluator.ScriptEvaluator(script=f.name)
+            self.assertEqual(['gaia/apps/*', 'gecko/dom'], se.sparse_paths())
+
+
+class FakeProject(object):
+
+    def __init__(self, name, files):
+        object.__init__(self)
+        self.name = name
+        self.local_path = name
+        self.repository = self
+        self.files = files
+
+    def read_file(self, rev, path):
+        return self.files.get((rev, path))
+
+
+class FakeRev(object):
+
+    def __init__(self, prj, hash, date=None):
+        object.__init__(self)
+        self.prj = prj
+        self.hash = hash
+        self.date = date
+
+
+class PythonEvaluatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.line = [
+            FakeRev(FakeProject('gaia', {('a', 'apps/x'): 'x'}), 'a'),
+            FakeRev(FakeProject('gecko', {('b', 'dom/y'): 'y'}), 'b'),
+        ]
+
+    def test_line_files(self):
+        files = evaluator.LineFiles(self.line)
+        self.assertEqual('x', files.read('gaia/apps/x'))
+        self.assertEqual('y', files.read('gecko/./dom/y'))
+        self.assertFalse(files.exists('gecko/dom/x'))
+        self.assertRaises(evaluator.EvaluatorError, files.read, 'other/x')
+
+    def test_eval(self):
+        pe = evaluator.PythonEvaluator(lambda x: x.read('gaia/apps/x'))
+        self.assertFalse(pe.needs_checkout)
+        self.assertEqual(True, pe.eval(self.line))
+        self.line[0].hash = 'c'
+        self.assertEqual(False, pe.eval_in(self.line, 'elsewhere'))
+
+    def test_load_function(self):
+        self.assertTrue(evaluator.load_function('os.path:join')
+                        is os.path.join)
+        with tempfile.NamedTemporaryFile(suffix='.py') as f:
+            f.write('def check(files):\n    return 42\n')
+            f.flush()
+            self.assertEqual(42, evaluator.load_function(
+                f.name + ':check')(None))
+        for spec in ('os.path', 'os.path:nope', 'no_such_module:f'):
+            self.assertRaises(evaluator.EvaluatorError,
+                              evaluator.load_function, spec)
+
+
+# Answers with the hash it's given, except for a few special ones, and
+# writes down which process saw which line
+harness_script = '''
+import os, sys, json, time
+seen = open(sys.argv[1], 'a')
+for line in iter(sys.stdin.readline, ''):
+    message = json.loads(line)
+    rev = message['revisions'][0]
+    seen.write('%d %s %s\\n' % (os.getpid(), rev['hash'], rev['path']))
+    seen.flush()
+    if rev['hash'] == 'crash':
+        sys.exit(1)
+    elif rev['hash'] == 'hang':
+        time.sleep(30)
+    print 'not a verdict'
+    print json.dumps({'verdict': rev['hash']})
+    sys.stdout.flush()
+'''
+
+
+class HarnessEvaluatorTests(unittest.TestCase):
+
+    def setUp(self):
+        script = tempfile.NamedTemporaryFile(suffix='.py')
+        script.write(harness_script)
+        script.flush()
+        self.addCleanup(script.close)
+        self.seen = tempfile.NamedTemporaryFile()
+        self.addCleanup(self.seen.close)
+        self.he = evaluator.HarnessEvaluator(
+            [sys.executable, script.name, self.seen.name], timeout=5)
+        self.addCleanup(self.he.close)
+
+    def line(self, hash):
+        return [FakeRev(FakeProject('gaia', {}), hash)]
+
+    def seen_lines(self):
+        self.seen.seek(0)
+        return [x.split() for x in self.seen.read().splitlines()]
+
+    def test_verdicts(self):
+        self.assertEqual(True, self.he.eval(self.line('pass')))
+        self.assertEqual(False, self.he.eval(self.line('fail')))
+        self.assertEqual(None, self.he.eval(self.line('skip')))
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, workdir)
+        self.assertEqual(True, self.he.eval_in(self.line('good'), workdir))
+        self.assertRaises(evaluator.HarnessError, self.he.eval,
+                          self.line('maybe'))
+        seen = self.seen_lines()
+        # The same harness saw all of them, but the workspace got its own
+        self.assertEqual(1, len(set(x[0] for x in seen if x[1] != 'good')))
+        self.assertEqual(os.path.abspath('gaia'), seen[0][2])
+        self.assertEqual(os.path.join(workdir, 'gaia'), seen[3][2])
+        self.assertNotEqual(seen[0][0], seen[3][0])
+
+    def test_crash(self):
+        self.assertRaises(evaluator.HarnessError, self.he.eval,
+                          self.line('crash'))
+        self.assertEqual(True, self.he.eval(self.line('pass')))
+        self.assertEqual(False, self.he.eval(self.line('crash')))
+        self.assertEqual(True, self.he.eval(self.line('pass')))
+        # Started again after each crash
+        self.assertEqual(5, len(set(x[0] for x in self.seen_lines())))
+
+    def test_timeout(self):
+        self.he.timeout = 0.5
+        self.assertEqual(True, self.he.eval(self.line('pass')))
+        self.assertEqual(None, self.he.eval(self.line('hang')))
+        self.assertEqual(True, self.he.eval(self.line('pass')))
+        pids = [x[0] for x in self.seen_lines()]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.he.timeout_outcome = False
+        self.assertEqual(False, self.he.eval(self.line('hang')))
+
 
 class InteractiveEvaluatorTests(unittest.TestCase):
 
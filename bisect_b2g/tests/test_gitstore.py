@@ -0,0 +1,153 @@
+import os
+import shutil
+import unittest
+
+from bisect_b2g.util import run_cmd
+from bisect_b2g import gitstore
+from bisect_b2g.tests.test_repository import TempGitRepository
+
+
+class DeltaTests(unittest.TestCase):
+
+    def test_copy_and_insert(self):
+        base = 'hello world'
+        # src size 11, dst size 12, copy 6 bytes from 0, insert 'there!'
+        delta = '\x0b\x0c' + '\x90\x06' + '\x06there!'
+        self.assertEqual('hello there!', gitstore.apply_delta(base, delta))
+
+    def test_wrong_base(self):
+        self.assertRaises(gitstore.GitStoreError,
+                          gitstore.apply_delta, 'abc', '\x0b\x00')
+
+
+class CommitParseTests(unittest.TestCase):
+
+    def test_parse_commit(self):
+        data = ('tree %s\nparent %s\nparent %s\n' % ('a' * 40, 'b' * 40,
+                                                     'c' * 40) +
+                'author A <a@b> 1000 +0100\n'
+                'committer C <c@d> 2000 -0730\n\nmessage\n')
+        parent, epoch, offset = gitstore.parse_commit(data)
+        self.assertEqual('\xbb' * 20, parent)
+        self.assertEqual(2000, epoch)
+        self.assertEqual(-(7 * 3600 + 30 * 60), offset)
+
+
+class FirstParentWalkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.t_repo = TempGitRepository(revision_names=range(20))
+        self.loc = self.t_repo.location
+        self.revs = self.t_repo.revisions
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def walk(self, start=None, end=None, tz=True):
+        store = gitstore.GitObjectStore(gitstore.find_git_dir(self.loc))
+        return list(store.first_parent_walk(
+            end or self.revs[-1]['commit'], start, tz))
+
+    def check(self, walked, first=0):
+        expected = list(reversed(self.revs[first:]))
+        self.assertEqual([x['commit'] for x in expected],
+                         [x[0] for x in walked])
+        for rev, (hash, epoch, offset) in zip(expected, walked):
+            self.assertEqual(rev['date'].utcoffset().days * 86400 +
+                             rev['date'].utcoffset().seconds, offset)
+
+    def test_loose_objects(self):
+        self.check(self.walk())
+        self.check(self.walk(self.revs[5]['commit']), 5)
+
+    def test_packed_objects(self):
+        run_cmd(['git', 'gc', '-q', '--aggressive'], workdir=self.loc)
+        head = self.revs[-1]['commit']
+        self.assertFalse(os.path.exists(os.path.join(
+            self.loc, '.git', 'objects', head[:2], head[2:])))
+        self.check(self.walk(self.revs[3]['commit']), 3)
+
+    def test_commit_graph(self):
+        run_cmd(['git', 'gc', '-q'], workdir=self.loc)
+        run_cmd(['git', 'commit-graph', 'write', '--reachable'],
+                workdir=self.loc)
+        store = gitstore.GitObjectStore(gitstore.find_git_dir(self.loc))
+        self.assertNotEqual(None, store.graph)
+        self.check(self.walk())
+        without_tz = self.walk(tz=False)
+        self.assertEqual([x[:2] for x in self.walk()],
+                         [x[:2] for x in without_tz])
+
+    def test_split_commit_graph(self):
+        # The older layer has the first ten commits
+        older = os.path.join(self.loc, 'older')
+        with open(older, 'w') as f:
+            f.write(self.revs[9]['commit'] + '\n')
+        with open(older) as f:
+            run_cmd(['git', 'commit-graph', 'write', '--split',
+                     '--stdin-commits'], workdir=self.loc, stdin=f)
+        run_cmd(['git', 'commit-graph', 'write', '--reachable',
+                 '--split=no-merge'], workdir=self.loc)
+        store = gitstore.GitObjectStore(gitstore.find_git_dir(self.loc))
+        self.assertEqual(2, len(store.graph.layers))
+        self.check(self.walk())
+        self.check(self.walk(self.revs[12]['commit']), 12)
+
+    def test_cached_offsets(self):
+        run_cmd(['git', 'commit-graph', 'write', '--reachable'],
+                workdir=self.loc)
+        path = os.path.join(self.loc, 'offsets.bin')
+        git_dir = gitstore.find_git_dir(self.loc)
+        store = gitstore.GitObjectStore(git_dir, path)
+        list(store.first_parent_walk(self.revs[-1]['commit']))
+        # Everything comes from the commit-graph and the cache now
+        store = gitstore.GitObjectStore(git_dir, path)
+        store.read_commit = None
+        self.check(list(store.first_parent_walk(self.revs[-1]['commit'])))
+
+    def test_not_an_ancestor(self):
+        run_cmd(['git', 'checkout', '-q', '-b', 'side',
+                 self.revs[2]['commit']], workdir=self.loc)
+        with open(os.path.join(self.loc, 'side'), 'w') as f:
+            f.write('side')
+        run_cmd(['git', 'add', 'side'], workdir=self.loc)
+        run_cmd(['git', 'commit', '-q', '-m', 'side'], workdir=self.loc)
+        side = run_cmd(['git', 'rev-parse', 'HEAD'],
+                       workdir=self.loc)[1].strip()
+        self.assertRaises(gitstore.GitStoreError, self.walk, side)
+
+
+class ReadHeadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.t_repo = TempGitRepository(revision_names=range(3))
+        self.loc = self.t_repo.location
+        self.git_dir = gitstore.find_git_dir(self.loc)
+        self.revs = [x['commit'] for x in self.t_repo.revisions]
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def test_branch(self):
+        self.assertEqual(self.revs[-1], gitstore.read_head(self.git_dir))
+
+    def test_detached(self):
+        run_cmd(['git', 'checkout', '-q', self.revs[0]], workdir=self.loc)
+        self.assertEqual(self.revs[0], gitstore.read_head(self.git_dir))
+
+    def test_packed_refs(self):
+        run_cmd(['git', 'pack-refs', '--all'], workdir=self.loc)
+        self.assertEqual(self.revs[-1], gitstore.read_head(self.git_dir))
+
+    def test_worktree(self):
+        worktree = self.loc + '-worktree'
+        run_cmd(['git', 'worktree', 'add', '--detach', worktree,
+                 self.revs[1]], workdir=self.loc)
+        self.addCleanup(shutil.rmtree, worktree)
+        self.assertEqual(self.revs[1], gitstore.read_head(
+            gitstore.find_git_dir(worktree)))
+
+    def test_unborn_branch(self):
+        run_cmd(['git', 'checkout', '-q', '--orphan', 'empty'],
+                workdir=self.loc)
+        self.assertEqual(None, gitstore.read_head(self.git_dir))
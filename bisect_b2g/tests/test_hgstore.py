@@ -0,0 +1,86 @@
+import os
+import shutil
+import struct
+import binascii
+import unittest
+
+from bisect_b2g.util import run_cmd
+from bisect_b2g import hgstore
+from bisect_b2g.tests.test_repository import make_temp_dir
+
+
+class PatchTests(unittest.TestCase):
+
+    def test_apply_patch(self):
+        patch = struct.pack('>lll', 0, 5, 3) + 'bye' + \
+            struct.pack('>lll', 6, 6, 1) + '!'
+        self.assertEqual('bye !world',
+                         hgstore.apply_patch('hello world', patch))
+
+    def test_parse_changeset(self):
+        text = 'a' * 40 + '\nuser\n1000 25200\nfile\n\ndescription'
+        self.assertEqual((1000, -25200), hgstore.parse_changeset(text))
+
+
+class ChangelogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempHgStore')
+        run_cmd(['hg', 'init', '--config',
+                 'format.revlog-compression=zlib', self.loc])
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def commit(self, name, message=None, date='1000 25200', filename='file'):
+        with open(os.path.join(self.loc, filename), 'w') as f:
+            f.write(name)
+        run_cmd(['hg', 'commit', '-A', '-d', date, '-m', message or name],
+                workdir=self.loc)
+        return run_cmd(['hg', 'log', '-r', '.', '--template', '{node}'],
+                       workdir=self.loc)[1]
+
+    def test_walk(self):
+        nodes = [self.commit(str(x), date='%d 25200' % (1000 + x))
+                 for x in range(5)]
+        walked = list(hgstore.Changelog(self.loc).first_parent_walk(
+            nodes[-1], nodes[1]))
+        self.assertEqual(list(reversed(nodes[1:])), [x[0] for x in walked])
+        self.assertEqual((1004, -25200), walked[0][1:])
+
+    def test_walk_to_root(self):
+        nodes = [self.commit(str(x)) for x in range(3)]
+        walked = list(hgstore.Changelog(self.loc).first_parent_walk(
+            nodes[-1]))
+        self.assertEqual(list(reversed(nodes)), [x[0] for x in walked])
+
+    def test_split_index_and_data(self):
+        nodes = [self.commit(str(x), binascii.hexlify(os.urandom(40000)))
+                 for x in range(4)]
+        self.assertTrue(os.path.exists(
+            os.path.join(self.loc, '.hg', 'store', '00changelog.d')))
+        walked = list(hgstore.Changelog(self.loc).first_parent_walk(
+            nodes[-1], nodes[0]))
+        self.assertEqual(list(reversed(nodes)), [x[0] for x in walked])
+
+    def test_first_parent_only(self):
+        base = self.commit('base')
+        side = self.commit('side', filename='side')
+        run_cmd(['hg', 'update', '-q', base], workdir=self.loc)
+        main = self.commit('main')
+        run_cmd(['hg', 'merge', '-q', '--tool', 'internal:fail', side],
+                workdir=self.loc)
+        merge = self.commit('merge')
+        walked = list(hgstore.Changelog(self.loc).first_parent_walk(
+            merge, base))
+        self.assertEqual([merge, main, base], [x[0] for x in walked])
+        self.assertRaises(hgstore.HgStoreError, list,
+                          hgstore.Changelog(self.loc).first_parent_walk(
+                              merge, side))
+
+    def test_dirstate_parent(self):
+        self.assertEqual('0' * 40, hgstore.read_dirstate_parent(self.loc))
+        nodes = [self.commit(str(x)) for x in range(3)]
+        self.assertEqual(nodes[-1], hgstore.read_dirstate_parent(self.loc))
+        run_cmd(['hg', 'update', '-q', nodes[0]], workdir=self.loc)
+        self.assertEqual(nodes[0], hgstore.read_dirstate_parent(self.loc))
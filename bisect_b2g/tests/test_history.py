@@ -0,0 +1,194 @@
+import unittest
+import datetime
+import random
+import tempfile
+
+from bisect_b2g import history
+from bisect_b2g.util import FixedOffset
+
+
+class FakeProject(object):
+
+    def __init__(self, name, dates):
+        object.__init__(self)
+        self.name = name
+        start = datetime.datetime(2013, 1, 1, tzinfo=FixedOffset(-25200))
+        self.revs = [("%s%d" % (name, d),
+                      start + datetime.timedelta(seconds=d)) for d in dates]
+
+    def rev_list(self):
+        return self.revs
+
+    def full_rev_list(self):
+        return self.revs
+
+    def resolve_tag(self, rev=None):
+        return rev
+
+
+def reference_history(projects):
+    # This is how history used to be built, kept to check that the merge
+    # still generates exactly the same lines
+    def create_line(exhausted_heads, heads):
+        line = sorted(exhausted_heads + heads, key=lambda x: x.date)
+        oldest_head = line[0]
+        oldest_head_i = heads.index(oldest_head)
+        if oldest_head.next_rev is None:
+            exhausted_heads.append(oldest_head)
+            del heads[oldest_head_i]
+        else:
+            heads[oldest_head_i] = heads[oldest_head_i].next_rev
+        return sorted(line, key=lambda x: x.prj.name)
+
+    output = []
+    exhausted_heads = []
+    heads = [history.make_revision_linked_list(x) for x in projects]
+    while len(heads) > (len(heads) + len(exhausted_heads) - 1):
+        output.append(create_line(exhausted_heads, heads))
+    return output
+
+
+def hashes(lines):
+    return [[x.hash for x in line] for line in lines]
+
+
+class InterleaveTests(unittest.TestCase):
+
+    def test_readme_example(self):
+        a = FakeProject('A', [1, 3, 5])
+        b = FakeProject('B', [2, 4, 6])
+        self.assertEqual(
+            [['A1', 'B2'], ['A3', 'B2'], ['A3', 'B4'], ['A5', 'B4'],
+             ['A5', 'B6']],
+            hashes(history.build_history([a, b])))
+
+    def test_lines_sorted_by_name(self):
+        b = FakeProject('B', [1, 3])
+        a = FakeProject('A', [2, 4])
+        self.assertEqual(
+            [['A2', 'B1'], ['A2', 'B3'], ['A4', 'B3']],
+            hashes(history.build_history([b, a])))
+
+    def test_ties_go_to_first_project(self):
+        a = FakeProject('A', [1, 2, 3])
+        b = FakeProject('B', [1, 2, 3])
+        self.assertEqual(
+            hashes(reference_history([b, a])),
+            hashes(history.build_history([b, a])))
+
+    def test_matches_reference(self):
+        rand = random.Random(1234)
+        for attempt in range(20):
+            projects = []
+            for name in 'DCBA'[:rand.randint(1, 4)]:
+                dates = sorted(rand.sample(range(60), rand.randint(1, 15)))
+                projects.append(FakeProject(name, dates))
+            self.assertEqual(
+                hashes(reference_history(projects)),
+                hashes(history.build_history(projects)))
+
+    def test_interleave_is_lazy(self):
+        columns = [[1, 3, 5], [2, 4, 6]]
+        lines = history.interleave(columns)
+        self.assertEqual([0, 0], next(lines))
+        self.assertEqual([1, 0], next(lines))
+
+    def test_interleave_empty_column(self):
+        self.assertEqual([], list(history.interleave([[1, 2], []])))
+
+
+class CompactHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.projects = [
+            FakeProject('B', [1, 4, 7, 8]),
+            FakeProject('A', [2, 3, 5, 9]),
+            FakeProject('C', [0, 6]),
+        ]
+        self.expected = hashes(history.build_history(self.projects))
+
+    def test_same_lines_as_build_history(self):
+        compact = history.build_compact_history(self.projects)
+        self.assertEqual(len(self.expected), len(compact))
+        self.assertEqual(self.expected, hashes(compact))
+
+    def test_mmap_backed(self):
+        with tempfile.NamedTemporaryFile() as f:
+            compact = history.build_compact_history(self.projects, f.name)
+            self.assertEqual(self.expected, hashes(compact))
+
+    def test_dates_survive(self):
+        compact = history.build_compact_history(self.projects)
+        full = history.build_history(self.projects)
+        self.assertEqual(full[3], compact[3])
+        self.assertEqual(full[3][0].date.utcoffset(),
+                         compact[3][0].date.utcoffset())
+
+    def test_slicing(self):
+        compact = history.build_compact_history(self.projects)
+        self.assertEqual(self.expected[2:], hashes(compact[2:]))
+        self.assertEqual(self.expected[:3], hashes(compact[:3]))
+        self.assertEqual(self.expected[1:][:2], hashes(compact[1:][:2]))
+        self.assertEqual(self.expected[-1], hashes([compact[-1]])[0])
+        self.assertEqual(self.expected[::2], hashes(compact[::2]))
+        self.assertRaises(IndexError, compact.__getitem__, len(compact))
+
+    def test_index(self):
+        compact = history.build_compact_history(self.projects)
+        self.assertEqual(4, compact.index(compact[4]))
+        self.assertEqual(1, compact[3:].index(compact[4]))
+
+
+class RefineHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.a = FakeProject('A', [1, 5, 9])
+        self.b = FakeProject('B', [2, 3, 4, 6, 7, 8])
+        self.full_b = self.b.revs
+        # B's history was cut down to the last revision of each push
+        self.b.revs = [self.full_b[0], self.full_b[2], self.full_b[-1]]
+        self.b.full_rev_list = lambda: self.full_b
+        self.history = history.build_history([self.a, self.b])
+
+    def test_refine(self):
+        self.assertEqual([['A1', 'B2'], ['A5', 'B2'], ['A5', 'B4'],
+                          ['A5', 'B8'], ['A9', 'B8']], hashes(self.history))
+        self.assertEqual([['A5', 'B2'], ['A5', 'B3'], ['A5', 'B4']],
+                         hashes(history.refine_history(self.history, 1)))
+        self.assertEqual([['A5', 'B4'], ['A5', 'B6'], ['A5', 'B7'],
+                          ['A5', 'B8']],
+                         hashes(history.refine_history(self.history, 2)))
+
+    def test_nothing_to_refine(self):
+        # A moves a single revision, and there's nothing after the end
+        self.assertEqual(None, history.refine_history(self.history, 0))
+        self.assertEqual(None, history.refine_history(self.history, 3))
+        self.assertEqual(None, history.refine_history(self.history, 4))
+
+
+class PrebuiltTests(unittest.TestCase):
+
+    def setUp(self):
+        self.history = history.build_history([
+            FakeProject('A', [1, 3, 5, 7, 9]),
+            FakeProject('B', [2, 4, 6, 8])])
+        self.built = [['A3', 'B2'], ['A5', 'B6'], ['A9', 'B8']]
+
+    def has_build(self, line):
+        return [x.hash for x in line] in self.built
+
+    def test_prebuilt_lines(self):
+        indices = history.prebuilt_lines(self.history, self.has_build)
+        # The first line is always there and the last never is
+        self.assertEqual([['A1', 'B2'], ['A3', 'B2'], ['A5', 'B6']],
+                         hashes([self.history[x] for x in indices]))
+
+    def test_build_gap(self):
+        indices = history.prebuilt_lines(self.history, self.has_build)
+        start, gap = history.build_gap(self.history, indices, 1)
+        self.assertEqual(1, start)
+        self.assertEqual([['A3', 'B2'], ['A3', 'B4'], ['A5', 'B4'],
+                          ['A5', 'B6']], hashes(gap))
+        start, gap = history.build_gap(self.history, indices, 2)
+        self.assertEqual(4, start)
+        self.assertEqual(self.history[4:], gap)
@@ -0,0 +1,88 @@
+import os
+import shutil
+import unittest
+
+from bisect_b2g.util import run_cmd
+from bisect_b2g.mirror import MirrorCache
+from bisect_b2g.repository import Project
+from bisect_b2g.gitstore import GitObjectStore
+from bisect_b2g.tests.test_repository import TempGitRepository, \
+    TempHgRepository, make_temp_dir
+
+
+class MirrorCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempMirrors')
+        self.cache = MirrorCache(os.path.join(self.loc, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def source(self, fake_cls):
+        t_repo = fake_cls(revision_names=['A', 'B', 'C'])
+        self.addCleanup(shutil.rmtree, t_repo.location)
+        return t_repo
+
+    def project(self, t_repo, vcs, name='cloned'):
+        mirror = self.cache.update(t_repo.location, vcs, 'source')
+        project = Project(name, t_repo.location,
+                          os.path.join(self.loc, name),
+                          t_repo.revisions[0]['commit'],
+                          t_repo.revisions[-1]['commit'],
+                          vcs=vcs, use_index=False, mirror=mirror)
+        self.addCleanup(project.close)
+        return project
+
+    def check(self, project, t_repo):
+        self.assertEqual([x['commit'] for x in t_repo.revisions],
+                         [x[0] for x in project.rev_list()])
+        project.set_rev(t_repo.revisions[1]['commit'])
+        with open(os.path.join(project.local_path, 'file')) as f:
+            self.assertEqual('B', f.read())
+
+    def test_urls_dont_collide(self):
+        self.assertNotEqual(
+            self.cache.mirror_path('file:///a/source', 'git', 'source'),
+            self.cache.mirror_path('file:///b/source', 'git', 'source'))
+
+    def test_git(self):
+        t_repo = self.source(TempGitRepository)
+        project = self.check_alternates(t_repo)
+        self.check(project, t_repo)
+
+    def check_alternates(self, t_repo):
+        project = self.project(t_repo, 'git')
+        git_dir = project.repository.repo.git_dir
+        self.assertTrue(os.path.exists(
+            os.path.join(git_dir, 'objects', 'info', 'alternates')))
+        # The clone doesn't have its own copy of the history
+        store = GitObjectStore(git_dir)
+        self.assertEqual(2, len(store.object_dirs))
+        self.assertEqual(t_repo.location, project.repository.repo.git.config(
+            'remote.origin.url'))
+        return project
+
+    def test_git_update(self):
+        t_repo = self.source(TempGitRepository)
+        self.project(t_repo, 'git', 'first')
+        run_cmd(['git', 'commit', '-q', '--allow-empty', '-m', 'new'],
+                workdir=t_repo.location)
+        new = run_cmd(['git', 'rev-parse', 'HEAD'],
+                      workdir=t_repo.location)[1].strip()
+        mirror = self.cache.update(t_repo.location, 'git', 'source')
+        self.assertEqual(new, run_cmd(['git', 'rev-parse', 'HEAD'],
+                                      workdir=mirror)[1].strip())
+        # Clones borrow its objects, so they have to stay
+        self.assertEqual('0', run_cmd(['git', 'config', 'gc.auto'],
+                                      workdir=mirror)[1].strip())
+        self.assertEqual('never', run_cmd(['git', 'config', 'gc.pruneExpire'],
+                                          workdir=mirror)[1].strip())
+
+    def test_hg(self):
+        t_repo = self.source(TempHgRepository)
+        project = self.project(t_repo, 'hg')
+        dot_hg = os.path.join(project.local_path, '.hg')
+        self.assertTrue(os.path.exists(os.path.join(dot_hg, 'sharedpath')))
+        self.assertFalse(os.path.exists(os.path.join(dot_hg, 'store')))
+        self.check(project, t_repo)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import unittest
+
+from bisect_b2g.pool import CheckoutPool
+from bisect_b2g.repository import GitRepository, HgRepository
+from bisect_b2g.tests.test_repository import TempGitRepository, \
+    TempHgRepository, make_temp_dir
+
+
+class BasePoolFixture(object):
+
+    def setUp(self):
+        self.t_repo = self.fake_cls(revision_names=['A', 'B', 'C', 'D'])
+        self.revs = [x['commit'] for x in self.t_repo.revisions]
+        self.repo = self.real_cls(name='Testing', url=self.t_repo.location,
+                                  local_path=self.t_repo.location)
+        self.loc = make_temp_dir('TempPool')
+        self.pool = CheckoutPool(self.repo, os.path.join(self.loc, 'pool'))
+
+    def tearDown(self):
+        self.pool.close()
+        self.repo.close()
+        shutil.rmtree(self.t_repo.location)
+        shutil.rmtree(self.loc)
+
+    def lease(self, rev, distance=None):
+        slot = self.pool.acquire(rev, distance)
+        slot.set_rev(rev)
+        return slot
+
+    def test_checkout(self):
+        slot = self.lease(self.revs[1])
+        with open(os.path.join(slot.path, 'file')) as f:
+            self.assertEqual('B', f.read())
+        self.assertEqual(self.revs[1], slot.repository.get_rev())
+        # The original working directory doesn't move
+        self.assertEqual(self.revs[-1], self.repo.get_rev())
+
+    def test_leased_slots_are_not_shared(self):
+        first = self.lease(self.revs[0])
+        second = self.lease(self.revs[0])
+        self.assertNotEqual(first.path, second.path)
+
+    def test_same_rev_reuses_slot(self):
+        first = self.lease(self.revs[0])
+        second = self.lease(self.revs[2])
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertEqual(second.path, self.pool.acquire(self.revs[2]).path)
+        self.assertEqual(first.path, self.pool.acquire(self.revs[0]).path)
+
+    def test_closest_slot(self):
+        first = self.lease(self.revs[0])
+        second = self.lease(self.revs[3])
+        self.pool.release(first)
+        self.pool.release(second)
+        positions = dict((x, i) for i, x in enumerate(self.revs))
+        slot = self.pool.acquire(
+            self.revs[1], lambda x: abs(positions[x] - 1))
+        self.assertEqual(first.path, slot.path)
+
+    def test_budget(self):
+        self.pool.budget = 0
+        slot = self.lease(self.revs[0])
+        self.assertTrue(os.path.exists(slot.path))
+        self.pool.release(slot)
+        self.assertFalse(os.path.exists(slot.path))
+        self.assertEqual(self.revs[1], self.lease(self.revs[1])
+                         .repository.get_rev())
+
+    def test_measuring(self):
+        def sizes():
+            return [x['size'] for x in self.pool._with_state(
+                lambda s: s['slots'].values())]
+
+        # Nothing is measured without a budget
+        self.pool.release(self.lease(self.revs[0]))
+        self.assertEqual([None], sizes())
+        self.pool.budget = 1 << 30
+        self.pool.measure_every = 2
+        slot = self.lease(self.revs[0])
+        with open(os.path.join(slot.path, 'big'), 'w') as f:
+            f.write('x' * 10000)
+        self.pool.release(slot)
+        self.assertTrue(sizes()[0] >= 10000)
+        os.remove(os.path.join(slot.path, 'big'))
+        self.pool.release(self.lease(self.revs[0]))
+        self.assertTrue(sizes()[0] >= 10000)
+        self.pool.release(self.lease(self.revs[0]))
+        self.assertTrue(sizes()[0] < 10000)
+
+
+class GitPoolTests(BasePoolFixture, unittest.TestCase):
+    fake_cls = TempGitRepository
+    real_cls = GitRepository
+
+
+class HgPoolTests(BasePoolFixture, unittest.TestCase):
+    fake_cls = TempHgRepository
+    real_cls = HgRepository
@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import unittest
+
+from bisect_b2g import pushes
+from bisect_b2g.tests.test_repository import make_temp_dir
+
+
+class PushlogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempPushlog')
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def write(self, data):
+        path = os.path.join(self.loc, 'pushlog.json')
+        with open(path, 'w') as f:
+            if isinstance(data, basestring):
+                f.write(data)
+            else:
+                json.dump(data, f)
+        return path
+
+    def test_original_format(self):
+        path = self.write({
+            '12': {'changesets': ['c', 'd'], 'date': 2, 'user': 'x'},
+            '9': {'changesets': ['a', 'b'], 'date': 1, 'user': 'x'},
+        })
+        self.assertEqual([['a', 'b'], ['c', 'd']], pushes.load_pushlog(path))
+
+    def test_version_2(self):
+        path = self.write({'lastpushid': 3, 'pushes': {
+            '3': {'changesets': [{'node': 'c'}], 'date': 2},
+            '2': {'changesets': [{'node': 'a'}, {'node': 'b'}], 'date': 1},
+        }})
+        self.assertEqual([['a', 'b'], ['c']], pushes.load_pushlog(path))
+
+    def test_malformed(self):
+        for data in ('not json', [1, 2], {'1': {'date': 1}},
+                     {'x': {'changesets': []}}):
+            self.assertRaises(pushes.PushlogError, pushes.load_pushlog,
+                              self.write(data))
+        self.assertRaises(pushes.PushlogError, pushes.load_pushlog,
+                          os.path.join(self.loc, 'missing'))
+
+
+class PushHeadsTests(unittest.TestCase):
+
+    def rev_list(self, hashes):
+        return [(x, None) for x in hashes]
+
+    def test_push_heads(self):
+        rev_list = self.rev_list('abcdefgh')
+        groups = [['a'], ['b', 'c', 'd'], ['f', 'g', 'h']]
+        self.assertEqual(self.rev_list('adeh'),
+                         pushes.push_heads(rev_list, groups))
+
+    def test_ends_are_kept(self):
+        rev_list = self.rev_list('abcd')
+        self.assertEqual(self.rev_list('ad'),
+                         pushes.push_heads(rev_list, [['a', 'b', 'c', 'd']]))
+        self.assertEqual(rev_list, pushes.push_heads(rev_list, []))
+
+    def test_merge_groups(self):
+        rev_list = self.rev_list('abcdef')
+        self.assertEqual([['a', 'b', 'c'], ['d', 'e'], ['f']],
+                         pushes.merge_groups(rev_list, set(['c', 'e'])))
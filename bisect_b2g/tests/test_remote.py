@@ -0,0 +1,149 @@
+import os
+import shutil
+import socket
+import unittest
+import threading
+
+from bisect_b2g import remote
+from bisect_b2g.evaluator import Evaluator, ScriptEvaluator
+from bisect_b2g.repository import Rev
+from bisect_b2g.tests.test_repository import make_temp_dir
+
+dumbo = os.path.abspath(os.path.join(os.path.split(__file__)[0], 'dumbo.py'))
+
+
+class FakeRepository(object):
+
+    def __init__(self):
+        object.__init__(self)
+        self.sparse = None
+
+
+class FakeProject(object):
+
+    def __init__(self, name, local_path=None):
+        object.__init__(self)
+        self.name = name
+        self.url = 'https://example.com/' + name
+        self.local_path = local_path or name
+        self.vcs = 'git'
+        self.good = 'good'
+        self.bad = 'bad'
+        self.repository = FakeRepository()
+        self.rev = None
+
+    def get_rev(self):
+        return self.rev
+
+    def set_rev(self, rev):
+        self.rev = rev
+
+    def set_sparse(self, patterns):
+        self.repository.sparse = patterns
+
+    def close(self):
+        pass
+
+
+class EvenEvaluator(Evaluator):
+    """Even hashes pass, odd ones fail and 'broken' can't be tested"""
+
+    needs_checkout = False
+
+    def eval(self, history_line):
+        if history_line[0].hash == 'broken':
+            raise Exception("broken")
+        return int(history_line[0].hash) % 2 == 0
+
+
+class CoordinatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempRemote')
+        self.addCleanup(shutil.rmtree, self.loc)
+        self.project = FakeProject('gaia')
+        self.setups = []
+
+    def coordinator(self, **kwargs):
+        coordinator = remote.Coordinator('127.0.0.1:0', [self.project],
+                                         **kwargs)
+        self.addCleanup(coordinator.close)
+        return coordinator
+
+    def setup_projects(self, repo_datas):
+        self.setups.append(repo_datas)
+        return [FakeProject(x['name'], x['local_path']) for x in repo_datas]
+
+    def start_worker(self, coordinator, evaluator, name):
+        worker = remote.Worker('127.0.0.1:%d' % coordinator.address[1],
+                               evaluator, os.path.join(self.loc, name),
+                               self.setup_projects, name)
+        thread = threading.Thread(target=worker.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def line(self, hash):
+        return [Rev(hash, self.project, None)]
+
+    def test_parse_address(self):
+        self.assertEqual((socket.AF_INET, ('localhost', 1234)),
+                         remote.parse_address('localhost:1234'))
+        self.assertEqual((socket.AF_UNIX, '/tmp/sock'),
+                         remote.parse_address('/tmp/sock'))
+        self.assertEqual((socket.AF_UNIX, 'sock'),
+                         remote.parse_address('unix:sock'))
+        self.assertRaises(remote.RemoteError, remote.parse_address, 'nope')
+
+    def test_evaluate(self):
+        coordinator = self.coordinator()
+        threads = [self.start_worker(coordinator, EvenEvaluator(), str(x))
+                   for x in range(2)]
+        self.assertEqual([True, False, True, False],
+                         coordinator.evaluate([self.line(str(x))
+                                               for x in range(4)]))
+        self.assertEqual(True, coordinator.eval(self.line('8')))
+        coordinator.close()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(set(os.path.join(self.loc, x, 'gaia')
+                             for x in ('0', '1')),
+                         set(x[0]['local_path'] for x in self.setups))
+        self.assertEqual(self.project.url, self.setups[0][0]['uri'])
+
+    def test_lost_worker(self):
+        coordinator = self.coordinator()
+        # Takes a line and goes away without an answer
+        sock = remote.connect('127.0.0.1:%d' % coordinator.address[1])
+        conn = remote.Connection(sock)
+        conn.send({'worker': 'flaky'})
+        self.assertTrue('setup' in conn.recv())
+        conn.send({'ready': True})
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            coordinator.evaluate([self.line('2')])))
+        thread.start()
+        self.assertEqual(['2'], [x['hash'] for x in conn.recv()['revisions']])
+        conn.close()
+        self.start_worker(coordinator, EvenEvaluator(), 'steady')
+        thread.join(10)
+        self.assertEqual([[True]], results)
+
+    def test_errors(self):
+        coordinator = self.coordinator(max_attempts=2)
+        self.start_worker(coordinator, EvenEvaluator(), 'worker')
+        self.assertRaises(remote.RemoteError, coordinator.eval,
+                          self.line('broken'))
+        self.assertEqual(False, coordinator.eval(self.line('1')))
+
+    def test_log(self):
+        path = os.path.join(self.loc, 'log')
+        coordinator = self.coordinator(log_path=path)
+        evaluator = ScriptEvaluator([dumbo, 'STDOUT:hello', '--exit-code',
+                                     '0'])
+        os.makedirs(os.path.join(self.loc, 'worker'))
+        self.start_worker(coordinator, evaluator, 'worker')
+        self.assertEqual(True, coordinator.eval(self.line('a')))
+        with open(path) as f:
+            self.assertTrue('[worker] hello\n' in f.readlines())
@@ -7,7 +7,9 @@ import datetime
 import pytz
 
 from bisect_b2g.util import run_cmd
-from bisect_b2g.repository import GitRepository, HgRepository
+from bisect_b2g.repository import GitRepository, HgRepository, TagIndex, \
+    Project
+from bisect_b2g.hgserver import HgCommandError
 
 
 def make_temp_dir(prefix):
@@ -84,6 +86,7 @@ class BaseRepositoryFixture(object):
                                   local_path=self.t_repo.location)
 
     def tearDown(self):
+        self.repo.close()
         shutil.rmtree(self.t_repo.location)
 
     def test_get_rev_by_default_commit(self):
@@ -104,6 +107,16 @@ class BaseRepositoryFixture(object):
         self.assertEqual(self.t_repo.revisions[3]['commit'],
                          self.repo.get_rev(self.t_repo.revisions[3]['commit']))
 
+    def test_read_file(self):
+        for revision in self.t_repo.revisions[:3]:
+            self.assertEqual(revision['name'], self.repo.read_file(
+                revision['commit'], 'file'))
+        self.assertEqual(None, self.repo.read_file(
+            self.t_repo.revisions[0]['commit'], 'missing'))
+        # Reading doesn't move the working directory
+        self.assertEqual(self.t_repo.revisions[-1]['commit'],
+                         self.repo.get_rev())
+
     def test_get_rev_invalid(self):
         self.assertRaises(Exception,
                           self.repo.get_rev, ('INVALID'))
@@ -143,6 +156,29 @@ class BaseRepositoryFixture(object):
             self.t_repo.revisions[-1]['name'],
             self.repo.resolve_tag(None))
 
+    def test_tag_index(self):
+        self.tag_repo()
+        rev = self.t_repo.revisions[2]
+        index = self.repo.tag_index()
+        self.assertTrue(rev['name'] in index.tags[rev['commit']])
+        self.assertEqual(rev['commit'], index.names[rev['name']])
+        self.assertTrue(os.path.exists(index.path))
+        reopened = TagIndex(index.path)
+        self.assertTrue(reopened.load())
+        self.assertEqual(index.fingerprint, reopened.fingerprint)
+        self.assertEqual(index.names, reopened.names)
+
+    def test_tag_index_refresh(self):
+        self.tag_repo()
+        rev = self.t_repo.revisions[1]
+        self.repo.tag_index()
+        self.make_tag('refreshed', rev['commit'])
+        self.repo.refresh_tags()
+        self.assertTrue(
+            'refreshed' in self.repo.tag_index().tags[rev['commit']])
+        self.assertTrue(
+            'refreshed' in self.repo.resolve_tag(rev['commit']))
+
     def compare_rev_lists(self, expected, actual):
         self.assertEqual(len(expected), len(actual))
         commits_to_assert = ([], [])
@@ -171,12 +207,27 @@ class BaseRepositoryFixture(object):
 
         self.compare_rev_lists(revs, a_rev_list)
 
+    def test_indexed_rev_list(self):
+        revs = self.t_repo.revisions
+        for i in range(2):
+            a_rev_list = self.repo.rev_list(
+                revs[0]['commit'], revs[-1]['commit'], use_index=True)
+            self.compare_rev_lists(revs, a_rev_list)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.repo.metadata_dir(), 'commits.sqlite')))
+
 
 class GitTests(object):
     fake_cls = TempGitRepository
     real_cls = GitRepository
     heady_thing = 'HEAD'
 
+    def tag_repo(self):
+        pass
+
+    def make_tag(self, name, commit):
+        run_cmd(['git', 'tag', name, commit], workdir=self.t_repo.location)
+
 
 class HgTests(object):
     fake_cls = TempHgRepository
@@ -199,6 +250,10 @@ class HgRepositoryTests(HgTests, BaseRepositoryFixture, unittest.TestCase):
             run_cmd(['hg', 'tag', str(i['name']), '-r',
                     str(i['commit'])], workdir=self.t_repo.location)
 
+    def make_tag(self, name, commit):
+        run_cmd(['hg', 'tag', name, '-r', commit],
+                workdir=self.t_repo.location)
+
     @unittest.skip("Skipping because implementation is bad")
     def test_resolve_tag_by_tag(self):
         pass
@@ -218,3 +273,301 @@ class HgRepositoryTests(HgTests, BaseRepositoryFixture, unittest.TestCase):
     def test_set_rev_by_tag(self):
         self.tag_repo()
         BaseRepositoryFixture.test_set_rev_by_tag(self)
+
+    def test_command_server_restarts(self):
+        # Asking for '.' by name goes through hg instead of the dirstate
+        self.repo.get_rev('.')
+        self.repo.server.proc.kill()
+        self.repo.server.proc.wait()
+        self.assertEqual(self.t_repo.revisions[-1]['commit'],
+                         self.repo.get_rev('.'))
+        self.assertNotEqual(None, self.repo.server)
+
+    def test_command_server_reports_errors(self):
+        self.assertRaises(HgCommandError, self.repo.hg, 'log', '-r', 'INVALID')
+        self.assertEqual(self.t_repo.revisions[-1]['commit'],
+                         self.repo.get_rev())
+
+
+class BaseSparseFixture(object):
+
+    def setUp(self):
+        self.t_repo = self.fake_cls(revision_names=['A', 'B', 'C'])
+        os.makedirs(os.path.join(self.t_repo.location, 'other', 'dir'))
+        with open(os.path.join(self.t_repo.location, 'other', 'dir',
+                               'data'), 'w') as f:
+            f.write('data')
+        run_cmd([self.vcs, 'add', 'other'], workdir=self.t_repo.location)
+        run_cmd([self.vcs, 'commit', '-m', 'other'],
+                workdir=self.t_repo.location)
+        self.repo = self.real_cls(name='Testing', url=self.t_repo.location,
+                                  local_path=self.t_repo.location)
+        self.head = self.repo.get_rev()
+        self.loc = make_temp_dir('TempSparse')
+
+    def tearDown(self):
+        self.repo.close()
+        shutil.rmtree(self.t_repo.location)
+        shutil.rmtree(self.loc)
+
+    def exists(self, repo, *path):
+        return os.path.exists(os.path.join(repo.local_path, *path))
+
+    def test_sparse(self):
+        self.assertFalse(self.repo.is_sparse())
+        self.repo.set_sparse(['file'])
+        self.assertTrue(self.repo.is_sparse())
+        self.assertTrue(self.exists(self.repo, 'file'))
+        self.assertFalse(self.exists(self.repo, 'other'))
+        self.repo.set_rev(self.t_repo.revisions[1]['commit'])
+        with open(os.path.join(self.repo.local_path, 'file')) as f:
+            self.assertEqual('B', f.read())
+        self.repo.set_sparse(['other/dir'])
+        self.assertFalse(self.exists(self.repo, 'file'))
+        self.repo.set_sparse(None)
+        self.assertFalse(self.repo.is_sparse())
+        self.assertTrue(self.exists(self.repo, 'file'))
+
+    def test_sparse_left_from_before(self):
+        self.repo.set_sparse(['file'])
+        self.repo.close()
+        self.repo = self.real_cls(name='Testing', url=self.t_repo.location,
+                                  local_path=self.t_repo.location)
+        self.repo.set_sparse(None)
+        self.assertTrue(self.exists(self.repo, 'other', 'dir', 'data'))
+
+    def test_checkouts_are_sparse(self):
+        self.repo.set_sparse(['other/*'])
+        checkout = self.repo.add_checkout(os.path.join(self.loc, 'c'))
+        checkout.set_rev(self.head)
+        self.assertTrue(self.exists(checkout, 'other', 'dir', 'data'))
+        self.assertFalse(self.exists(checkout, 'file'))
+        checkout.close()
+
+
+class BasePathFilterFixture(object):
+
+    def setUp(self):
+        self.t_repo = self.fake_cls(revision_names=['A'])
+        self.paths = ['a/x', 'b/y', 'a/x', 'b/z', 'c', 'b/y']
+        for i, path in enumerate(self.paths):
+            path = os.path.join(self.t_repo.location, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(str(i))
+            run_cmd([self.vcs, 'add', path], workdir=self.t_repo.location)
+            run_cmd([self.vcs, 'commit', '-m', str(i)],
+                    workdir=self.t_repo.location)
+        self.project = Project('Testing', self.t_repo.location,
+                               self.t_repo.location,
+                               self.t_repo.revisions[0]['commit'],
+                               self.head(), vcs=self.vcs, use_index=False)
+        self.all_revs = [x[0] for x in self.project.rev_list()]
+
+    def tearDown(self):
+        self.project.close()
+        shutil.rmtree(self.t_repo.location)
+
+    def kept(self, include=None, exclude=None):
+        self.project.set_path_filter(include, exclude)
+        return [self.all_revs.index(x[0]) for x in self.project.rev_list()]
+
+    def test_changed_files(self):
+        changed = self.project.repository.changed_files(
+            self.all_revs[0], self.all_revs[-1])
+        self.assertEqual([[x] for x in self.paths],
+                         [changed[x] for x in self.all_revs[1:]])
+
+    def test_include(self):
+        self.assertEqual(range(7), self.kept())
+        self.assertEqual([0, 1, 3, 6], self.kept(['a']))
+        self.assertEqual([0, 2, 4, 5, 6], self.kept(['b', 'c']))
+        self.assertEqual([0, 4, 6], self.kept(['b/z*']))
+
+    def test_exclude(self):
+        self.assertEqual([0, 1, 3, 5, 6], self.kept(exclude=['b']))
+        self.assertEqual([0, 5, 6], self.kept(['a', 'c'], ['a/x']))
+
+    def test_pushes(self):
+        self.project.set_pushes([self.all_revs[1:4], self.all_revs[4:6]])
+        self.assertEqual([0, 3, 5, 6], self.kept())
+        # A push counts as changing everything its revisions change
+        self.assertEqual([0, 5, 6], self.kept(['c']))
+        self.assertEqual([0, 3, 6], self.kept(['a']))
+
+    def test_merge_pushes(self):
+        self.project.set_pushes('merges')
+        self.assertEqual(range(7), self.kept())
+        self.project.close()
+        merge = self.merge()
+        with open(os.path.join(self.t_repo.location, 'c'), 'w') as f:
+            f.write('after')
+        run_cmd([self.vcs, 'commit', '-m', 'after', 'c'],
+                workdir=self.t_repo.location)
+        self.project = Project('Testing', self.t_repo.location,
+                               self.t_repo.location,
+                               self.t_repo.revisions[0]['commit'],
+                               self.head(), vcs=self.vcs, use_index=False)
+        self.assertEqual(set([merge]), self.project.repository.merges(
+            self.t_repo.revisions[0]['commit'], self.head()))
+        self.all_revs = [x[0] for x in self.project.rev_list()]
+        self.project.set_pushes('merges')
+        last = len(self.all_revs) - 1
+        self.assertEqual([0, last - 1, last], self.kept())
+        self.assertEqual(merge, self.all_revs[last - 1])
+
+    def test_first_parents(self):
+        merge = self.merge()
+        # The side branch isn't on the first parent history
+        self.assertEqual([merge] + list(reversed(self.all_revs)), [
+            x[0] for x in self.project.repository.iter_revs_vcs(
+                self.all_revs[0], merge)])
+
+
+class GitPathFilterTests(BasePathFilterFixture, unittest.TestCase):
+    fake_cls = TempGitRepository
+    vcs = 'git'
+
+    def head(self):
+        return run_cmd(['git', 'rev-parse', 'HEAD'],
+                       workdir=self.t_repo.location)[1].strip()
+
+    def merge(self):
+        loc = self.t_repo.location
+        run_cmd(['git', 'checkout', '-q', '-b', 'side', 'HEAD~1'],
+                workdir=loc)
+        run_cmd(['git', 'commit', '-q', '--allow-empty', '-m', 'side'],
+                workdir=loc)
+        run_cmd(['git', 'checkout', '-q', '-'], workdir=loc)
+        run_cmd(['git', 'merge', '-q', '--no-ff', '-m', 'merge', 'side'],
+                workdir=loc)
+        return self.head()
+
+
+class HgPathFilterTests(BasePathFilterFixture, unittest.TestCase):
+    fake_cls = TempHgRepository
+    vcs = 'hg'
+
+    def head(self):
+        return run_cmd(['hg', 'log', '-r', 'tip', '--template', '{node}'],
+                       workdir=self.t_repo.location)[1].strip()
+
+    def merge(self):
+        loc = self.t_repo.location
+        main = self.head()
+        run_cmd(['hg', 'update', '-q', '-r', 'p1(tip)'], workdir=loc)
+        with open(os.path.join(loc, 'side'), 'w') as f:
+            f.write('side')
+        run_cmd(['hg', 'add', 'side'], workdir=loc)
+        run_cmd(['hg', 'commit', '-m', 'side'], workdir=loc)
+        run_cmd(['hg', 'update', '-q', '-r', main], workdir=loc)
+        run_cmd(['hg', 'merge', '-q', '-r', 'tip'], workdir=loc)
+        run_cmd(['hg', 'commit', '-m', 'merge'], workdir=loc)
+        return self.head()
+
+
+class GitSparseTests(BaseSparseFixture, unittest.TestCase):
+    fake_cls = TempGitRepository
+    real_cls = GitRepository
+    vcs = 'git'
+
+    def test_checkout_after_sparse(self):
+        self.repo.set_sparse(['other/*'])
+        apply_sparse = GitRepository._apply_sparse
+        seen = []
+
+        def check(repo, patterns):
+            seen.append(os.path.exists(os.path.join(repo.local_path, 'file')))
+            apply_sparse(repo, patterns)
+        GitRepository._apply_sparse = check
+        try:
+            checkout = self.repo.add_checkout(os.path.join(self.loc, 'c'))
+        finally:
+            GitRepository._apply_sparse = apply_sparse
+        # Nothing was there before the patterns were set
+        self.assertEqual([False], seen)
+        self.assertFalse(self.exists(checkout, 'file'))
+        self.assertTrue(self.exists(checkout, 'other', 'dir', 'data'))
+        checkout.close()
+
+
+class HgSparseTests(BaseSparseFixture, unittest.TestCase):
+    fake_cls = TempHgRepository
+    real_cls = HgRepository
+    vcs = 'hg'
+
+
+class CloneModeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempClones')
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def project(self, t_repo, vcs, clone_mode, good=0, bad=-1, url=None):
+        return Project('cloned', url or t_repo.location,
+                       os.path.join(self.loc, 'cloned'),
+                       t_repo.revisions[good]['commit'],
+                       t_repo.revisions[bad]['commit'],
+                       vcs=vcs, use_index=False, clone_mode=clone_mode)
+
+    def git_source(self):
+        t_repo = TempGitRepository(revision_names=range(8))
+        self.addCleanup(shutil.rmtree, t_repo.location)
+        run_cmd(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                workdir=t_repo.location)
+        return t_repo, 'file://' + t_repo.location
+
+    def check(self, project, t_repo, good=0, bad=-1):
+        expected = t_repo.revisions[good:bad % len(t_repo.revisions) + 1]
+        self.assertEqual([x['commit'] for x in expected],
+                         [x[0] for x in project.rev_list()])
+        project.set_rev(expected[0]['commit'])
+        with open(os.path.join(project.local_path, 'file')) as f:
+            self.assertEqual(expected[0]['name'], f.read())
+        project.close()
+
+    def test_git_partial(self):
+        t_repo, url = self.git_source()
+        project = self.project(t_repo, 'git', 'partial', url=url)
+        self.assertEqual('true', project.repository.repo.git.config(
+            'remote.origin.promisor'))
+        self.check(project, t_repo)
+
+    def test_git_shallow(self):
+        t_repo, url = self.git_source()
+        project = self.project(t_repo, 'git', 'shallow', good=2, bad=5,
+                               url=url)
+        self.check(project, t_repo, good=2, bad=5)
+
+    def test_git_top_up(self):
+        t_repo, url = self.git_source()
+        self.project(t_repo, 'git', 'full', bad=3).close()
+        # A commit the clone hasn't seen yet, which isn't on any branch
+        run_cmd(['git', 'checkout', '-q', t_repo.revisions[-1]['commit']],
+                workdir=t_repo.location)
+        run_cmd(['git', 'commit', '-q', '--allow-empty', '-m', 'new'],
+                workdir=t_repo.location)
+        new = run_cmd(['git', 'rev-parse', 'HEAD'],
+                      workdir=t_repo.location)[1].strip()
+        t_repo.revisions.append({'name': '7', 'commit': new})
+        project = self.project(t_repo, 'git', 'full', good=5)
+        self.assertEqual([x['commit'] for x in t_repo.revisions[5:]],
+                         [x[0] for x in project.rev_list()])
+        project.close()
+
+    def test_hg_bounded(self):
+        t_repo = TempHgRepository(revision_names=range(8))
+        self.addCleanup(shutil.rmtree, t_repo.location)
+        project = self.project(t_repo, 'hg', 'shallow', good=2, bad=5)
+        self.assertEqual(6, len(project.repository.changelog()))
+        self.check(project, t_repo, good=2, bad=5)
+
+    def test_hg_top_up(self):
+        t_repo = TempHgRepository(revision_names=range(8))
+        self.addCleanup(shutil.rmtree, t_repo.location)
+        self.project(t_repo, 'hg', 'shallow', bad=3).close()
+        project = self.project(t_repo, 'hg', 'shallow', good=2)
+        self.check(project, t_repo, good=2)
@@ -0,0 +1,64 @@
+import os
+import shutil
+import unittest
+
+from bisect_b2g.results import ResultStore, line_key
+from bisect_b2g.tests.test_repository import make_temp_dir
+
+
+class FakeProject(object):
+
+    def __init__(self, name):
+        object.__init__(self)
+        self.name = name
+
+
+class FakeRev(object):
+
+    def __init__(self, project, hash):
+        object.__init__(self)
+        self.prj = project
+        self.hash = hash
+
+
+class ResultStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = make_temp_dir('TempResults')
+        self.path = os.path.join(self.loc, 'results')
+        a, b = FakeProject('a'), FakeProject('b')
+        self.line = [FakeRev(b, '2'), FakeRev(a, '1')]
+        self.other = [FakeRev(a, '1'), FakeRev(b, '3')]
+
+    def tearDown(self):
+        shutil.rmtree(self.loc)
+
+    def test_line_key(self):
+        self.assertEqual((('a', '1'), ('b', '2')), line_key(self.line))
+
+    def test_empty(self):
+        self.assertEqual(None, ResultStore(self.path).get(self.line))
+
+    def test_put_get(self):
+        store = ResultStore(self.path)
+        store.put(self.line, True)
+        store.put(self.other, False)
+        self.assertEqual(True, store.get(self.line))
+        self.assertEqual(False, store.get(self.other))
+
+    def test_shared(self):
+        first = ResultStore(self.path)
+        second = ResultStore(self.path)
+        self.assertEqual(None, second.get(self.line))
+        first.put(self.line, False)
+        self.assertEqual(False, second.get(self.line))
+        self.assertEqual(False, ResultStore(self.path).get(self.line))
+
+    def test_partial_record(self):
+        store = ResultStore(self.path)
+        store.put(self.line, True)
+        with open(self.path, 'a') as f:
+            f.write('{"line": [["a", "1"], ["b"')
+        reader = ResultStore(self.path)
+        self.assertEqual(True, reader.get(self.line))
+        self.assertEqual(None, reader.get(self.other))
@@ -2,9 +2,12 @@
 
 import os
 import stat
+import time
+import shutil
 import unittest
 import subprocess
 import tempfile
+import StringIO
 
 import bisect_b2g.util as util
 
@@ -137,3 +140,89 @@ class RunCmdTest(unittest.TestCase):
             ([dumbo, "STDOUT:stdout", "STDERR:stderr"]),
             **{'inc_err': True, 'rc_only': True}
         )
+
+
+class RunProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='run_process')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_streams_lines(self):
+        lines = []
+        log_file = StringIO.StringIO()
+        result = util.run_process(
+            [dumbo, 'STDOUT:one', 'STDERR:two', 'STDOUT:three'],
+            inc_err=True, log_file=log_file, line_callback=lines.append)
+        self.assertEqual(['one', 'two', 'three'], lines)
+        self.assertEqual('one\ntwo\nthree\n', log_file.getvalue())
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue(result.rusage is not None)
+        self.assertEqual(None, result.timed_out)
+
+    def test_bounded_output(self):
+        result = util.run_process(
+            ['python', '-c', 'print "x" * 100000 + "end"'], keep_output=10)
+        self.assertEqual('xxxxxxend\n', result.output)
+
+    def test_all_output(self):
+        code, output = util.run_cmd(
+            ['python', '-c', 'print "x" * (2 << 20) + "end"'])
+        self.assertEqual('x' * (2 << 20) + 'end\n', output)
+
+    def test_workdir_defaults_to_current(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            code, output = util.run_cmd(['pwd', '-P'])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(os.path.realpath(self.tmpdir) + '\n', output)
+
+    def test_timeout_kills_group(self):
+        pid_file = os.path.join(self.tmpdir, 'pid')
+        start = time.time()
+        result = util.run_process(
+            ['sh', '-c', 'sleep 30 & echo $! > %s; wait' % pid_file],
+            timeout=0.5)
+        self.assertEqual('wall', result.timed_out)
+        self.assertTrue(time.time() - start < 10)
+        with open(pid_file) as f:
+            pid = int(f.read())
+        # The background sleep went too, although it might not have been
+        # reaped yet
+        time.sleep(0.2)
+        stat_path = '/proc/%d/stat' % pid
+        if os.path.exists(stat_path):
+            with open(stat_path) as f:
+                self.assertEqual('Z', f.read().rsplit(')', 1)[1].split()[0])
+        else:
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+    def test_timeout_without_output(self):
+        start = time.time()
+        result = util.run_process(
+            ['sh', '-c', 'exec > /dev/null 2>&1; sleep 30'], timeout=0.5)
+        self.assertEqual('wall', result.timed_out)
+        with open(os.devnull, 'w') as devnull:
+            result = util.run_process(['sleep', '30'], idle_timeout=0.5,
+                                      stdout=devnull, stderr=devnull)
+        self.assertEqual('idle', result.timed_out)
+        self.assertTrue(time.time() - start < 10)
+
+    def test_idle_timeout(self):
+        result = util.run_process(
+            ['sh', '-c', 'echo start; sleep 30'], idle_timeout=0.5)
+        self.assertEqual('idle', result.timed_out)
+        self.assertEqual('start\n', result.output)
+        # Output keeps it alive
+        result = util.run_process(
+            ['sh', '-c', 'for i in 1 2 3 4; do echo $i; sleep 0.2; done'],
+            idle_timeout=1)
+        self.assertEqual(None, result.timed_out)
+
+    def test_run_cmd_timeout(self):
+        self.assertRaises(util.RunCommandTimeout, util.run_cmd,
+                          ['sleep', '30'], rc_only=True, timeout=0.2)
@@ -0,0 +1,232 @@
+import os
+import shutil
+import unittest
+
+from mock import Mock
+
+from bisect_b2g.repository import Project, Rev
+from bisect_b2g.evaluator import Evaluator, PythonEvaluator
+from bisect_b2g.bisection import Bisection
+from bisect_b2g.workspace import Workspace, ParallelRunner, Prefetcher, \
+    layout_path, sparse_patterns
+from bisect_b2g.pool import CheckoutPool
+from bisect_b2g.tests.test_repository import TempGitRepository, \
+    TempHgRepository, make_temp_dir
+
+
+class FileEvaluator(Evaluator):
+    """Passes when every project's file says what the history line says"""
+
+    def eval_in(self, history_line, workdir):
+        for rev in history_line:
+            path = os.path.join(workdir, layout_path(rev.prj), 'file')
+            with open(path) as f:
+                if f.read() != rev.name:
+                    return False
+        return True
+
+
+class WorkspaceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.git = TempGitRepository(revision_names=['A', 'B', 'C'])
+        self.hg = TempHgRepository(revision_names=['D', 'E', 'F'])
+        self.loc = make_temp_dir('TempWorkspace')
+        self.projects = [
+            Project('git', self.git.location, self.git.location,
+                    'A', 'C', vcs='git'),
+            Project('hg', self.hg.location, self.hg.location,
+                    self.hg.revisions[0]['commit'],
+                    self.hg.revisions[-1]['commit'], vcs='hg'),
+        ]
+
+    def tearDown(self):
+        for project in self.projects:
+            project.close()
+        for path in (self.git.location, self.hg.location, self.loc):
+            shutil.rmtree(path)
+
+    def make_line(self, git_i, hg_i):
+        line = []
+        for project, fake, i in zip(self.projects, (self.git, self.hg),
+                                    (git_i, hg_i)):
+            rev = Rev(fake.revisions[i]['commit'], project,
+                      fake.revisions[i]['date'])
+            rev.name = fake.revisions[i]['name']
+            line.append(rev)
+        return line
+
+    def test_layout(self):
+        workspace = Workspace(os.path.join(self.loc, '0'), self.projects)
+        for project in self.projects:
+            self.assertTrue(os.path.isdir(
+                os.path.join(workspace.path, layout_path(project))))
+        workspace.close()
+
+    def test_sparse_patterns(self):
+        git, hg = [layout_path(x) for x in self.projects]
+        self.assertEqual(
+            {'git': ['a/b', 'c'], 'hg': ['*.txt']},
+            sparse_patterns(self.projects, [git + '/a/b', hg + '/*.txt',
+                                            git + '/./c', 'elsewhere/d']))
+
+    def test_sparse_workspace(self):
+        self.projects[0].set_sparse(['file'])
+        workspace = Workspace(os.path.join(self.loc, '0'), self.projects)
+        self.assertTrue(workspace.repositories['git'].is_sparse())
+        self.assertFalse(workspace.repositories['hg'].is_sparse())
+        workspace.close()
+
+    def test_runner(self):
+        workspaces = [Workspace(os.path.join(self.loc, str(i)),
+                                self.projects) for i in range(2)]
+        runner = ParallelRunner(FileEvaluator(), workspaces)
+        lines = [self.make_line(0, 1), self.make_line(2, 0),
+                 self.make_line(1, 2)]
+        self.assertEqual([True, True, True], runner.evaluate(lines))
+        runner.close()
+        # The projects' own checkouts are left alone
+        for project, fake in zip(self.projects, (self.git, self.hg)):
+            self.assertEqual(fake.revisions[-1]['commit'], project.get_rev())
+
+    def test_checkout_free_runner(self):
+        def check(files):
+            return all(x.name == files.read(
+                os.path.join(layout_path(x.prj), 'file'))
+                for x in files.history_line)
+        runner = ParallelRunner(PythonEvaluator(check), [], 2)
+        lines = [self.make_line(0, 1), self.make_line(2, 0)]
+        self.assertEqual([True, True], runner.evaluate(lines))
+        runner.close()
+
+    def test_checkout_free_bisection(self):
+        hg_path = os.path.join(layout_path(self.projects[1]), 'file')
+        history = [self.make_line(2, i) for i in range(3)]
+        evaluator = PythonEvaluator(lambda x: x.read(hg_path) == 'D')
+        bisection = Bisection(self.projects, history, evaluator)
+        self.assertEqual(0, bisection.found_i)
+        for project, fake in zip(self.projects, (self.git, self.hg)):
+            self.assertEqual(fake.revisions[-1]['commit'], project.get_rev())
+
+    def test_pooled_runner(self):
+        pools = dict((x.name, CheckoutPool(x.repository,
+                                           os.path.join(self.loc, x.name)))
+                     for x in self.projects)
+        workspaces = [Workspace(os.path.join(self.loc, str(i)),
+                                self.projects, pools) for i in range(2)]
+        runner = ParallelRunner(FileEvaluator(), workspaces)
+        lines = [self.make_line(0, 1), self.make_line(2, 0),
+                 self.make_line(1, 2)]
+        self.assertEqual([True, True, True], runner.evaluate(lines))
+        self.assertTrue(os.path.islink(os.path.join(
+            workspaces[0].path, layout_path(self.projects[0]))))
+        runner.close()
+        for pool in pools.values():
+            pool.close()
+
+
+class FakeWorkspace(object):
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.line = None
+        self.set_lines = 0
+
+    def set_line(self, history_line):
+        self.line = history_line
+        self.set_lines += 1
+
+    def close(self):
+        pass
+
+
+class FakeRev(object):
+
+    def __init__(self, prj, hash):
+        object.__init__(self)
+        self.prj = prj
+        self.hash = hash
+
+    def tag(self):
+        return self.hash
+
+
+class WorkspaceEvaluator(Evaluator):
+    """Checks it's run where the line is checked out"""
+
+    def __init__(self, workspaces, threshold):
+        Evaluator.__init__(self)
+        self.workspaces = dict((x.path, x) for x in workspaces)
+        self.threshold = threshold
+
+    def eval_in(self, history_line, workdir):
+        assert self.workspaces[workdir].line is history_line
+        return history_line[0].hash < self.threshold
+
+
+class FakeStore(object):
+
+    def __init__(self, outcomes):
+        object.__init__(self)
+        self.outcomes = outcomes
+
+    def get(self, history_line):
+        return self.outcomes.get(history_line[0].hash)
+
+    def put(self, history_line, outcome):
+        self.outcomes[history_line[0].hash] = outcome
+
+
+class PrefetcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Mock()
+        self.project.name = 'project'
+        self.workspaces = [FakeWorkspace(str(x)) for x in range(3)]
+        self.prefetcher = Prefetcher(self.workspaces)
+
+    def tearDown(self):
+        self.prefetcher.close()
+
+    def line(self, i):
+        return [FakeRev(self.project, i)]
+
+    def test_take_prefetched(self):
+        lines = [self.line(x) for x in range(3)]
+        current = self.prefetcher.take(lines[0])
+        self.prefetcher.prepare(lines[1:])
+        chosen = self.prefetcher.take(lines[2])
+        self.assertTrue(chosen is not current)
+        self.assertTrue(chosen.line is lines[2])
+        self.assertEqual(1, chosen.set_lines)
+
+    def test_take_other(self):
+        lines = [self.line(x) for x in range(4)]
+        self.prefetcher.take(lines[0])
+        self.prefetcher.prepare(lines[1:3])
+        chosen = self.prefetcher.take(lines[3])
+        self.assertTrue(chosen.line is lines[3])
+        # Taken from the candidates when nothing else is free
+        self.prefetcher.current = self.workspaces[0]
+        self.prefetcher.prepare(lines[1:3])
+        self.prefetcher.stale = []
+        self.assertTrue(self.prefetcher._idle() in self.workspaces[1:])
+        self.assertEqual(1, len(self.prefetcher.pending))
+
+    def test_bisection(self):
+        history = [self.line(x) for x in range(20)]
+        evaluator = WorkspaceEvaluator(self.workspaces, 13)
+        bisection = Bisection([self.project], history, evaluator,
+                              prefetcher=self.prefetcher)
+        self.assertEqual(12, bisection.found_i)
+        self.assertFalse(self.project.set_rev.called)
+
+    def test_stored_bisection(self):
+        history = [self.line(x) for x in range(64)]
+        evaluator = WorkspaceEvaluator(self.workspaces, 40)
+        # The second line to test already has a result, so isn't prefetched
+        bisection = Bisection([self.project], history, evaluator,
+                              FakeStore({48: False}),
+                              prefetcher=self.prefetcher)
+        self.assertEqual(39, bisection.found_i)
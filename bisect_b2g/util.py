@@ -1,6 +1,12 @@
 #!/bin/false
 
 import os
+import time
+import errno
+import select
+import signal
+import calendar
+import datetime
 import subprocess
 import logging
 
@@ -22,40 +28,303 @@ def generate_env(env=None, delete_env=None):
     return full_env
 
 
+class FixedOffset(datetime.tzinfo):
+    """A timezone that is always `offset` seconds east of UTC"""
+
+    def __init__(self, offset):
+        datetime.tzinfo.__init__(self)
+        self.offset = offset
+
+    def utcoffset(self, dt):
+        return datetime.timedelta(seconds=self.offset)
+
+    def tzname(self, dt):
+        return ''
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+
+_offsets = {}
+
+
+def from_epoch(epoch, offset):
+    """Make an aware datetime from seconds since the epoch and an offset
+    in seconds east of UTC"""
+    if offset not in _offsets:
+        _offsets[offset] = FixedOffset(offset)
+    return datetime.datetime.fromtimestamp(epoch, _offsets[offset])
+
+
+def to_epoch(date):
+    """The reverse of from_epoch.  Naive datetimes are taken to be UTC"""
+    epoch = calendar.timegm(date.utctimetuple())
+    if date.microsecond:
+        epoch += date.microsecond / 1e6
+    delta = date.utcoffset() or datetime.timedelta(0)
+    return epoch, delta.days * 86400 + delta.seconds
+
+
+class StoreError(Exception):
+    """Raised when a repository can't be read without running its VCS"""
+    pass
+
+
 class RunCommandException(Exception):
     pass
 
 
-# XXX: This function is garbage!  It should have a complete rewrite
-def run_cmd(command, workdir=os.getcwd(), inc_err=False,
-            env=None, delete_env=False, rc_only=False,
-            raise_if_not=0, **kwargs):
+class RunCommandTimeout(RunCommandException):
 
-    kwargs = kwargs.copy()
-    full_env = generate_env(env, delete_env)
+    def __init__(self, msg, result):
+        RunCommandException.__init__(self, msg)
+        self.result = result
 
-    if rc_only and inc_err:
-        raise RunCommandException(
-            "You're asking to ignore output(rc_only) but to " +
-            "include stderr.  You are quizzical"
-        )
 
+class OutputTail(object):
+    """Keeps the last size bytes written to it, or all of them"""
+
+    def __init__(self, size):
+        object.__init__(self)
+        self.size = size
+        self.chunks = []
+        self.length = 0
+
+    def write(self, data):
+        if self.size is None:
+            self.chunks.append(data)
+            return
+        if self.size <= 0:
+            return
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.pop(0))
+
+    def getvalue(self):
+        data = ''.join(self.chunks)
+        if self.size is None:
+            return data
+        return data[-self.size:] if self.size > 0 else ''
+
+
+class ProcessResult(object):
+    """How a command run by run_process went"""
+
+    def __init__(self, command, exit_code, output, error, duration,
+                 rusage=None, timed_out=None):
+        object.__init__(self)
+        self.command = command
+        self.exit_code = exit_code
+        self.output = output
+        self.error = error
+        self.duration = duration
+        self.rusage = rusage
+        # None, or 'wall' or 'idle' for the timeout that stopped it
+        self.timed_out = timed_out
+
+    def describe_usage(self):
+        if self.rusage is None:
+            return "%.1fs" % self.duration
+        return "%.1fs, %.1fs user, %.1fs system, %d KB peak memory" % (
+            self.duration, self.rusage.ru_utime, self.rusage.ru_stime,
+            self.rusage.ru_maxrss)
+
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def pid_alive(pid):
+    """Whether a process with this pid exists, even if we can't signal it"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def kill_group(proc, grace=5):
+    """Stop a process and everything it started, politely at first"""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        return
+    deadline = time.time() + grace
+    while time.time() < deadline:
+        pid, status = os.waitpid(proc.pid, os.WNOHANG)
+        if pid != 0:
+            # Reaped here, so there's no rusage for it
+            proc.returncode = _returncode(status)
+            break
+        time.sleep(0.05)
+    # Whatever is left of the group doesn't get a choice
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def run_process(command, workdir=None, inc_err=False, env=None,
+                delete_env=False, timeout=None, idle_timeout=None,
+                log_file=None, line_callback=None, keep_output=None,
+                **kwargs):
+    """
+    Run command in its own process group, reading its output as it comes
+    instead of all at once.  If keep_output is given, only the last
+    keep_output bytes of stdout and of stderr are kept.  Every line is also
+    written to log_file and passed to line_callback, if they're given.  If
+    it runs for more than timeout seconds or prints nothing for
+    idle_timeout seconds, the whole process group is killed.  Returns a
+    ProcessResult
+    """
+    kwargs = kwargs.copy()
     if inc_err:
         kwargs['stderr'] = subprocess.STDOUT
-
     for x in ('stdout', 'stderr'):
-        if not x in kwargs:
+        if x not in kwargs:
             kwargs[x] = subprocess.PIPE
+    start = time.time()
+    proc = subprocess.Popen(command, cwd=workdir,
+                            env=generate_env(env, delete_env),
+                            preexec_fn=os.setsid, **kwargs)
+    tails = {}
+    streams = {}
+    for name in ('stdout', 'stderr'):
+        tails[name] = OutputTail(keep_output)
+        pipe = getattr(proc, name)
+        if pipe is not None:
+            streams[pipe.fileno()] = (pipe, tails[name], [''])
+    last_output = start
+    timed_out = None
+
+    def emit(partial, data, flush=False):
+        lines = (partial[0] + data).split('\n')
+        partial[0] = '' if flush else lines.pop()
+        for line in lines:
+            if flush and not line:
+                continue
+            if log_file is not None:
+                log_file.write(line + '\n')
+            if line_callback is not None:
+                line_callback(line)
 
-    proc = subprocess.Popen(command, cwd=workdir, env=full_env, **kwargs)
+    def deadline():
+        deadlines = []
+        if timeout is not None:
+            deadlines.append(start + timeout)
+        if idle_timeout is not None:
+            deadlines.append(last_output + idle_timeout)
+        return min(deadlines) if deadlines else None
+
+    def expired(now):
+        if timeout is not None and now >= start + timeout:
+            return 'wall'
+        elif idle_timeout is not None and now >= last_output + idle_timeout:
+            return 'idle'
+        return None
+
+    while streams:
+        wait = deadline()
+        if wait is not None:
+            wait = max(0, wait - time.time())
+        try:
+            ready = select.select(streams.keys(), [], [], wait)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        now = time.time()
+        if not ready:
+            timed_out = expired(now)
+            if timed_out:
+                log.warning("%s timed out after %.1fs (%s), killing it",
+                            command, now - start, timed_out)
+                kill_group(proc)
+                break
+            continue
+        for fd in ready:
+            pipe, tail, partial = streams[fd]
+            data = os.read(fd, 65536)
+            if not data:
+                emit(partial, '', flush=True)
+                pipe.close()
+                del streams[fd]
+                continue
+            last_output = now
+            tail.write(data)
+            emit(partial, data)
+    for pipe, tail, partial in streams.values():
+        pipe.close()
+
+    # It can close its output and keep running, so the timeouts still apply
+    rusage = None
+    while proc.returncode is None:
+        polling = timed_out is None and deadline() is not None
+        try:
+            pid, status, rusage = os.wait4(proc.pid,
+                                           os.WNOHANG if polling else 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+            continue
+        if pid != 0:
+            proc.returncode = _returncode(status)
+            break
+        now = time.time()
+        timed_out = expired(now)
+        if timed_out:
+            log.warning("%s timed out after %.1fs (%s), killing it",
+                        command, now - start, timed_out)
+            kill_group(proc)
+        else:
+            time.sleep(min(0.05, max(0, deadline() - now)))
+    if log_file is not None:
+        log_file.flush()
+
+    result = ProcessResult(command, proc.returncode,
+                           tails['stdout'].getvalue(),
+                           tails['stderr'].getvalue(),
+                           time.time() - start, rusage, timed_out)
+    log.debug("%s exited with %s after %s", command, result.exit_code,
+              result.describe_usage())
+    return result
+
+
+def run_cmd(command, workdir=None, inc_err=False,
+            env=None, delete_env=False, rc_only=False,
+            raise_if_not=0, **kwargs):
+    """
+    Run command and return its exit code and output, raising
+    RunCommandException if the exit code isn't raise_if_not, unless that's
+    None or only the exit code is wanted.  Other arguments are passed on
+    to run_process, and RunCommandTimeout is raised if it times out
+    """
+    if rc_only and inc_err:
+        raise RunCommandException(
+            "You're asking to ignore output(rc_only) but to " +
+            "include stderr.  You are quizzical"
+        )
 
-    output, stderr = proc.communicate()
+    result = run_process(command, workdir=workdir, inc_err=inc_err, env=env,
+                         delete_env=delete_env, **kwargs)
+    if result.timed_out:
+        raise RunCommandTimeout(
+            "%s in %s timed out (%s) after %.1fs" % (
+                command, workdir or os.getcwd(), result.timed_out,
+                result.duration), result)
 
-    exit_code = proc.poll()
+    exit_code = result.exit_code
     if raise_if_not is None or exit_code == raise_if_not or rc_only:
-        return exit_code, output
+        return exit_code, result.output
     else:
         raise RunCommandException(
             "Exit code is %d, not %d for %s in %s\nStdout:%s\nStderr:%s" % (
-                exit_code, raise_if_not, command, workdir, output, stderr)
+                exit_code, raise_if_not, command, workdir or os.getcwd(),
+                result.output, result.error)
         )
@@ -0,0 +1,270 @@
+import os
+import Queue
+import logging
+from multiprocessing.pool import ThreadPool
+
+from bisect_b2g.pool import CheckoutPool
+from bisect_b2g.results import line_key
+
+log = logging.getLogger(__name__)
+
+
+def layout_path(project):
+    """
+    Where a project goes inside a workspace.  Projects keep their path
+    relative to the current directory so that scripts written for the
+    normal checkouts work unchanged in a workspace
+    """
+    path = os.path.relpath(os.path.abspath(project.local_path))
+    if os.path.isabs(path) or path.split(os.sep)[0] == os.pardir:
+        return project.name
+    return path
+
+
+def sparse_patterns(projects, paths, layout=None):
+    """
+    Split paths, which start with where a project is checked out, into the
+    patterns for each project.  Projects without any are left out.  layout
+    maps project names to where they are checked out, if that isn't their
+    layout_path
+    """
+    patterns = {}
+    for path in paths:
+        path = os.path.normpath(path)
+        for project in projects:
+            if layout is not None:
+                prefix = layout[project.name] + os.sep
+            else:
+                prefix = layout_path(project) + os.sep
+            if path.startswith(prefix):
+                patterns.setdefault(project.name, []).append(
+                    path[len(prefix):])
+                break
+        else:
+            log.warning("%s isn't in any of the projects", path)
+    return patterns
+
+
+class Workspace(object):
+    """
+    A directory with a private checkout of every project.  Without pools
+    each project is cloned into the workspace.  With a CheckoutPool for
+    each project, the workspace holds symlinks to slots leased from the
+    pools instead, and positions maps each project to {hash: index} so the
+    slot closest to a revision can be picked
+    """
+
+    def __init__(self, path, projects, pools=None, positions=None):
+        object.__init__(self)
+        self.path = os.path.abspath(path)
+        self.pools = pools
+        self.positions = positions or {}
+        self.repositories = {}
+        self.slots = {}
+        self.links = {}
+        for project in projects:
+            local_path = os.path.join(self.path, layout_path(project))
+            parent = os.path.dirname(local_path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if pools is not None:
+                self.links[project.name] = local_path
+                continue
+            log.debug("Workspace copy of %s is at %s", project.name,
+                      local_path)
+            self.repositories[project.name] = project.checkout_at(local_path)
+
+    def _distance(self, name, rev):
+        positions = self.positions.get(name, {})
+        if rev not in positions:
+            return lambda x: None
+        return lambda x: abs(positions[x] - positions[rev]) \
+            if x in positions else None
+
+    def _lease(self, rev):
+        name = rev.prj.name
+        pool = self.pools[name]
+        if name in self.slots:
+            pool.release(self.slots.pop(name))
+        slot = pool.acquire(rev.hash, self._distance(name, rev.hash))
+        self.slots[name] = slot
+        link = self.links[name]
+        if os.path.islink(link):
+            os.remove(link)
+        os.symlink(slot.path, link)
+        return slot.repository
+
+    def set_line(self, history_line):
+        for rev in history_line:
+            log.debug("Setting %s to %s in %s", rev.prj.name, rev.hash,
+                      self.path)
+            if self.pools is not None:
+                repository = self._lease(rev)
+            else:
+                repository = self.repositories[rev.prj.name]
+            if repository.get_rev() != rev.hash:
+                repository.set_rev(rev.hash)
+
+    def close(self):
+        for name, slot in self.slots.items():
+            self.pools[name].release(slot)
+        self.slots = {}
+        for repository in self.repositories.values():
+            repository.close()
+
+
+class ParallelRunner(object):
+    """
+    Evaluates several history lines at once, each one in a Workspace of its
+    own.  There are as many jobs as workspaces, unless the evaluator
+    doesn't need the lines checked out, which then needs no workspaces
+    """
+
+    def __init__(self, evaluator, workspaces, jobs=None):
+        object.__init__(self)
+        self.evaluator = evaluator
+        self.workspaces = workspaces
+        self.jobs = jobs or len(workspaces)
+        self.free = Queue.Queue()
+        for workspace in workspaces:
+            self.free.put(workspace)
+        self.pool = ThreadPool(self.jobs)
+
+    def _evaluate(self, history_line):
+        if not self.evaluator.needs_checkout:
+            return self.evaluator.eval(history_line)
+        workspace = self.free.get()
+        try:
+            workspace.set_line(history_line)
+            return self.evaluator.eval_in(history_line, workspace.path)
+        finally:
+            self.free.put(workspace)
+
+    def evaluate(self, history_lines):
+        """Return the outcome for each line, in the same order"""
+        return self.pool.map(self._evaluate, history_lines)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for workspace in self.workspaces:
+            workspace.close()
+
+
+def make_pools(projects, budget=None):
+    """A CheckoutPool for each project, kept with its repository"""
+    pools = {}
+    for project in projects:
+        repository = project.repository
+        pools[project.name] = CheckoutPool(
+            repository, os.path.join(repository.metadata_dir(), 'checkouts'),
+            budget)
+    return pools
+
+
+class Prefetcher(object):
+    """
+    Gets the next lines a binary bisection might test ready in spare
+    workspaces while the current one is being evaluated.  Once the outcome
+    is known, take() hands back the workspace that already has the chosen
+    line checked out and the other candidate is left to finish in the
+    background
+    """
+
+    def __init__(self, workspaces):
+        object.__init__(self)
+        self.workspaces = workspaces
+        self.current = None
+        self.pending = {}
+        self.stale = []
+        self.pool = ThreadPool(len(workspaces))
+
+    def _idle(self):
+        busy = [x[0] for x in self.pending.values() + self.stale]
+        for workspace in self.workspaces:
+            if workspace is not self.current and workspace not in busy:
+                return workspace
+        if self.stale:
+            workspace, result = self.stale.pop(0)
+        else:
+            # Nothing left over, so one of the candidates has to give way
+            workspace, result = self.pending.pop(sorted(self.pending)[0])
+        result.wait()
+        return workspace
+
+    def _prepare(self, workspace, history_line):
+        workspace.set_line(history_line)
+        # Warm up the tag cache for the report and the log
+        for rev in history_line:
+            rev.tag()
+
+    def prepare(self, history_lines):
+        """Start checking out the lines that might be tested next"""
+        keys = [line_key(x) for x in history_lines]
+        for key in self.pending.keys():
+            if key not in keys:
+                self.stale.append(self.pending.pop(key))
+        for key, line in zip(keys, history_lines):
+            if key not in self.pending:
+                workspace = self._idle()
+                log.debug("Prefetching %s in %s", key, workspace.path)
+                self.pending[key] = (workspace, self.pool.apply_async(
+                    self._prepare, (workspace, line)))
+
+    def take(self, history_line):
+        """
+        A workspace with history_line checked out, which doesn't have to be
+        one of the lines that were prepared
+        """
+        key = line_key(history_line)
+        # Whatever was being tested is done with
+        self.current = None
+        if key in self.pending:
+            workspace, result = self.pending.pop(key)
+            try:
+                result.get()
+                log.debug("Using prefetched %s", workspace.path)
+            except Exception as e:
+                log.warning("Prefetching into %s failed: %s",
+                            workspace.path, e)
+                workspace.set_line(history_line)
+        else:
+            workspace = self._idle()
+            workspace.set_line(history_line)
+        self.current = workspace
+        return workspace
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for workspace in self.workspaces:
+            workspace.close()
+
+
+def _positions(projects):
+    positions = {}
+    for project in projects:
+        positions[project.name] = dict(
+            (x[0], i) for i, x in enumerate(project.rev_list()))
+    return positions
+
+
+def _workspaces(projects, path, count, pools=None):
+    positions = _positions(projects) if pools is not None else None
+    workspaces = []
+    for i in range(count):
+        log.info("Setting up workspace %d of %d", i + 1, count)
+        workspaces.append(Workspace(os.path.join(path, str(i)), projects,
+                                    pools, positions))
+    return workspaces
+
+
+def make_runner(evaluator, projects, path, jobs, pools=None):
+    if not evaluator.needs_checkout:
+        return ParallelRunner(evaluator, [], jobs)
+    return ParallelRunner(evaluator, _workspaces(projects, path, jobs, pools))
+
+
+def make_prefetcher(projects, path, pools=None):
+    # One workspace being tested and one for each of the next candidates
+    return Prefetcher(_workspaces(projects, path, 3, pools))
@@ -1,6 +1,7 @@
 #!/bin/bash
 
 # From git gaia 5a1c8dd69f66c8b5a7f2e5bc0fc183992af07b44's second parent
+# bisect_b2g-path: gaia/apps/communications/dialer/index.html
 
 grep '           <span id="dialer-message-text" data-l10n-id="NoPreviousOutgoingCalls" hidden> </span>'\
     gaia/apps/communications/dialer/index.html